@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Benchmark of the storage queries with and without the indexes of the jobs, entities and used tables.
+A database is populated with N jobs (1M by default) and N/10 entities, then the latency of the
+following queries is measured with the indexes dropped, then created again (as after a migration):
+* joblist: jobs of a user for a jobname, ordered by creation_time (get_list)
+* joblist_admin: last jobs for a jobname, all users (get_list for admin, LAST=100)
+* job_event: job read from its process_id (read with from_process_id=True)
+* entity_hash: entities with a given hash (register_entity)
+
+The database is created in a temporary SQLite file by default (--db to use e.g. PostgreSQL),
+it is not the database of the server.
+
+Usage:
+    python benchmarks/bench_indexes.py [-n 1000000] [-r 20] [--db sqlite:////tmp/bench.db]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+import datetime as dt
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from sqlalchemy import select
+from uws_server import storage
+
+JOBNAMES = ['job_{}'.format(i) for i in range(20)]
+OWNERS = ['user_{}'.format(i) for i in range(1000)]
+PHASES = ['COMPLETED'] * 8 + ['ERROR', 'ABORTED', 'EXECUTING', 'QUEUED', 'ARCHIVED']
+
+
+def populate(db, n, batch_size=10000):
+    t0 = dt.datetime(2020, 1, 1)
+    with db.engine.begin() as conn:
+        for start in range(0, n, batch_size):
+            jobs = []
+            entities = []
+            for i in range(start, min(start + batch_size, n)):
+                owner = random.choice(OWNERS)
+                jobs.append({
+                    'jobid': 'job{:09d}'.format(i),
+                    'jobname': random.choice(JOBNAMES),
+                    'phase': random.choice(PHASES),
+                    'creation_time': (t0 + dt.timedelta(seconds=i * 60)).strftime(storage.DT_FMT),
+                    'owner': owner,
+                    'owner_token': owner,
+                    'run_id': '',
+                    'process_id': i + 1,
+                })
+                if i % 10 == 0:
+                    entities.append({
+                        'entity_id': 'entity{:09d}'.format(i),
+                        'file_name': 'output.txt',
+                        'hash': '{:064x}'.format(i),
+                        'creation_time': (t0 + dt.timedelta(seconds=i * 60)).strftime(storage.DT_FMT),
+                        'owner': owner,
+                        'jobid': 'job{:09d}'.format(i),
+                        'result_name': 'output',
+                    })
+            conn.execute(db.Job.__table__.insert(), jobs)
+            conn.execute(db.Entity.__table__.insert(), entities)
+            print('\r  {} jobs'.format(start + len(jobs)), end='', flush=True)
+    print()
+
+
+def drop_indexes(db):
+    with db.engine.begin() as conn:
+        for table in db.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.exec_driver_sql('DROP INDEX IF EXISTS {}'.format(index.name))
+
+
+def measure(db, n, repeat):
+    Job = db.Job
+    Entity = db.Entity
+
+    def joblist():
+        owner = random.choice(OWNERS)
+        return select(Job.jobid, Job.phase, Job.creation_time).where(
+            Job.jobname == random.choice(JOBNAMES), Job.phase.notin_(['ARCHIVED']),
+            Job.owner == owner, Job.owner_token == owner,
+        ).order_by(Job.creation_time.asc())
+
+    queries = {
+        'joblist': joblist,
+        'joblist_admin': lambda: select(Job.jobid, Job.phase, Job.creation_time).where(
+            Job.jobname == random.choice(JOBNAMES),
+        ).order_by(Job.creation_time.desc()).limit(100),
+        'job_event': lambda: select(Job).where(Job.process_id == random.randint(1, n)),
+        'entity_hash': lambda: select(Entity).where(Entity.hash == '{:064x}'.format(random.randrange(0, n, 10))),
+    }
+    latencies = {}
+    with db.engine.connect() as conn:
+        for name, query in queries.items():
+            t0 = time.perf_counter()
+            for i in range(repeat):
+                conn.execute(query()).fetchall()
+            latencies[name] = (time.perf_counter() - t0) / repeat * 1000
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=1000000, help='number of jobs')
+    parser.add_argument('-r', type=int, default=20, help='number of queries of each type')
+    parser.add_argument('--db', default='', help='database (SQLAlchemy URL), a temporary SQLite file by default')
+    args = parser.parse_args()
+    db_file = None
+    db_string = args.db
+    if not db_string:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        db_string = 'sqlite:///' + db_file
+    random.seed(0)
+    try:
+        db = storage.SQLAlchemyDatabase(db_string)
+        print('Database: {}'.format(db.engine.url))
+        print('Populate {} jobs...'.format(args.n))
+        t0 = time.perf_counter()
+        populate(db, args.n)
+        print('  done in {:.1f}s'.format(time.perf_counter() - t0))
+        drop_indexes(db)
+        before = measure(db, args.n, args.r)
+        t0 = time.perf_counter()
+        db.create_indexes()
+        print('Indexes created in {:.1f}s'.format(time.perf_counter() - t0))
+        after = measure(db, args.n, args.r)
+        print('{:15s} {:>14s} {:>14s}'.format('query', 'no index (ms)', 'indexes (ms)'))
+        for name in before:
+            print('{:15s} {:14.2f} {:14.2f}'.format(name, before[name], after[name]))
+        db.engine.dispose()
+    finally:
+        if db_file:
+            os.remove(db_file)
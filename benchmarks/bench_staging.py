@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Benchmark of the staging strategies of the input files of local jobs (see LOCAL_STAGING): for each size, an
+input file is created in the source directory (as in UPLOADS_PATH), then staged to the destination directory
+(as in LOCAL_WORKDIR_PATH) with the bash command generated by LocalManager for each strategy:
+copy, reflink, hardlink, symlink.
+
+The source and destination directories are temporary directories in --src and --dst (the system temporary
+directory by default), use directories on the file systems of the deployment. The strategy selected by
+LOCAL_STAGING = 'auto' for these directories is also reported.
+
+Usage:
+    python benchmarks/bench_staging.py [-s 1 2 5] [--src /var/opt/opus/uploads] [--dst /tmp]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from uws_server import managers
+
+GB = 1024**3
+
+
+def make_input(path, size, chunk_size=16 * 1024**2):
+    """Write a file of size bytes (random blocks, not compressible)"""
+    block = os.urandom(chunk_size)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            n = min(chunk_size, size - written)
+            f.write(block[:n])
+            written += n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', type=float, nargs='+', default=[1, 2, 5], help='sizes of the inputs in GB')
+    parser.add_argument('--src', default=None, help='directory of the input files')
+    parser.add_argument('--dst', default=None, help='directory where the input files are staged')
+    args = parser.parse_args()
+    src_dir = tempfile.mkdtemp(dir=args.src)
+    dst_dir = tempfile.mkdtemp(dir=args.dst)
+    manager = managers.LocalManager()
+    print('Staging from {} to {} (auto: {})'.format(src_dir, dst_dir, manager.detect_staging(src_dir, dst_dir)))
+    print('{:>8s} '.format('size(GB)') + ' '.join('{:>12s}'.format(s + ' (s)') for s in manager.staging_strategies))
+    try:
+        for size_gb in args.s:
+            src = os.path.join(src_dir, 'input.fits')
+            make_input(src, int(size_gb * GB))
+            durations = []
+            for staging in manager.staging_strategies:
+                dst = os.path.join(dst_dir, 'input.fits')
+                command = manager._stage_file(src, dst, staging=staging)
+                t0 = time.perf_counter()
+                subprocess.run(['bash', '-c', command], check=True)
+                durations.append(time.perf_counter() - t0)
+                assert os.path.getsize(dst) == os.path.getsize(src)
+                os.remove(dst)
+            print('{:8.2f} '.format(size_gb) + ' '.join('{:12.3f}'.format(d) for d in durations))
+            os.remove(src)
+    finally:
+        shutil.rmtree(src_dir)
+        shutil.rmtree(dst_dir)
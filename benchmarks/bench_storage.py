@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Benchmark of GET /rest/<jobname>/<jobid> with a shared storage engine (pooled) versus an engine
+created for each request (previous behaviour, emulated by disposing the engines before each request).
+
+The database used is the one configured in settings (SQLite by default). To benchmark PostgreSQL,
+set STORAGE_TYPE = 'PostgreSQL' and the PGSQL_* variables in settings_local.py.
+
+Usage:
+    python benchmarks/bench_storage.py [-n 500]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import webtest
+from uws_server import uws_server
+from uws_server import storage
+
+jobname = 'test_'
+user = uws_server.User('test_', 'test_')
+
+
+def create_job():
+    request = type('MyClass', (object,), {'POST': {'runId': 'bench_'}, 'files': {}})()
+    job = uws_server.Job(jobname, '', user, from_post=request)
+    return job
+
+
+def run(test_app, url, n, pooled):
+    t0 = time.perf_counter()
+    for i in range(n):
+        if not pooled:
+            storage.dispose_databases()
+        test_app.get(url)
+    return n / (time.perf_counter() - t0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=500, help='number of requests for each mode')
+    args = parser.parse_args()
+    test_app = webtest.TestApp(uws_server.app)
+    job = create_job()
+    url = '/rest/{}/{}'.format(jobname, job.jobid)
+    print('Database: {}'.format(uws_server.SQLALCHEMY_DB))
+    print('GET {} x {}'.format(url, args.n))
+    try:
+        rps_before = run(test_app, url, args.n, pooled=False)
+        print('  engine per request : {:8.1f} requests/s'.format(rps_before))
+        rps_after = run(test_app, url, args.n, pooled=True)
+        print('  shared engine      : {:8.1f} requests/s'.format(rps_after))
+        print('  speedup            : {:8.1f}x'.format(rps_after / rps_before))
+    finally:
+        job.storage.delete(job)
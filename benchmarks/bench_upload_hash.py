@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Benchmark of the hash of the files uploaded from a form (input entities of a job). For each size, a file is
+uploaded (bottle FileUpload read from a spooled file, as for a multipart request) and saved to a directory:
+* two_pass: file saved, then hashed by EntityStorage.get_hash() with 64 KB chunks (previous behaviour)
+* two_pass_buffer: same, with HASH_CHUNK_SIZE chunks for get_hash()
+* single_pass: hash computed while the file is written (save_upload(), storage.HashWriter)
+
+The files are written in --dir (a temporary directory by default), which needs twice the largest size in free
+space. The second read of two_pass may be served by the page cache if the file fits in memory: use sizes larger
+than the memory of the machine to measure the disk reads.
+
+Usage:
+    python benchmarks/bench_upload_hash.py [-s 1 2 5 10] [--dir /var/tmp]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from bottle import FileUpload
+from uws_server import uws_server
+from uws_server import storage
+
+GB = 1024**3
+
+
+def make_source(path, size, chunk_size=16 * 1024**2):
+    """Write a file of size bytes (random blocks, not compressible)"""
+    block = os.urandom(chunk_size)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            n = min(chunk_size, size - written)
+            f.write(block[:n])
+            written += n
+
+
+def two_pass(source, dest, buffer_size):
+    with open(source, 'rb') as src:
+        FileUpload(src, 'input', 'input.fits').save(dest)
+    return storage.EntityStorage().get_hash(dest, buffer_size=buffer_size)
+
+
+def single_pass(source, dest):
+    with open(source, 'rb') as src:
+        return uws_server.save_upload(FileUpload(src, 'input', 'input.fits'), dest)
+
+
+def measure(func, dest, *args):
+    t0 = time.perf_counter()
+    digest = func(*args)
+    duration = time.perf_counter() - t0
+    os.remove(dest)
+    return duration, digest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', type=float, nargs='+', default=[1, 2, 5, 10], help='sizes of the uploads in GB')
+    parser.add_argument('--dir', default=None, help='directory for the files, a temporary directory by default')
+    args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp(dir=args.dir)
+    source = os.path.join(tmp_dir, 'source')
+    dest = os.path.join(tmp_dir, 'input.fits')
+    print('Directory: {}, SHA{}, HASH_CHUNK_SIZE={}'.format(tmp_dir, storage.SHA_ALGO, storage.HASH_CHUNK_SIZE))
+    print('{:>8s} {:>14s} {:>14s} {:>14s} {:>12s}'.format(
+        'size(GB)', 'two_pass (s)', 'buffer (s)', 'single (s)', 'single MB/s'))
+    try:
+        for size_gb in args.s:
+            size = int(size_gb * GB)
+            make_source(source, size)
+            t_two, h_two = measure(two_pass, dest, source, dest, 65536)
+            t_buf, h_buf = measure(two_pass, dest, source, dest, storage.HASH_CHUNK_SIZE)
+            t_one, h_one = measure(single_pass, dest, source, dest)
+            assert h_two == h_buf == h_one
+            print('{:8.2f} {:14.2f} {:14.2f} {:14.2f} {:12.0f}'.format(
+                size_gb, t_two, t_buf, t_one, size / t_one / 1024**2))
+            os.remove(source)
+    finally:
+        shutil.rmtree(tmp_dir)
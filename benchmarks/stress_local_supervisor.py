@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Stress test of the LocalSupervisor used by LocalManager: hundreds of sleep processes are started and
+followed by the supervisor, then the number of threads, the zombies left and the time needed to reap
+all processes are reported. A few processes are stopped (SIGSTOP) and killed to check the state
+transitions signaled to the server (signals are only counted here, not sent).
+
+Usage:
+    python benchmarks/stress_local_supervisor.py [-n 500] [-d 2]
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import subprocess as sp
+import collections
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from uws_server import managers
+
+
+class Job(object):
+    # The job script signals COMPLETED itself before it ends
+    phase = 'COMPLETED'
+
+
+def count_zombies(pids):
+    zombies = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                if f.read().split(')')[-1].split()[0] == 'Z':
+                    zombies += 1
+        except IOError:
+            pass
+    return zombies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=500, help='number of sleep processes')
+    parser.add_argument('-d', type=float, default=2, help='duration of each sleep process in seconds')
+    args = parser.parse_args()
+    signals = collections.Counter()
+
+    def send_signal(process_id, phase, error_msg=''):
+        signals[phase] += 1
+
+    supervisor = managers.LocalSupervisor(send_signal, poll_interval=managers.LocalManager.poll_interval)
+    threads_before = threading.active_count()
+    t0 = time.perf_counter()
+    popens = []
+    for i in range(args.n):
+        popen = sp.Popen(['sleep', str(args.d)])
+        supervisor.add(popen, Job())
+        popens.append(popen)
+    t_start = time.perf_counter() - t0
+    print('{} processes started in {:.2f}s'.format(args.n, t_start))
+    # Stop some processes (restarted by the supervisor) and kill others (signaled as ERROR)
+    for popen in popens[:10]:
+        os.kill(popen.pid, signal.SIGSTOP)
+    for popen in popens[10:20]:
+        popen.kill()
+    print('threads: {} before, {} while running'.format(threads_before, threading.active_count()))
+    while supervisor.count():
+        time.sleep(0.01)
+    t_end = time.perf_counter() - t0
+    print('all processes reaped after {:.2f}s (sleep {}s, poll interval {}s)'.format(
+        t_end, args.d, supervisor.poll_interval))
+    print('zombies left: {}'.format(count_zombies([popen.pid for popen in popens])))
+    print('return codes: {}'.format(dict(collections.Counter(popen.returncode for popen in popens))))
+    print('signals: {}'.format(dict(signals)))
@@ -1,3 +1,8 @@
-from uws_server.uws_server import run, app
+import os
+from uws_server.uws_server import run, app, start_deadline_scheduler
+
+# With the reloader, only the child process serves the requests (the parent process watches the files)
+if os.environ.get('BOTTLE_CHILD'):
+    start_deadline_scheduler()
 
 run(app, host='localhost', port=8082, debug=False, reloader=True)
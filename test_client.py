@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Unit tests for UWS client (proxy to the UWS server)
+"""
+
+import io
+import threading
+import http.server
+import pytest
+
+pytest.importorskip('flask_security')
+
+from uws_client import uws_client
+
+
+class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """UWS server that records the requests received, and sets a cookie in each response"""
+
+    received = []
+
+    def do_GET(self):
+        self.reply(b'')
+
+    def do_POST(self):
+        self.reply(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def reply(self, body):
+        self.received.append((self.command, dict(self.headers), body))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Set-Cookie', 'session=user_{}; Path=/'.format(len(self.received)))
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    UpstreamHandler.received = []
+    monkeypatch.setitem(uws_client.app.config, 'UWS_SERVER_URL', 'http://127.0.0.1:{}'.format(server.server_port))
+    monkeypatch.setattr(uws_client, '_uws_server_sessions', {})
+    yield UpstreamHandler.received
+    server.shutdown()
+    server.server_close()
+
+
+class TestProxy(object):
+    """Test the proxy of the client to the UWS server"""
+
+    def test_post_stream(self, upstream):
+        client = uws_client.app.test_client()
+        data = {'input': 'test_proxy', 'file': (io.BytesIO(b'file content'), 'input.txt')}
+        response = client.post('/proxy/rest/test_', data=data, content_type='multipart/form-data')
+        print(upstream)
+        assert (response.status_code == 200 and response.data == b'ok')
+        method, headers, body = upstream[0]
+        # Body sent as received: same boundary, file content included
+        assert (method == 'POST' and headers['Content-Type'].startswith('multipart/form-data; boundary='))
+        assert (headers['Content-Type'].split('boundary=')[1].strip('"').encode() in body)
+        assert (b'file content' in body and b'test_proxy' in body)
+
+    def test_post_data(self, upstream):
+        client = uws_client.app.test_client()
+        client.post('/proxy/jdl/test_', data=b'{"name": "test_"}', content_type='application/json')
+        method, headers, body = upstream[0]
+        assert (headers['Content-Type'] == 'application/json' and body == b'{"name": "test_"}')
+
+    def test_no_cookies(self, upstream):
+        # The session to the server is shared by all the users: cookies set by the server are not sent back
+        client = uws_client.app.test_client()
+        client.get('/proxy/rest/test_')
+        client.get('/proxy/rest/test_')
+        print(upstream)
+        assert (len(upstream) == 2)
+        assert ('Cookie' not in upstream[1][1])
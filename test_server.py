@@ -6,8 +6,15 @@
 Unit tests for UWS server
 """
 
+import os
+import time
+import base64
+import signal
+import subprocess
 import pytest
 import webtest
+import sqlalchemy
+from sqlalchemy import event
 
 from uws_server import uws_server
 
@@ -370,3 +377,1019 @@ class TestJobSequence(object):
         assert (response.status_int == 200)
         assert (response.text == '')
         self.assert_job_phase(jobid, 'COMPLETED')
+
+
+class TestUnitOfWork(object):
+    """Test that storage changes are committed once per request, and rolled back on error"""
+
+    def test_single_commit(self):
+        db = uws_server.storage.get_database()
+        commits = []
+
+        def count_commit(conn):
+            commits.append(conn)
+
+        # Known user (a new user is committed before the transfer of the inputs, see test_commit_flushed)
+        test_app.get('/rest/' + jobname)
+        event.listen(db.engine, 'commit', count_commit)
+        try:
+            url = '/rest/' + jobname
+            response = test_app.post(url, {'input': 'test_commit'})
+            print(url + ' --> ' + response.status + ' ({} commit)'.format(len(commits)))
+            assert (response.status_int == 303)
+            assert (len(commits) == 1)
+        finally:
+            event.remove(db.engine, 'commit', count_commit)
+
+    def test_commit_flushed(self):
+        # Changes flushed before a long transfer are committed, so that the write lock is released
+        db = uws_server.storage.get_database()
+        commits = []
+
+        def count_commit(conn):
+            commits.append(conn)
+
+        event.listen(db.engine, 'commit', count_commit)
+        uws_server.storage.begin_request()
+        try:
+            job_storage = getattr(uws_server.storage, uws_server.STORAGE + 'JobStorage')()
+            job_storage.get_users(name='test_commit_flushed')
+            uws_server.storage.commit_flushed()
+            assert (len(commits) == 0)
+            job_storage.add_user('test_commit_flushed', token='test_')
+            uws_server.storage.commit_flushed()
+            assert (len(commits) == 1)
+        finally:
+            uws_server.storage.end_request()
+            event.remove(db.engine, 'commit', count_commit)
+
+    def test_rollback(self, jobid):
+        uws_server.storage.begin_request()
+        job = uws_server.Job(jobname, jobid, uws_server.User('test_', 'test_'))
+        job.set_attribute('run_id', 'test_rollback')
+        uws_server.storage.end_request(commit=False)
+        job = uws_server.Job(jobname, jobid, uws_server.User('test_', 'test_'))
+        assert (job.run_id == 'test_')
+
+
+class TestMaintenance(object):
+    """Test the maintenance of the jobs: status of the active jobs read by chunks, only changed jobs are read"""
+
+    def test_status(self, jobid, monkeypatch):
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True, get_parameters=True)
+        job.phase = 'QUEUED'
+        job.process_id = 1
+        job.storage.save(job)
+        # Job with an unchanged phase
+        other_jobid = create_job()
+        other_job = uws_server.Job(jobname, other_jobid, user, get_attributes=True, get_parameters=True)
+        other_job.phase = 'QUEUED'
+        other_job.process_id = 2
+        other_job.storage.save(other_job)
+        uws_server.storage.commit_session()
+        bulk = []
+        read = []
+
+        def get_status_bulk(self, jobs):
+            bulk.append(jobs)
+            return {jobid: 'EXECUTING', other_jobid: 'QUEUED'}
+
+        class Job(uws_server.Job):
+            def __init__(self, jobname, jobid, *args, **kwargs):
+                read.append(jobid)
+                super().__init__(jobname, jobid, *args, **kwargs)
+
+        manager_class = getattr(uws_server.managers, uws_server.MANAGER + 'Manager')
+        monkeypatch.setattr(manager_class, 'get_status_bulk', get_status_bulk)
+        monkeypatch.setattr('uws_server.uws_server.Job', Job)
+        monkeypatch.setattr('uws_server.uws_server.MAINTENANCE_CHUNK_SIZE', 1)
+        response = test_app.get('/handler/maintenance/' + jobname, extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+        assert (response.status_int == 200)
+        print(response.text)
+        jobs = [j for chunk in bulk for j in chunk]
+        print([(j.jobid, j.phase, j.process_id) for j in jobs])
+        # One job per chunk
+        assert (all(len(chunk) == 1 for chunk in bulk))
+        assert (all(j.phase in ['QUEUED', 'EXECUTING', 'SUSPENDED'] for j in jobs))
+        assert ((jobid, 'QUEUED', 1) in [(j.jobid, j.phase, j.process_id) for j in jobs])
+        assert ('Status has been updated: QUEUED --> EXECUTING' in response.text)
+        assert (jobid in read and other_jobid not in read)
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True)
+        assert (job.phase == 'EXECUTING')
+
+
+class TestJobRead(object):
+    """Test that a job with many results is read with a bounded number of SQL statements"""
+
+    def test_read_statements(self, jobid):
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True, get_parameters=True, get_results=True)
+        for i in range(20):
+            entity = job.storage.register_entity(
+                jobid=jobid, result_name='output', result_value='*.txt', file_name='out_{}.txt'.format(i),
+                file_dir='.', content_type='text/plain', hash='hash_{}_{}'.format(jobid, i), owner='test_',
+            )
+            job.add_result_entry('out_{}'.format(i), entity)
+        job.storage.save(job)
+        db = uws_server.storage.get_database()
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            job = uws_server.Job(jobname, jobid, user, get_attributes=True, get_parameters=True, get_results=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+        print('{} statements to read job {}'.format(len(statements), jobid))
+        assert (len(job.results) == 20)
+        assert (job.results['out_3']['file_name'].endswith('_out_3.txt'))
+        assert (job.parameters)
+        assert (len(statements) <= 2)
+
+
+class TestUserCache(object):
+    """Test that known users are not read from the database on each request, unless their roles change"""
+
+    def count_user_statements(self, url):
+        db = uws_server.storage.get_database()
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            if 'users' in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            response = test_app.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+        print(url + ' --> ' + response.status + ' ({} user statements)'.format(len(statements)))
+        return len(statements)
+
+    def test_cache(self):
+        url = '/rest/' + jobname
+        uws_server.storage.user_cache.invalidate()
+        assert (self.count_user_statements(url) > 0)
+        assert (self.count_user_statements(url) == 0)
+        # Changing roles invalidates the cached user
+        job_storage = getattr(uws_server.storage, uws_server.STORAGE + 'JobStorage')()
+        job_storage.add_role('anonymous', 'anonymous', role='test_cache')
+        assert (uws_server.storage.user_cache.get('anonymous', 'anonymous') is None)
+        assert (self.count_user_statements(url) > 0)
+        assert ('test_cache' in uws_server.storage.user_cache.get('anonymous', 'anonymous'))
+        job_storage.remove_role('anonymous', 'anonymous', role='test_cache')
+        assert (uws_server.storage.user_cache.get('anonymous', 'anonymous') is None)
+
+    def test_app_token(self, monkeypatch):
+        # Roles of an APP_TOKEN are synced even if the user is cached
+        url = '/rest/' + jobname
+        headers = {'Authorization': 'Basic ' + base64.b64encode(b'test_app:test_app_token').decode()}
+        app_tokens = {'test_app_token': {'name': 'test_app', 'active': True, 'jobs': ['test_app_job']}}
+        monkeypatch.setattr('uws_server.uws_server.APP_TOKENS', app_tokens)
+        test_app.get(url, headers=headers)
+        assert ('test_app_job' in uws_server.storage.user_cache.get('test_app', 'test_app_token'))
+        app_tokens['test_app_token']['active'] = False
+        test_app.get(url, headers=headers)
+        assert ('test_app_job' not in uws_server.storage.user_cache.get('test_app', 'test_app_token'))
+        job_storage = getattr(uws_server.storage, uws_server.STORAGE + 'JobStorage')()
+        uws_server.storage.user_cache.invalidate('test_app')
+        assert (not job_storage.has_role('test_app', 'test_app_token', 'test_app_job'))
+
+    def test_lru(self):
+        cache = uws_server.storage.UserCache(ttl=60, size=2)
+        cache.set('a', 'a', ['x'])
+        cache.set('b', 'b', [])
+        cache.get('a', 'a')
+        cache.set('c', 'c', [])
+        assert (cache.get('b', 'b') is None)
+        assert (cache.get('a', 'a') == ['x'])
+        cache = uws_server.storage.UserCache(ttl=-1, size=2)
+        cache.set('a', 'a', ['x'])
+        assert (cache.get('a', 'a') is None)
+
+
+class TestJDLRegistry(object):
+    """Test that a job description file is parsed once, and again if it changes"""
+
+    def test_registry(self):
+        jdl_name = 'test_registry'
+        jdl = uws_server.uws_jdl.VOTFile()
+        jdl.content.update({
+            'name': jdl_name,
+            'annotation': 'test annotation',
+            'executionDuration': '1',
+            'quote': '1',
+            'parameters': {'input': {'datatype': 'xs:string', 'default': 'test_', 'required': 'true'}},
+            'used': {},
+            'generated': {},
+            'script': 'echo test_registry',
+        })
+        jdl.save(jdl_name)
+        fnames = [jdl._get_filename(jdl_name), '{}/{}.sh'.format(jdl.scripts_path, jdl_name)]
+        try:
+            jdl1 = uws_server.uws_jdl.VOTFile()
+            jdl1.read(jdl_name)
+            jdl2 = uws_server.uws_jdl.VOTFile()
+            jdl2.read(jdl_name)
+            assert (jdl1.content['parameters'] is jdl2.content['parameters'])
+            assert (jdl2.content['annotation'] == 'test annotation')
+            # Saving the file updates the description read
+            jdl.content['annotation'] = 'test registry'
+            jdl.save(jdl_name)
+            jdl3 = uws_server.uws_jdl.VOTFile()
+            jdl3.read(jdl_name)
+            print('{}: {}'.format(jdl_name, jdl3.content['annotation']))
+            assert (jdl3.content['annotation'] == 'test registry')
+            assert (jdl3.content['parameters'] is not jdl1.content['parameters'])
+        finally:
+            for fname in fnames:
+                os.remove(fname)
+            uws_server.uws_jdl.jdl_registry.invalidate(jdl_name)
+
+
+class TestLocalSupervisor(object):
+    """Test that local processes are followed by a single thread and reaped when they end"""
+
+    def wait_processes(self, supervisor, timeout=10):
+        t0 = time.time()
+        while supervisor.count() and time.time() - t0 < timeout:
+            time.sleep(0.05)
+        return supervisor.count()
+
+    def test_supervisor(self):
+        signals = []
+
+        def send_signal(process_id, phase, error_msg=''):
+            signals.append((process_id, phase))
+
+        supervisor = uws_server.managers.LocalSupervisor(send_signal, poll_interval=0.1)
+        job = type('Job', (object,), {'phase': 'COMPLETED'})()
+        popens = [subprocess.Popen(['sleep', '0.2']) for i in range(50)]
+        for popen in popens:
+            supervisor.add(popen, job)
+        killed = subprocess.Popen(['sleep', '10'])
+        supervisor.add(killed, job)
+        stopped = subprocess.Popen(['sleep', '0.5'])
+        supervisor.add(stopped, job)
+        os.kill(stopped.pid, signal.SIGSTOP)
+        killed.kill()
+        assert (self.wait_processes(supervisor) == 0)
+        print('{} processes reaped, signals: {}'.format(len(popens) + 2, signals))
+        assert (all(popen.returncode == 0 for popen in popens))
+        assert (stopped.returncode == 0)
+        assert (signals == [(killed.pid, 'ERROR')])
+
+
+class TestLocalStaging(object):
+    """Test the staging strategies of the input files of local jobs"""
+
+    def test_staging(self, tmp_path):
+        manager = uws_server.managers.LocalManager()
+        src = str(tmp_path / 'input.fits')
+        with open(src, 'wb') as f:
+            f.write(b'input')
+        for staging in manager.staging_strategies:
+            dst = str(tmp_path / staging)
+            command = manager._stage_file(src, dst, staging=staging)
+            print(command)
+            subprocess.run(['bash', '-c', command], check=True)
+            assert (open(dst, 'rb').read() == b'input')
+            assert (os.path.islink(dst) == (staging == 'symlink'))
+            assert (os.path.samefile(src, dst) == (staging in ['hardlink', 'symlink']))
+        assert (manager.detect_staging(str(tmp_path), str(tmp_path)) in ['copy', 'reflink'])
+        # The probe files are removed
+        assert (sorted(os.listdir(str(tmp_path))) == sorted(['input.fits'] + manager.staging_strategies))
+        with pytest.raises(UserWarning):
+            uws_server.managers.LocalManager(staging='bind')
+
+
+class TestLocalScheduler(object):
+    """Test the admission of local jobs: global, user and jobname slots, CPUs, and priority"""
+
+    def test_admission(self, tmp_path):
+        scheduler = uws_server.managers.LocalScheduler(max_jobs=3, max_jobs_per_user=2, cpus=4, memory=0)
+
+        def submit(jobid, owner='a', cpus=1, priority=0, admission_fifo=None):
+            job = type('Job', (object,), {
+                'jobid': jobid, 'owner': owner, 'jobname': 'test_',
+                'jdl': type('JDL', (object,), {'content': {'cpus': cpus, 'priority': priority}})()})()
+            return scheduler.submit(scheduler.request(job, str(tmp_path / jobid), admission_fifo=admission_fifo))
+
+        assert (submit('a1') and submit('a2'))
+        # Slot of user a: b1 passes
+        # The script of a3 waits on its named pipe
+        fifo = str(tmp_path / 'a3_admission')
+        os.mkfifo(fifo)
+        fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+        assert (not submit('a3', admission_fifo=fifo))
+        assert (submit('b1', owner='b'))
+        assert (os.path.exists(str(tmp_path / 'b1')) and not os.path.exists(str(tmp_path / 'a3')))
+        # No global slot
+        assert (not submit('b2', owner='b'))
+        assert (not submit('c1', owner='c', priority=1))
+        scheduler.release('b1')
+        # c1 first (priority), then a3 would need a slot of user a
+        assert ('c1' in scheduler.running and 'a3' in scheduler.waiting)
+        # Aborted while waiting
+        scheduler.release('b2')
+        assert (scheduler.count() == (3, 1))
+        # 4 CPUs: a large job waits for the CPUs, and blocks the jobs after it
+        scheduler.release('c1')
+        scheduler.release('a1')
+        assert (set(scheduler.running) == {'a2', 'a3'})
+        # a3 woken up
+        assert (os.read(fd, 100) == b'admitted\n')
+        os.close(fd)
+        assert (not submit('d1', owner='d', cpus=8))
+        assert (scheduler.waiting['d1']['cpus'] == 4)
+        assert (not submit('e1', owner='e'))
+        scheduler.release('a2')
+        scheduler.release('a3')
+        assert (list(scheduler.running) == ['d1'])
+        scheduler.release('d1')
+        assert (list(scheduler.running) == ['e1'])
+        # Bad PARAMs in the JDL
+        for content in [{'cpus': 'two'}, {'memory': 'lots'}, {'priority': 'high'}]:
+            job = type('Job', (object,), {
+                'jobid': 'bad', 'owner': 'a', 'jobname': 'test_',
+                'jdl': type('JDL', (object,), {'content': content})()})()
+            with pytest.raises(UserWarning, match='PARAM {}'.format(list(content)[0])):
+                scheduler.request(job, str(tmp_path / 'bad'))
+        assert (uws_server.managers.parse_memory('2gb') == 2048)
+        assert (uws_server.managers.parse_memory('500M') == 500)
+
+
+class TestJobCgroup(object):
+    """Test the limits and accounting of a local job in its cgroup (cgroup v2 files emulated in a directory)"""
+
+    def test_cgroup(self, tmp_path, jobid):
+        uws_server.managers.JobCgroup.setup(root=str(tmp_path), cpu_weight=50)
+        # The server process runs in a leaf, the jobs in a sibling with a lower cpu.weight
+        assert (open(str(tmp_path / 'server' / 'cgroup.procs')).read() == str(os.getpid()))
+        assert (open(str(tmp_path / 'jobs' / 'cpu.weight')).read() == '50')
+        cgroup = uws_server.managers.JobCgroup(jobid, root=str(tmp_path))
+        cgroup.create(cpus=1.5, memory=512)
+        assert (cgroup.path == str(tmp_path / 'jobs' / 'job_{}'.format(jobid)))
+        assert (open(os.path.join(cgroup.path, 'cpu.max')).read() == '150000 100000')
+        assert (open(os.path.join(cgroup.path, 'memory.max')).read() == str(512 * 1024**2))
+        files = {
+            'cpu.stat': 'usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n',
+            'memory.peak': '104857600\n',
+            'io.stat': '8:0 rbytes=1000 wbytes=2000 rios=1 wios=2 dbytes=0 dios=0\n'
+                       '8:16 rbytes=10 wbytes=20 rios=1 wios=2 dbytes=0 dios=0\n',
+            'memory.events': 'low 0\nhigh 0\nmax 0\noom 0\noom_kill 0\n',
+        }
+        for name, content in files.items():
+            with open(os.path.join(cgroup.path, name), 'w') as f:
+                f.write(content)
+        # Processes of the job, killed without cgroup.kill (Linux < 5.14)
+        process = subprocess.Popen(['sleep', '10'])
+        with open(os.path.join(cgroup.path, 'cgroup.procs'), 'w') as f:
+            f.write('{}\n'.format(process.pid))
+        cgroup.kill()
+        assert (process.wait(5) == -signal.SIGKILL)
+        stats = cgroup.stats()
+        print(stats)
+        assert (stats == {'cpu_time': 2.5, 'memory_peak': 104857600, 'io_read_bytes': 1010, 'io_write_bytes': 2020,
+                          'oom_kill': 0})
+        # Resources used shown in jobInfo
+        jd = os.path.join(uws_server.JOBDATA_PATH, jobid)
+        os.makedirs(jd, exist_ok=True)
+        with open(os.path.join(jd, 'resources.yml'), 'w') as f:
+            uws_server.yaml.safe_dump(stats, f)
+        job = uws_server.Job(jobname, jobid, uws_server.User('test_', 'test_'), get_attributes=True)
+        xml = job.to_xml().decode()
+        assert ('<cpu_time>2.5</cpu_time>' in xml and '<oom_kill>0</oom_kill>' in xml)
+
+    def test_join_fails(self, tmp_path, jobid):
+        # The batch script cannot be moved to the cgroup of the job (e.g. EPERM): the job fails instead of running
+        # without limits
+        cgroup = uws_server.managers.JobCgroup(jobid, root=str(tmp_path))
+        cgroup.create(cpus=1)
+        os.mkdir(os.path.join(cgroup.path, 'cgroup.procs'))
+        manager = uws_server.managers.LocalManager()
+        manager.scripts_path = str(tmp_path)
+        with open(str(tmp_path / '{}.sh'.format(jobname)), 'w') as f:
+            f.write('echo "job executed"\n')
+        job = uws_server.Job(jobname, jobid, uws_server.User('test_', 'test_'))
+        jd = os.path.join(manager.jobdata_path, jobid)
+        os.makedirs(jd, exist_ok=True)
+        batch = manager._make_batch(job, get_input_files=[cgroup.join_command(), 'echo "staging"'])
+        result = subprocess.run(['bash', '-c', '\n'.join(batch)], stdout=subprocess.PIPE, universal_newlines=True,
+                                cwd=str(tmp_path))
+        print(result.stdout)
+        assert (result.returncode == 1)
+        assert ('Cannot move the job to its cgroup' in result.stdout and 'staging' not in result.stdout)
+        assert (os.path.exists(os.path.join(jd, 'job_error')) and not os.path.exists(os.path.join(jd, 'job_start')))
+
+
+class TestJobEventChannel(object):
+    """Test that job events written by local jobs to the named pipe change the job phase, without HTTP request"""
+
+    def test_channel(self, jobid):
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user)
+        process_id = int(time.time() * 1000) % 1000000000
+        job.set_attribute('process_id', process_id)
+        job.set_attribute('phase', 'QUEUED')
+        lines = uws_server.managers.LocalManager()._job_event_function()
+        script = '\n'.join(['JOBID={}'.format(process_id)] + lines + ['job_event EXECUTING'])
+        subprocess.check_call(['bash', '-c', script])
+        t0 = time.time()
+        while job.phase != 'EXECUTING' and time.time() - t0 < 5:
+            time.sleep(0.05)
+            job = uws_server.Job(jobname, jobid, user)
+        print('{} --> {}'.format(jobid, job.phase))
+        assert (job.phase == 'EXECUTING')
+
+
+class TestSLURMManager(object):
+    """Test SLURMManager offline with the fake ssh/scp/sbatch/sacct/scancel of test_jobs/slurm_shims"""
+
+    def test_slurm(self, jobid, tmp_path, monkeypatch):
+        shims = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_jobs', 'slurm_shims')
+        monkeypatch.setenv('PATH', shims + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('FAKE_SLURM_DIR', str(tmp_path / 'slurm'))
+        monkeypatch.setitem(uws_server.uws_jdl.test_job, 'generated', {'output': {'default': 'output.txt', 'content_type': 'text/plain'}})
+        manager = uws_server.managers.SLURMManager()
+        manager.jobdata_path = str(tmp_path / 'jobdata')
+        manager.workdir_path = str(tmp_path / 'workdir')
+        manager.results_path = str(tmp_path / 'results')
+        job = uws_server.Job(jobname, jobid, uws_server.User('test_', 'test_'),
+                             get_attributes=True, get_parameters=True)
+        job.process_id = manager.start(job)
+        assert (os.path.isfile('{}/{}/sbatch.sh'.format(manager.jobdata_path, jobid)))
+        assert (manager.get_status(job) == 'QUEUED')
+        with open(str(tmp_path / 'slurm' / '{}.state'.format(job.process_id)), 'w') as f:
+            f.write('RUNNING\n')
+        assert (manager.get_status(job) == 'EXECUTING')
+        job.phase = 'EXECUTING'
+        manager.delete(job)
+        assert (not os.path.isdir('{}/{}'.format(manager.jobdata_path, jobid)))
+        assert (manager.get_status(job) == 'ABORTED')
+        # scancel fails for unknown jobs, delete continues
+        job.process_id = '1'
+        manager.delete(job)
+        metrics = manager.get_metrics()
+        print(metrics)
+        assert (metrics['start']['count'] == 1)
+        assert (metrics['delete']['count'] == 2)
+
+    def test_slurm_status_bulk(self, tmp_path, monkeypatch):
+        shims = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_jobs', 'slurm_shims')
+        monkeypatch.setenv('PATH', shims + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('FAKE_SLURM_DIR', str(tmp_path))
+        states = {'1001': 'RUNNING', '1002': 'CANCELLED by 1834', '1003': 'PENDING'}
+        for process_id, state in states.items():
+            with open(str(tmp_path / '{}.state'.format(process_id)), 'w') as f:
+                f.write(state + '\n')
+        jobs = [type('Job', (object,), {'jobid': 'job_' + p, 'process_id': p})() for p in ['1001', '1002', '1003', '1004']]
+        manager = uws_server.managers.SLURMManager()
+        count = manager.get_metrics().get('get_status_bulk', {}).get('count', 0)
+        phases = manager.get_status_bulk(jobs)
+        print(phases)
+        assert (phases == {'job_1001': 'EXECUTING', 'job_1002': 'ABORTED', 'job_1003': 'QUEUED'})
+        assert (manager.get_metrics()['get_status_bulk']['count'] == count + 1)
+
+    def test_slurm_log(self, tmp_path, monkeypatch):
+        shims = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_jobs', 'slurm_shims')
+        monkeypatch.setenv('PATH', shims + os.pathsep + os.environ['PATH'])
+        manager = uws_server.managers.SLURMManager()
+        manager.jobdata_path = str(tmp_path)
+        job = type('Job', (object,), {'jobid': 'job_1001', 'process_id': '1001'})()
+        os.makedirs(str(tmp_path / 'job_1001'))
+        with open(str(tmp_path / 'job_1001' / 'stdout.log'), 'w') as f:
+            f.write('line 1\nline 2\nline 3\n')
+        assert (b''.join(manager.get_log(job, 'stdout')) == b'line 1\nline 2\nline 3\n')
+        assert (b''.join(manager.get_log(job, 'stdout', offset=7)) == b'line 2\nline 3\n')
+        assert (b''.join(manager.get_log(job, 'stdout', tail=1)) == b'line 3\n')
+        with pytest.raises(subprocess.CalledProcessError):
+            manager.get_log(job, 'stderr')
+
+
+class TestIndexes(object):
+    """Test that the indexes are created in a database created by a previous version"""
+
+    def test_migration(self, tmp_path):
+        db_string = 'sqlite:///{}'.format(tmp_path / 'job_database_old.db')
+        db = uws_server.storage.SQLAlchemyDatabase(db_string)
+        with db.engine.begin() as conn:
+            for table in db.Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.exec_driver_sql('DROP INDEX {}'.format(index.name))
+        db.engine.dispose()
+        db = uws_server.storage.SQLAlchemyDatabase(db_string)
+        inspector = sqlalchemy.inspect(db.engine)
+        indexes = [ix['name'] for ix in inspector.get_indexes('jobs')]
+        print(indexes)
+        assert ('ix_jobs_process_id' in indexes)
+        assert ('ix_entities_hash' in [ix['name'] for ix in inspector.get_indexes('entities')])
+        with db.engine.connect() as conn:
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN SELECT * FROM jobs WHERE process_id = 1').fetchall()
+        print(plan)
+        assert ('ix_jobs_process_id' in str(plan))
+        db.engine.dispose()
+
+
+class TestJobList(object):
+    """Test the streamed job list and the keyset pagination (CURSOR)"""
+
+    def get_jobids(self, url):
+        response = test_app.get(url)
+        jobids = [ref.split('"')[0] for ref in response.text.split('<uws:jobref id="')[1:]]
+        next_url = response.headers.get('Link', '')[1:].split('>')[0].replace(uws_server.BASE_URL, '')
+        return jobids, next_url
+
+    def test_pages(self):
+        jobids = [create_job() for i in range(5)]
+        user = uws_server.User('test_', 'test_')
+        all_jobids = [j['jobid'] for j in uws_server.JobList(jobname, user).jobs]
+        # Jobs created in the same second are ordered by jobid
+        assert (set(jobids) <= set(all_jobids))
+        # Pages of 2 jobs, the most recent first, the cursor is given by the previous page
+        paged_jobids = []
+        cursor = ''
+        while cursor is not None:
+            joblist = uws_server.JobList(jobname, user, last=2, cursor=cursor)
+            assert (len(joblist.jobs) <= 2)
+            paged_jobids.extend(j['jobid'] for j in joblist.jobs)
+            cursor = joblist.next_cursor
+        assert (paged_jobids == all_jobids[::-1])
+        # Follow the Link headers of the HTTP responses
+        url = '/rest/' + jobname
+        all_jobids, next_url = self.get_jobids(url)
+        assert (not next_url)
+        paged_jobids = []
+        url += '?LAST=1&CURSOR='
+        while url:
+            page, url = self.get_jobids(url)
+            print(url)
+            assert (len(page) <= 1)
+            paged_jobids.extend(page)
+        assert (paged_jobids == all_jobids[::-1])
+        test_app.get('/rest/' + jobname + '?CURSOR=bad', status=400)
+
+    def test_last_after(self):
+        jobids = [create_job() for i in range(3)]
+        user = uws_server.User('test_', 'test_')
+        all_jobs = uws_server.JobList(jobname, user).jobs
+        # LAST: the most recent jobs, most recent first
+        last_jobs = uws_server.JobList(jobname, user, last=3).jobs
+        assert (last_jobs == all_jobs[::-1][:3])
+        assert (last_jobs[0]['creation_time'] >= max(j['creation_time'] for j in all_jobs if j['jobid'] in jobids))
+        # AFTER: jobs created strictly after the given time
+        creation_time = uws_server.dt.datetime.strptime(all_jobs[0]['creation_time'], uws_server.DT_FMT)
+        after_jobs = uws_server.JobList(jobname, user, after=creation_time).jobs
+        assert (after_jobs == [j for j in all_jobs if j['creation_time'] > all_jobs[0]['creation_time']])
+        url = '/rest/{}?AFTER={}&LAST=2'.format(jobname, creation_time.isoformat())
+        assert (test_app.get(url).status_int == 200)
+        test_app.get('/rest/' + jobname + '?AFTER=yesterday', status=400)
+        test_app.get('/rest/' + jobname + '?LAST=-1', status=400)
+
+    def test_chunks(self):
+        jobids = [create_job() for i in range(3)]
+        user = uws_server.User('test_', 'test_')
+        joblist = uws_server.JobList(jobname, user)
+        chunked = list(joblist.storage.iter_list(joblist, chunk_size=2, **joblist.list_kwargs))
+        assert ([j['jobid'] for j in chunked] == [j['jobid'] for j in joblist.jobs])
+        assert (set(jobids) <= set(j['jobid'] for j in chunked))
+
+
+class TestWaitBroker(object):
+    """Test the WaitBroker used for the UWS WAIT blocking behaviour"""
+
+    def setup_method(self):
+        self.brokers = []
+
+    def teardown_method(self):
+        # Brokers receive the job_status signal until closed
+        for broker in self.brokers:
+            broker.close()
+
+    def new_broker(self, **kwargs):
+        broker = uws_server.WaitBroker(**kwargs)
+        self.brokers.append(broker)
+        return broker
+
+    def test_signal(self, jobid):
+        broker = self.new_broker(max_waiters=1, poll_interval=60)
+        result = {}
+        thread = uws_server.threading.Thread(target=lambda: result.update(changed=broker.wait(jobid, 'PENDING', 10)))
+        thread.start()
+        while not broker.count():
+            time.sleep(0.01)
+        # Too many waiters: returns at once
+        assert (broker.wait(jobid, 'PENDING', 10) is None)
+        # Same phase: still waiting
+        uws_server.send_status_signal(jobid, 'PENDING')
+        time.sleep(0.1)
+        assert (thread.is_alive())
+        uws_server.send_status_signal(jobid, 'QUEUED')
+        thread.join(5)
+        assert (result['changed'] is True)
+        assert (broker.count() == 0)
+
+    def test_poll(self, jobid):
+        # Phase changed by another process: seen in storage
+        broker = self.new_broker(poll_interval=0.1)
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True)
+        job.phase = 'QUEUED'
+        job.storage.save(job, save_parameters=False, save_results=False)
+        uws_server.storage.commit_session()
+        t0 = time.time()
+        assert (broker.wait(jobid, 'PENDING', 10) is True)
+        print(time.time() - t0)
+        assert (broker.wait(jobid, 'QUEUED', 0.3) is False)
+
+
+class TestDeadlineScheduler(object):
+    """Test the abort of the jobs that overrun their execution duration"""
+
+    def test_heap(self):
+        expired = []
+        scheduler = uws_server.DeadlineScheduler(lambda jobid, jobname: expired.append(jobid), margin=0)
+        scheduler.stop()
+        now = time.time()
+        scheduler.set_deadline('deadline_3', jobname, now + 0.6)
+        scheduler.set_deadline('deadline_1', jobname, now + 0.2)
+        scheduler.set_deadline('deadline_2', jobname, now + 0.4)
+        # Job ended, deadline extended, no deadline
+        scheduler._receive('change_status', sig_jobid='deadline_2', sig_phase='COMPLETED')
+        scheduler.set_deadline('deadline_1', jobname, now + 0.8)
+        scheduler.set_deadline('deadline_3', jobname, None)
+        assert (scheduler.count() == 1)
+        assert (scheduler.pop_expired(now + 0.7) == [])
+        assert (scheduler.pop_expired(now + 0.9) == [('deadline_1', jobname)])
+        assert (scheduler.count() == 0 and not scheduler.heap)
+
+    def test_abort(self, jobid):
+        # Job EXECUTING before the scheduler starts (e.g. restart of the server): deadline read from storage
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True, get_parameters=True)
+        job.phase = 'EXECUTING'
+        job.execution_duration = 1
+        job.start_time = uws_server.dt.datetime.now().strftime(uws_server.DT_FMT)
+        job.storage.save(job)
+        uws_server.storage.commit_session()
+        assert (job.storage.get_deadlines([jobid, 'unknown']) == {jobid: (jobname, job.start_time, 1)})
+        expired = []
+
+        def on_expire(expired_jobid, expired_jobname):
+            # Other EXECUTING jobs of the test database are ignored
+            if expired_jobid == jobid:
+                uws_server.abort_overrun_job(expired_jobid, expired_jobname)
+                expired.append(time.time())
+
+        scheduler = uws_server.DeadlineScheduler(on_expire, margin=0)
+        t0 = time.time()
+        scheduler.start()
+        try:
+            while not expired and time.time() - t0 < 5:
+                time.sleep(0.05)
+        finally:
+            scheduler.stop()
+        assert (not scheduler.thread.is_alive())
+        print(expired[0] - t0)
+        assert (expired[0] - t0 < 2)
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True)
+        print(job.error)
+        assert (job.phase == 'ERROR' and 'Execution duration exceeded (1s)' in job.error)
+        assert (jobid not in job.storage.get_deadlines([jobid]))
+
+    def test_abort_fails(self, jobid, monkeypatch):
+        # The phase is claimed before the abort: the error is recorded even if the abort fails
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True, get_parameters=True)
+        job.phase = 'EXECUTING'
+        job.execution_duration = 1
+        job.storage.save(job)
+        uws_server.storage.commit_session()
+
+        def abort(self, job):
+            raise RuntimeError('scancel failed')
+
+        manager_class = getattr(uws_server.managers, uws_server.MANAGER + 'Manager')
+        monkeypatch.setattr(manager_class, 'abort', abort)
+        uws_server.abort_overrun_job(jobid, jobname)
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True)
+        print(job.error)
+        assert (job.phase == 'ERROR')
+        assert ('Execution duration exceeded (1s), abort failed: scancel failed' in job.error)
+
+    def test_claim(self, jobid):
+        # Deadline seen by several server processes: a single one aborts the job
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True, get_parameters=True)
+        job.phase = 'EXECUTING'
+        job.storage.save(job)
+        uws_server.storage.commit_session()
+        assert (job.storage.claim_phase(jobid, 'EXECUTING', 'ERROR'))
+        assert (not job.storage.claim_phase(jobid, 'EXECUTING', 'ERROR'))
+        assert (job.storage.get_phases([jobid]) == {jobid: 'ERROR'})
+
+
+class TestNotificationBus(object):
+    """Test that job status changes are sent to the other server processes with the Socket notification bus"""
+
+    def test_socket(self, tmp_path):
+        received = []
+
+        def receiver(sender, **kw):
+            received.append((kw.get('sig_jobid'), kw.get('sig_phase')))
+
+        uws_server.signal('job_status').connect(receiver)
+        bus = uws_server.notifications.SocketNotificationBus(str(tmp_path))
+        other_bus = uws_server.notifications.SocketNotificationBus(str(tmp_path))
+        # Socket left by a process that ended
+        open(str(tmp_path / 'ended.sock'), 'w').close()
+        try:
+            # Another server process publishes a status change
+            code = (
+                'from uws_server import notifications\n'
+                'bus = notifications.SocketNotificationBus("{}")\n'
+                'bus.publish("job_other", "COMPLETED")\n'
+                'bus.close()\n'
+            ).format(tmp_path)
+            subprocess.run([uws_server.sys.executable, '-c', code], check=True, cwd=os.path.dirname(__file__) or '.')
+            # This process publishes: dispatched once here, and sent to other_bus
+            bus.publish('job_self', 'QUEUED')
+            t0 = time.time()
+            while len(received) < 4 and time.time() - t0 < 5:
+                time.sleep(0.01)
+            print(received)
+            assert (received.count(('job_other', 'COMPLETED')) == 2)
+            assert (received.count(('job_self', 'QUEUED')) == 2)
+            assert (not os.path.exists(str(tmp_path / 'ended.sock')))
+        finally:
+            uws_server.signal('job_status').disconnect(receiver)
+            bus.close()
+            other_bus.close()
+        assert (os.listdir(str(tmp_path)) == [])
+
+
+class TestJobEvents(object):
+    """Test the Server-Sent Events stream of a job"""
+
+    def set_phase(self, jobid, phase):
+        user = uws_server.User('test_', 'test_')
+        job = uws_server.Job(jobname, jobid, user, get_attributes=True)
+        job.phase = phase
+        job.storage.save(job, save_parameters=False, save_results=False)
+        uws_server.storage.commit_session()
+
+    def write_log(self, jobid, logname, text):
+        logroot = os.path.join(uws_server.JOBDATA_PATH, jobid)
+        os.makedirs(logroot, exist_ok=True)
+        with open(os.path.join(logroot, logname + '.log'), 'a') as f:
+            f.write(text)
+
+    def test_completed(self, jobid):
+        self.write_log(jobid, 'stdout', 'line 1\nline 2\nno newline')
+        self.set_phase(jobid, 'COMPLETED')
+        url = '/rest/{}/{}/events'.format(jobname, jobid)
+        response = test_app.get(url)
+        print(response.text)
+        assert (response.headers['content-type'] == 'text/event-stream; charset=UTF-8')
+        assert ('event: phase\ndata: {"phase": "COMPLETED"}' in response.text)
+        assert ('id: 24:0\nevent: stdout\ndata: {"offset": 0, "text": "line 1\\nline 2\\nno newline"}' in response.text)
+        assert (response.text.endswith('event: end\ndata: {"phase": "COMPLETED"}\n\n'))
+        # Reconnection: only the new lines are sent
+        response = test_app.get(url, headers={'Last-Event-ID': '14:0'})
+        assert ('data: {"offset": 14, "text": "no newline"}' in response.text)
+
+    def test_executing(self, jobid, monkeypatch):
+        monkeypatch.setattr(uws_server, 'EVENTS_LOG_INTERVAL', 0.05)
+        self.set_phase(jobid, 'EXECUTING')
+        self.write_log(jobid, 'stderr', 'started\npartial')
+
+        def run_job():
+            time.sleep(0.2)
+            self.write_log(jobid, 'stderr', ' line\n')
+            time.sleep(0.2)
+            self.set_phase(jobid, 'COMPLETED')
+            uws_server.send_status_signal(jobid, 'COMPLETED')
+
+        thread = uws_server.threading.Thread(target=run_job)
+        thread.start()
+        response = test_app.get('/rest/{}/{}/events?timeout=10'.format(jobname, jobid))
+        thread.join()
+        print(response.text)
+        events = [line[7:] for line in response.text.split('\n') if line.startswith('event: ')]
+        assert (events == ['phase', 'stderr', 'stderr', 'phase', 'end'])
+        assert ('data: {"offset": 0, "text": "started\\n"}' in response.text)
+        assert ('data: {"offset": 8, "text": "partial line\\n"}' in response.text)
+
+
+    def test_max_streams(self, jobid, monkeypatch):
+        self.set_phase(jobid, 'COMPLETED')
+        url = '/rest/{}/{}/events'.format(jobname, jobid)
+        streams = uws_server.EventStreams(max_streams=1)
+        monkeypatch.setattr(uws_server, 'event_streams', streams)
+        # A stream is released when it ends
+        test_app.get(url)
+        assert (streams.count() == 0)
+        # Too many streams: 503
+        assert (streams.open())
+        response = test_app.get(url, status=503)
+        print(response.status)
+        list(streams.stream([]))
+        test_app.get(url, status=200)
+
+
+class TestLogs(object):
+    """Test the incremental access to the logs of a job"""
+
+    def test_local(self, jobid):
+        logroot = os.path.join(uws_server.JOBDATA_PATH, jobid)
+        os.makedirs(logroot, exist_ok=True)
+        with open(os.path.join(logroot, 'stdout.log'), 'w') as f:
+            f.write('line 1\nline 2\nline 3\n')
+        url = '/rest/{}/{}/stdout'.format(jobname, jobid)
+        response = test_app.get(url)
+        assert (response.body == b'line 1\nline 2\nline 3\n')
+        assert (response.headers['X-Log-Size'] == '21')
+        etag = response.headers['ETag']
+        # Not modified
+        test_app.get(url, headers={'If-None-Match': etag}, status=304)
+        # Offset, tail and Range
+        assert (test_app.get(url + '?offset=14').body == b'line 3\n')
+        assert (test_app.get(url + '?offset=100').body == b'')
+        assert (test_app.get(url + '?tail=2').body == b'line 2\nline 3\n')
+        assert (test_app.get(url + '?tail=0').body == b'')
+        assert (test_app.get(url + '?tail=10').body == b'line 1\nline 2\nline 3\n')
+        response = test_app.get(url, headers={'Range': 'bytes=7-12'}, status=206)
+        assert (response.body == b'line 2')
+        assert (response.headers['Content-Range'] == 'bytes 7-12/21')
+        test_app.get(url, headers={'Range': 'bytes=100-'}, status=416)
+        test_app.get(url + '?offset=-1', status=400)
+        # New lines: new ETag
+        with open(os.path.join(logroot, 'stdout.log'), 'a') as f:
+            f.write('line 4')
+        response = test_app.get(url + '?offset=21', headers={'If-None-Match': etag})
+        assert (response.body == b'line 4')
+        assert (test_app.get(url + '?tail=1').body == b'line 4')
+        # No log for a PENDING job
+        test_app.get('/rest/{}/{}/stderr'.format(jobname, jobid), status=404)
+
+
+class TestHTTPClient(object):
+    """Test that the outbound requests of the server share kept-alive connections, with a timeout"""
+
+    def test_keep_alive(self):
+        import http.server
+        import threading
+        ports = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                ports.append(self.client_address[1])
+                if self.path == '/slow':
+                    time.sleep(1)
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'OK')
+
+            def log_message(self, *args):
+                pass
+
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+        try:
+            client = uws_server.http_client.get_http_client()
+            assert (client is uws_server.http_client.get_http_client())
+            for i in range(5):
+                assert (client.get(url + '/').content == b'OK')
+            print(ports)
+            # A single connection was opened
+            assert (len(set(ports)) == 1)
+            with pytest.raises(uws_server.http_client.requests.exceptions.ReadTimeout):
+                uws_server.http_client.HTTPClient(read_timeout=0.2).get(url + '/slow')
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+class TestInputDownload(object):
+    """Test that an input given as a URL is downloaded by chunks with its hash, and bounded in size"""
+
+    def test_download(self, tmp_path):
+        import http.server
+        import threading
+        import hashlib
+        content = os.urandom(300000)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Disposition', 'attachment; filename="input.fits"')
+                if self.path != '/chunked':
+                    self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+        client = uws_server.http_client.get_http_client()
+        try:
+            path = str(tmp_path / 'input.fits')
+            with client.get(url + '/input.fits', stream=True) as r:
+                filename = uws_server.get_filename_from_cd(r.headers.get('content-disposition'))
+                file_hash = uws_server.download_response(r, path, chunk_size=65536)
+            print(filename, file_hash)
+            assert (filename == 'input.fits')
+            assert (file_hash == getattr(hashlib, 'sha' + uws_server.SHA_ALGO)(content).hexdigest())
+            assert (open(path, 'rb').read() == content)
+            # Too large, from Content-Length or while downloading
+            for uri in ['/input.fits', '/chunked']:
+                with client.get(url + uri, stream=True) as r:
+                    with pytest.raises(UserWarning):
+                        uws_server.download_response(r, str(tmp_path / 'large.fits'), max_size=100000)
+            assert (sorted(os.listdir(str(tmp_path))) == ['input.fits'])
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+class TestUploadHash(object):
+    """Test that the hash of an uploaded file is computed while it is saved"""
+
+    def test_save_upload(self, tmp_path):
+        import io
+        from bottle import FileUpload
+        content = os.urandom(3000000)
+        path = str(tmp_path / 'input.fits')
+        upload = FileUpload(io.BytesIO(content), 'input', 'input.fits')
+        file_hash = uws_server.save_upload(upload, path, chunk_size=65536)
+        print(file_hash)
+        assert (open(path, 'rb').read() == content)
+        assert (file_hash == uws_server.storage.EntityStorage().get_hash(path))
+        assert (file_hash == uws_server.storage.EntityStorage().get_hash(path, buffer_size=1000))
+        # Existing files are not overwritten
+        with pytest.raises(IOError):
+            uws_server.save_upload(upload, path)
+
+
+class TestEntityStore(object):
+    """Test that the files of the entities are stored once per hash, and removed when not linked anymore"""
+
+    def test_store(self, tmp_path, monkeypatch):
+        store = uws_server.entity_store.EntityStore(str(tmp_path / 'entities'))
+        monkeypatch.setattr(uws_server.entity_store, '_entity_store', store)
+        monkeypatch.setattr('uws_server.storage.USE_ENTITY_STORE', True)
+        monkeypatch.setattr('uws_server.uws_classes.USE_ENTITY_STORE', True)
+        user = uws_server.User('test_', 'test_')
+        content = os.urandom(10000)
+        jobids = [create_job(), create_job()]
+        paths = []
+        for jid in jobids:
+            upload_dir = os.path.join(uws_server.UPLOADS_PATH, jid)
+            os.makedirs(upload_dir)
+            paths.append(os.path.join(upload_dir, 'calib.fits'))
+            with open(paths[-1], 'wb') as f:
+                f.write(content)
+            entity = uws_server.Job(jobname, jid, user).storage.register_entity(
+                file_name='calib.fits', file_dir=upload_dir, used_jobid=jid, used_role='input', owner=user.name)
+        file_hash = entity['hash']
+        print(file_hash, jobids)
+        # Stored once
+        assert (os.path.samestat(os.stat(paths[0]), os.stat(paths[1])))
+        assert (os.path.samefile(paths[0], store.blob_path(file_hash)))
+        assert (store.refcount(file_hash) == 2)
+        assert (file_hash in uws_server.Job(jobname, jobids[0], user).storage.get_job_hashes(jobids[0]))
+        # The blob is removed with the last job that uses it
+        uws_server.Job(jobname, jobids[0], user).delete()
+        assert (store.refcount(file_hash) == 1)
+        assert (open(paths[1], 'rb').read() == content)
+        uws_server.Job(jobname, jobids[1], user).delete()
+        assert (not os.path.exists(store.blob_path(file_hash)))
+        # Blobs not linked anymore
+        path = str(tmp_path / 'result.txt')
+        with open(path, 'w') as f:
+            f.write('result')
+        blob = store.add(path)
+        os.remove(path)
+        assert (os.path.exists(blob))
+        assert (store.collect() == 1)
+        assert (not os.path.exists(blob))
+        # Same hash and size, different content (e.g. SHA-1 collision): the file is not replaced
+        path = str(tmp_path / 'other.txt')
+        with open(path, 'w') as f:
+            f.write('other')
+        blob = store.add(path, hash='0' * 40)
+        path = str(tmp_path / 'forged.txt')
+        with open(path, 'w') as f:
+            f.write('forge')
+        assert (store.add(path, hash='0' * 40) is None)
+        assert (open(path).read() == 'forge' and open(blob).read() == 'other')
@@ -48,6 +48,12 @@ UWS_AUTH = 'Basic'
 CLIENT_TITLE = "OPUS"
 HOME_CONTENT = ""
 
+# Proxy to the UWS server (request and response bodies are streamed by chunks)
+PROXY_CHUNK_SIZE = 65536  # in bytes
+PROXY_POOL_SIZE = 10  # connections kept alive to each UWS server
+PROXY_CONNECT_TIMEOUT = 10  # in seconds
+PROXY_READ_TIMEOUT = 660  # in seconds, maximum time between two bytes received (> WAIT_TIME_MAX of the server)
+
 # Editable configuration keywords (can be modified from the preference web page)
 EDITABLE_CONFIG = [
     'UWS_SERVER_URL',
@@ -50,6 +50,9 @@
         'contact_email',
         'executionDuration',
         'quote',
+        'cpus',
+        'memory',
+        'priority',
     ];
     var elt_fields = [
         'name',
@@ -216,6 +216,25 @@ var uwsLib = (function() {
 		});
 	};
 
+	uwsClient.prototype.followJobEvents = function(id, phaseCallback, endCallback, errorCallback) {
+		// Server-Sent Events of the job (phase changes, new lines of stdout and stderr)
+		var source = new EventSource(this.serviceUrl + "/" + id + "/events");
+		source.addEventListener('phase', function(e) {
+			phaseCallback(id, JSON.parse(e.data).phase);
+		});
+		source.addEventListener('end', function(e) {
+			source.close();
+			endCallback(id, JSON.parse(e.data).phase);
+		});
+		source.onerror = function(e) {
+			// The browser reconnects if the stream was only closed by the server
+			if (source.readyState == EventSource.CLOSED) {
+				errorCallback(id);
+			}
+		};
+		return source;
+	};
+
 	uwsClient.prototype.getJobList = function(successCallback, errorCallback) {
 		var jobName = this.jobName;
 		$.ajax({
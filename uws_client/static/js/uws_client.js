@@ -69,6 +69,8 @@ var uws_client = (function($) {
     var refreshPhaseTimeout = {}; // stores setInterval functions for phase refresh
     var refreshPhaseTimeoutDelay = {}; //
     var timeoutDelays = [2000,2000,3000,4000,5000]; // delays in ms
+    var jobEvents = {}; // stores EventSource of jobs followed with Server-Sent Events (false if not available)
+    var maxJobEvents = 2; // streams kept open at once (browsers limit the connections per server), other jobs are polled
     var selectedJobId;
 
     if (!('global' in window)) {
@@ -295,7 +297,7 @@ var uws_client = (function($) {
             case 'EXECUTING':
             case 'UNKNOWN':
             case 'SUSPENDED':
-                refreshPhaseTimeout[jobId] = setTimeout(getJobPhase, refreshPhaseTimeoutDelay[jobId], jobId);
+                followJobPhase(jobId);
         };
     };
 
@@ -1346,6 +1348,41 @@ var uws_client = (function($) {
     };
 
 
+    //----------
+    // FOLLOW JOB PHASE
+
+    var followJobPhase = function(jobId) {
+        // Follow phase changes with Server-Sent Events if possible, else poll the phase
+        var jobName = $('#'+jobId).attr('jobname');
+        if (jobEvents[jobId]) {
+            return;
+        };
+        var nJobEvents = Object.keys(jobEvents).filter(function(id) { return jobEvents[id]; }).length;
+        if (!window.EventSource || jobEvents[jobId] === false || nJobEvents >= maxJobEvents) {
+            refreshPhaseTimeout[jobId] = setTimeout(getJobPhase, refreshPhaseTimeoutDelay[jobId], jobId);
+            return;
+        };
+        logger('INFO', 'Follow events of job '+jobId);
+        jobEvents[jobId] = clients[jobName].followJobEvents(jobId, getJobEventsPhase, getJobEventsEnd, getJobEventsError);
+    };
+    var getJobEventsPhase = function(jobId, phase) {
+        var phase_init = $('#'+jobId+' td button.phase').html().split(";").pop();
+        if (phase != phase_init) {
+            refreshPhase(jobId, phase);
+        };
+    };
+    var getJobEventsEnd = function(jobId, phase) {
+        delete jobEvents[jobId];
+        getJobEventsPhase(jobId, phase);
+    };
+    var getJobEventsError = function(jobId) {
+        // Stream not available: poll the phase
+        logger('WARNING', 'Cannot follow events of job '+jobId+', poll phase');
+        jobEvents[jobId] = false;
+        getJobPhase(jobId);
+    };
+
+
     //----------
     // GET JOB PHASE
 
@@ -11,7 +11,9 @@ import yaml
 import uuid
 import datetime
 import base64
+import threading
 import requests
+from http.cookiejar import DefaultCookiePolicy
 import json
 from requests.auth import HTTPBasicAuth
 from flask import Flask, request, abort, redirect, url_for, session, g, current_app, render_template, flash, Response, stream_with_context, send_from_directory
@@ -635,25 +637,82 @@ def job_definition(jobname):
 # Proxy (to avoid cross domain calls and add Auth header)
 
 
+# Headers of the requests and responses forwarded by the proxy
+PROXY_REQUEST_HEADERS = ['Accept', 'Range', 'If-None-Match', 'Last-Event-ID']
+PROXY_RESPONSE_HEADERS = ['content-length', 'content-disposition', 'content-range', 'accept-ranges', 'etag',
+                          'cache-control', 'link', 'x-log-size']
+
+
 @app.route('/proxy/<path:uri>', methods=['GET', 'POST', 'DELETE'])
 def proxy(uri):
-    response = uws_server_request('/' + uri, method=request.method, init_request=request)
-    #logger.debug(response.headers.__dict__)
-    # def generate():
-    #     for chunk in r.iter_content(CHUNK_SIZE):
-    #         yield chunk
-    # return Response(stream_with_context(generate()), content_type = r.headers['content-type'])
-    headers = {}
-    for k in ['content-length', 'content-disposition']:  #, 'content-encoding']:
-        if k in response.headers.__dict__['_store']:
-            headers[k] = response.headers[k]
-    return Response(response, status=response.status_code, content_type=response.headers.get('content-type', None), headers=headers)
+    # The request body (e.g. uploaded files) and the response are streamed by chunks
+    response = uws_server_request('/' + uri, method=request.method, init_request=request, stream=True)
+    content_type = response.headers.get('content-type', None)
+    headers = {k: response.headers[k] for k in PROXY_RESPONSE_HEADERS if k in response.headers}
+    chunk_size = PROXY_CHUNK_SIZE
+    if content_type and content_type.startswith('text/event-stream'):
+        # Server-Sent Events (e.g. /rest/<jobname>/<jobid>/events): forward each event when received
+        chunk_size = None
+        headers['X-Accel-Buffering'] = 'no'
+
+    def generate():
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            response.close()
+
+    return Response(stream_with_context(generate()), status=response.status_code, content_type=content_type,
+                    headers=headers)
+
+
+class RequestBody(object):
+    """Body of the incoming request, read by chunks when sent by requests (its length gives the Content-Length)"""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
 
+    def __iter__(self):
+        return iter(lambda: self.stream.read(PROXY_CHUNK_SIZE), b'')
 
-def uws_server_request(uri, method='GET', init_request=None):
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+# Sessions to the UWS servers, indexed by server URL: connections are kept alive and reused
+_uws_server_sessions = {}
+_uws_server_sessions_lock = threading.Lock()
+
+
+def get_uws_server_session(server_url):
+    """Get the requests Session of the process to server_url, create it if needed (thread-safe)
+
+    The Session is shared by the requests of all the users, so cookies are not stored: a cookie set by the server
+    (or a load balancer) for a user would be sent with the requests of the other users.
+    """
+    with _uws_server_sessions_lock:
+        if server_url not in _uws_server_sessions:
+            http = requests.Session()
+            http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=PROXY_POOL_SIZE)
+            http.mount('http://', adapter)
+            http.mount('https://', adapter)
+            _uws_server_sessions[server_url] = http
+        return _uws_server_sessions[server_url]
+
+
+def uws_server_request(uri, method='GET', init_request=None, stream=False):
     server_url = app.config['UWS_SERVER_URL']
     # Remove server_url from uri if present (uri is expected to be a relative path)
     uri = uri.replace(server_url, '')
+    url = '{}{}'.format(server_url, uri)
+    http = get_uws_server_session(server_url)
+    # The read timeout is the maximum time between two bytes received (longer than a WAIT request on the server)
+    timeout = (PROXY_CONNECT_TIMEOUT, PROXY_READ_TIMEOUT)
     # Add auth information (Basic, Token...)
     auth = None
     if app.config['UWS_AUTH'] == 'Basic':
@@ -661,31 +720,33 @@ def uws_server_request(uri, method='GET', init_request=None):
             auth = HTTPBasicAuth(current_user.email, current_user.token)
         else:
             auth = HTTPBasicAuth('anonymous', 'anonymous')
+    headers = {}
+    if init_request:
+        # e.g. Range for the logs, Last-Event-ID when an events stream is reconnected
+        for k in PROXY_REQUEST_HEADERS:
+            if k in init_request.headers:
+                headers[k] = init_request.headers[k]
     # Send request
     if method == 'DELETE':
-        response = requests.delete('{}{}'.format(server_url, uri), auth=auth)
+        response = http.delete(url, auth=auth, headers=headers, stream=stream, timeout=timeout)
     elif method == 'POST':
-        post={}
-        if init_request:
-            for key in list(init_request.form.keys()):
-                value = init_request.form.getlist(key)
-                logger.debug('POST {}: {}'.format(key, value))
-                if len(value) == 1:
-                    post[key] = value[0]
-                else:
-                    post[key] = value
-        files = {}
+        body = None
         if init_request:
-            for fname in list(init_request.files.keys()):
-                logger.debug('file: ' + fname)
-                fp = init_request.files[fname]
-                files[fname] = (fp.filename, fp.stream, fp.content_type, fp.headers)
-        response = requests.post('{}{}'.format(server_url, uri), data=post, files=files, auth=auth)
+            # The form and files are not parsed by the client: the body is sent as received
+            headers['Content-Type'] = init_request.content_type
+            if init_request.mimetype in ['multipart/form-data', 'application/x-www-form-urlencoded']:
+                # e.g. uploaded files, sent by chunks
+                body = init_request.stream
+                if init_request.content_length is not None:
+                    body = RequestBody(init_request.stream, init_request.content_length)
+            else:
+                body = init_request.get_data(cache=False)
+        response = http.post(url, data=body, auth=auth, headers=headers, stream=stream, timeout=timeout)
     else:
         params = {}
         if init_request:
             params = init_request.args
-        response = requests.get('{}{}'.format(server_url, uri), params=params, auth=auth)
+        response = http.get(url, params=params, auth=auth, headers=headers, stream=stream, timeout=timeout)
     # Return response
     logger.debug("{} {}{} ({})".format(method, server_url, uri, response.status_code))
     return response
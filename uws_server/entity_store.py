@@ -4,10 +4,20 @@
 # Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
 """
 Defines class to store and keep track of entities
+
+The EntityStore is a content-addressed store of the entity files (see USE_ENTITY_STORE): each file is
+stored once in ENTITY_STORE_PATH/<hash[:2]>/<hash> (blob), and the files of the jobs (UPLOADS_PATH/<jobid>,
+RESULTS_PATH/<jobid>) with the same hash are hard links to this blob. The number of links of a blob is
+its reference count: a blob that is not linked anymore by a job file is removed by release() or collect().
+A file is linked to an existing blob only if their contents are identical (not only their hashes).
+
+All the files with the same content share the blob: a file modified in place (e.g. an input staged with
+LOCAL_STAGING = 'hardlink' and modified by a job) modifies the files of all the jobs that use this content.
 """
 
 import hashlib
-from .storage import *
+import filecmp
+import threading
 from .settings import *
 
 
@@ -18,19 +28,98 @@ class EntityStore(object):
         self.path = path
 
     def get_file_hash(self, fname):
-        """Generate SHA1 hassh for given file
+        """Generate SHA hash for given file (see SHA_ALGO)
         :param fname:
         :return: hax hash
         """
-        BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
-        sha1 = hashlib.sha1()
+        sha = getattr(hashlib, 'sha' + SHA_ALGO)()
         with open(fname, 'rb') as f:
             while True:
-                data = f.read(BUF_SIZE)
+                data = f.read(HASH_CHUNK_SIZE)
                 if not data:
                     break
-                sha1.update(data)
-        return sha1.hexdigest()
+                sha.update(data)
+        return sha.hexdigest()
+
+    def blob_path(self, hash):
+        """Path of the blob for the given hash"""
+        return os.path.join(self.path, hash[:2], hash)
+
+    def add(self, fname, hash=None):
+        """Store the file fname in the Store: the file becomes a link to the blob with the same hash if it exists,
+        else the blob is created as a link to the file
+        :return: blob path, or None if the file cannot be linked (e.g. Store on another file system)
+        """
+        if not hash:
+            hash = self.get_file_hash(fname)
+        blob = self.blob_path(hash)
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # New blob
+            os.link(fname, blob)
+            logger.debug('New blob {} for {}'.format(hash, fname))
+            return blob
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logger.warning('Cannot link {} in the entity store: {}'.format(fname, e))
+            return None
+        # Blob already stored, replace the file by a link to the blob
+        st_file = os.stat(fname)
+        st_blob = os.stat(blob)
+        if os.path.samestat(st_file, st_blob):
+            return blob
+        # Same hash is not enough (e.g. SHA-1 collisions): the file of another user must not be replaced by a
+        # link to a different content
+        if st_file.st_size != st_blob.st_size or not filecmp.cmp(fname, blob, shallow=False):
+            logger.warning('Blob {} has a different content than {}, file kept'.format(hash, fname))
+            return None
+        tmp = fname + '.link'
+        try:
+            os.link(blob, tmp)
+            os.replace(tmp, fname)
+        except OSError as e:
+            # e.g. blob removed meanwhile by release()
+            logger.warning('Cannot link {} to blob {}: {}'.format(fname, hash, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        logger.debug('File {} linked to blob {}'.format(fname, hash))
+        return blob
+
+    def refcount(self, hash):
+        """Number of files linked to the blob (0 if the blob is not stored)"""
+        try:
+            return os.stat(self.blob_path(hash)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def release(self, hash):
+        """Remove the blob if it is not linked anymore by a file
+        :return: True if the blob was removed
+        """
+        if hash and self.refcount(hash) == 0 and os.path.exists(self.blob_path(hash)):
+            # A file linked meanwhile keeps the content (the blob is linked again by add())
+            os.remove(self.blob_path(hash))
+            logger.debug('Blob {} removed'.format(hash))
+            return True
+        return False
+
+    def collect(self):
+        """Remove all the blobs that are not linked anymore by a file
+        :return: number of blobs removed
+        """
+        removed = 0
+        if not os.path.isdir(self.path):
+            return removed
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for hash in os.listdir(prefix_path):
+                if self.release(hash):
+                    removed += 1
+        return removed
 
     def get_entity_properties(self, id):
         """get entity properties using its id
@@ -87,3 +176,16 @@ class SQLEntityStore(EntityStore):
         """
         pass
 
+
+# Entity store of the server process
+_entity_store = None
+_entity_store_lock = threading.Lock()
+
+
+def get_entity_store():
+    """Get the EntityStore of the process, create it if needed (thread-safe)"""
+    global _entity_store
+    with _entity_store_lock:
+        if _entity_store is None:
+            _entity_store = EntityStore()
+    return _entity_store
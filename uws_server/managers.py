@@ -16,17 +16,23 @@ Specific functions are expected for those classes:
 * cp_script
 """
 
+import time
 import datetime as dt
 import subprocess as sp
 import re
+import heapq
+import itertools
+import signal
+import atexit
+import threading
+import selectors
+import yaml
+import blinker
 from .settings import *
+from .http_client import get_http_client
 
 if MANAGER == 'Local':
     import shutil
-    import signal
-    import requests
-    import threading
-    import psutil
 
 
 # -------------
@@ -52,6 +58,26 @@ class Manager(object):
     # workdir_path = '.'
     # results_path = '.'
 
+    def _job_event_function(self, name='job_event'):
+        """Bash function that sends a job event (phase, error message) to the UWS server with curl
+
+        Returns:
+            list of lines
+        """
+        return [
+            '{}() {{'.format(name),
+            '    if [ -z "$2" ]',
+            '    then',
+            '        curl -k -s -o $jd/job_curl_signal_$1.log'
+            ' -d "jobid=$JOBID" -d "phase=$1" {}/handler/job_event'.format(BASE_URL),
+            '    else',
+            '        echo "$1 $2"',
+            '        curl -k -s -o $jd/job_curl_signal_$1.log'
+            ' -d "jobid=$JOBID" -d "phase=$1" --data-urlencode "error_msg=$2" {}/handler/job_event'.format(BASE_URL),
+            '    fi',
+            '}',
+        ]
+
     def _make_batch(self, job, jobid_var='$$', get_input_files=[]):
         """Make batch file to run the job and signal status to the UWS server directly
 
@@ -74,20 +100,10 @@ class Manager(object):
             '}',
             'echo "[`timestamp`] Initialize job"',
         ]
-        # Error/Suspend/Term handler (send signals to server with curl)
+        # Error/Suspend/Term handler (send signals to server)
+        batch.extend(self._job_event_function())
         batch.extend([
             #'set -e ',
-            'job_event() {',
-            '    if [ -z "$2" ]',
-            '    then',
-            '        curl -k -s -o $jd/job_curl_signal_$1.log'
-            ' -d "jobid=$JOBID" -d "phase=$1" {}/handler/job_event'.format(BASE_URL),
-            '    else',
-            '        echo "$1 $2"',
-            '        curl -k -s -o $jd/job_curl_signal_$1.log'
-            ' -d "jobid=$JOBID" -d "phase=$1" --data-urlencode "error_msg=$2" {}/handler/job_event'.format(BASE_URL),
-            '    fi',
-            '}',
             'error_handler() {',
             '    if [ -z "$1" ]; then',
             '        msg="Error in ${BASH_SOURCE[1]##*/} running command: $BASH_COMMAND"',
@@ -240,6 +256,12 @@ class Manager(object):
         """
         return job.phase
 
+    def get_status_bulk(self, jobs):
+        """Get status (phase) of several jobs
+        :return: dictionary of job status indexed by jobid
+        """
+        return {job.jobid: self.get_status(job) for job in jobs}
+
     def get_info(self, job):
         """Get job info
         :return: dictionary with job info
@@ -250,6 +272,14 @@ class Manager(object):
         """Get job results"""
         pass
 
+    def get_log(self, job, logname, offset=0, tail=None):
+        """Get a log (stdout or stderr) of a job that is not yet in JOBDATA_PATH (e.g. still on a work cluster)
+
+        Returns:
+            iterator over the log content (bytes) from offset, or its last tail lines, None if not available
+        """
+        return None
+
     def cp_script(self, jobname):
         """Copy job script"""
         pass
@@ -265,82 +295,105 @@ class LocalManager(Manager):
     Note that get_status(), get_info(), get_jobdata() and cp_script() functions
     are not needed as the job runs on the UWS server directly
     """
-    poll_interval = 2  # poll processes regularly to avoid zombies
-    suspended_processes = []  # suspended processes, restart signals will be sent regularly
+    poll_interval = 2  # poll processes regularly, see LocalSupervisor
+    staging_strategies = ['copy', 'reflink', 'hardlink', 'symlink']
+    # Strategy detected for (device of source, device of destination), see detect_staging()
+    _detected_staging = {}
 
-    def __init__(self):
+    def __init__(self, staging=LOCAL_STAGING):
         # PATHs
         self.scripts_path = SCRIPTS_PATH
         self.jobdata_path = JOBDATA_PATH
         self.workdir_path = LOCAL_WORKDIR_PATH
         self.results_path = RESULTS_PATH
+        if staging not in self.staging_strategies + ['auto']:
+            raise UserWarning('Unknown staging strategy for input files: {}'.format(staging))
+        self.staging = staging
+
+    def detect_staging(self, src_dir, dst_dir):
+        """Strategy used to stage files from src_dir to dst_dir for LOCAL_STAGING = 'auto': reflink if the file
+        system supports it (copy-on-write, e.g. Btrfs, XFS), else copy. The result is kept for the devices.
+        """
+        key = (os.stat(src_dir).st_dev, os.stat(dst_dir).st_dev)
+        if key not in self._detected_staging:
+            staging = 'copy'
+            if key[0] == key[1]:
+                probe = os.path.join(src_dir, '.staging_probe_{}'.format(os.getpid()))
+                probe_copy = os.path.join(dst_dir, '.staging_probe_{}'.format(os.getpid()))
+                try:
+                    with open(probe, 'w') as f:
+                        f.write('probe')
+                    if sp.run(['cp', '--reflink=always', probe, probe_copy], stdout=sp.DEVNULL,
+                              stderr=sp.DEVNULL).returncode == 0:
+                        staging = 'reflink'
+                except OSError as e:
+                    logger.warning('Cannot detect staging strategy from {} to {}: {}'.format(src_dir, dst_dir, e))
+                finally:
+                    for path in [probe, probe_copy]:
+                        if os.path.exists(path):
+                            os.remove(path)
+            logger.info('Staging strategy from {} to {}: {}'.format(src_dir, dst_dir, staging))
+            self._detected_staging[key] = staging
+        return self._detected_staging[key]
+
+    def _stage_file(self, src, dst, staging=None):
+        """Bash command that stages the file src to dst with the staging strategy (see LOCAL_STAGING), falling back
+        to a copy if not possible (e.g. hard link across devices)
+
+        Returns:
+            command as a string
+        """
+        staging = staging or self.staging
+        if staging == 'reflink':
+            # GNU cp copies the file if the file system does not support reflinks
+            return 'cp -p --reflink=auto {src} {dst}'.format(src=src, dst=dst)
+        if staging == 'hardlink':
+            return 'ln -f {src} {dst} 2>/dev/null || cp -p {src} {dst}'.format(src=src, dst=dst)
+        if staging == 'symlink':
+            return 'ln -sf {src} {dst}'.format(src=src, dst=dst)
+        return 'cp -p {src} {dst}'.format(src=src, dst=dst)
+
+    def _job_event_function(self, name='job_event'):
+        """Bash function that writes the job event to the named pipe of the server process (see JobEventChannel),
+        or sends it with curl if the pipe is not read
+
+        Returns:
+            list of lines
+        """
+        if not LOCAL_JOB_EVENTS_FIFO:
+            return super()._job_event_function(name=name)
+        fifo = get_job_event_channel().path
+        lines = super()._job_event_function(name=name + '_curl')
+        lines.extend([
+            '{}() {{'.format(name),
+            '    local event_msg="${2//$\'\\n\'/ }"',
+            '    if [ -p ' + fifo + ' ] && printf "%s\\t%s\\t%s\\n" "$JOBID" "$1" "${event_msg:0:2000}"'
+            ' | timeout 5 tee -a ' + fifo + ' >/dev/null',
+            '    then',
+            '        if [ -n "$2" ]; then echo "$1 $2"; fi',
+            '    else',
+            '        {}_curl "$1" "$2"'.format(name),
+            '    fi',
+            '}',
+        ])
+        return lines
 
     def _send_signal(self, process_id, phase, error_msg=''):
+        # Job event handled in-process if the server listens to job events (see JobEventChannel)
+        job_event = blinker.signal('job_event')
+        if job_event.receivers:
+            job_event.send(process_id, phase=phase, error_msg=error_msg)
+            return
         data = {'jobid': process_id, 'phase': phase}
         if error_msg:
             data['error_msg'] = error_msg
         url = '{}/handler/job_event'.format(BASE_URL)
-        response = requests.post(url, data)
+        response = get_http_client().post(url, data)
         logger.info('job event sent {}'.format(response.content))
         if response.status_code != 200:
             logger.error(response.content)
         del response
 
-    def _poll_process(self, popen, job):
-        rcode = popen.poll()
-        process_id = popen.pid
-        # Actions depending on rcode value
-        if not rcode:
-            try:
-                p = psutil.Process(process_id)
-            except psutil.NoSuchProcess as e:
-                logger.info('process {} ended (NoSuchProcess)'.format(process_id))
-                if job.phase == 'EXECUTING':
-                    self._send_signal(process_id, 'ERROR', error_msg='Process terminated with errors')
-                return
-            # TODO: Handle sleeping, idle, suspended processes?...
-            # Handle stopped processes
-            if p.status() in [psutil.STATUS_STOPPED, psutil.STATUS_TRACING_STOP]:
-                logger.info('process {} stopped'.format(process_id))
-                try:
-                    # Try to restart the process by sending SIGCONT
-                    os.kill(process_id, signal.SIGCONT)
-                except OSError as e:
-                    if 'No such process' in str(e):
-                        logger.warning('No such process ({})'.format(process_id))
-                    else:
-                        logger.warning(str(e))
-                if p.status() == psutil.STATUS_STOPPED:
-                    # If this did not work, change status to SUSPENDED for now
-                    self._send_signal(process_id, 'SUSPENDED')
-                    self.suspended_processes.append(process_id)
-                else:
-                    # If this worked, continue execution
-                    if process_id in self.suspended_processes:
-                        self._send_signal(process_id, 'EXECUTING')
-                        self.suspended_processes.remove(process_id)
-                    logger.info('process {} continued'.format(process_id))
-                # Rerun _poll_process after some time
-                threading.Timer(self.poll_interval, self._poll_process, [popen, job]).start()
-            else:
-                # Let the process run
-                logger.debug('process {} running'.format(process_id))
-                # Rerun _poll_process after some time
-                threading.Timer(self.poll_interval, self._poll_process, [popen, job]).start()
-        # Handle killed processes
-        elif rcode == -9:
-            logger.info('process {} killed during execution'.format(process_id))
-            self._send_signal(process_id, 'ERROR', error_msg='Process killed during execution')
-        # Handle processes terminated with errors
-        elif rcode <= -1:
-            logger.info('process {} terminated with errors'.format(process_id))
-            self._send_signal(process_id, 'ERROR', error_msg='Process terminated with errors')
-        # Otherwise process has terminated
-        else:
-            logger.info('process {} terminated (rcode=0)'.format(process_id))
-            if job.phase == 'EXECUTING':
-                self._send_signal(process_id, 'ERROR', error_msg='Process terminated (rcode=0)')
-
     def start(self, job):
         """Start job locally
         :return: process_id
@@ -352,6 +405,11 @@ class LocalManager(Manager):
             os.makedirs(jd)
         if not os.path.isdir(wd):
             os.makedirs(wd)
+        # Resources requested by the job (UserWarning if a PARAM of its JDL is not valid)
+        admission_file = '{}/job_admitted'.format(jd)
+        admission_fifo = '{}/job_admission'.format(jd)
+        scheduler = get_local_scheduler()
+        request = scheduler.request(job, admission_file, admission_fifo=admission_fifo)
         # Create parameter file
         param_file = '{}/parameters.sh'.format(jd)
         with open(param_file, 'w') as f:
@@ -359,50 +417,109 @@ class LocalManager(Manager):
             params, files = job.parameters_to_bash(get_files=True)
             f.write(params)
         os.chmod(param_file, 0o744)
-        get_input_files = []
-        # Copy job description file
-        jdl_fname = job.jdl._get_filename(job.jobname)
-        get_input_files.append('cp -p {jdl} {jd}'.format(jdl=jdl_fname, jd=jd))
-        # Copy input files to workdir_path (scp if uploaded from form, or wget if given as a URI)
-        for fname in files['form']:
-            # shutil.copy(
-            #     '{}/{}/{}'.format(UPLOADS_PATH, job.jobid, fname),
-            #     '{}/{}'.format(wd, fname))
-            get_input_files.append('cp -p {up}/{jobid}/{fname} {wd}/{fname}'.format(
-                up=UPLOADS_PATH, jobid=job.jobid, fname=fname, wd=wd
-            ))
-        for furl in files['URI']:
-            fname = furl.split('/')[-1]
-            # response = requests.get(furl, stream=True)
-            # with open('{}/{}'.format(wd, fname), 'wb') as out_file:
-            #     shutil.copyfileobj(response.raw, out_file)
-            # del response
-            get_input_files.append('curl -OJ {url}'.format(url=furl))
-        # Create batch file
-        batch = [
-            '#!/bin/bash -l',
-            '### INIT LocalManager',
-            # Redirect stdout and stderr to files
-            'exec >{jd}/stdout.log 2>{jd}/stderr.log'.format(jd=jd),
-        ]
-        batch.extend(
-            self._make_batch(job, get_input_files=get_input_files)
-        )
-        batch_file = '{}/batch.sh'.format(jd)
-        with open(batch_file, 'w') as f:
-            f.write('\n'.join(batch))
-        os.chmod(batch_file, 0o744)
-        # Execute batch using sp
-        cmd = [batch_file]
-        # logger.debug(' '.join(cmd))
-        popen = sp.Popen(cmd)
-        # poll popen regularly
-        self._poll_process(popen, job)
+        # Wait for admission (see LocalScheduler), the job stays QUEUED. The script blocks on a read of the named
+        # pipe job_admission (opened for reading and writing, so it does not block on open and the scheduler can
+        # write to it), and wakes up every minute to fail if the server process ended meanwhile.
+        for fname in [admission_file, admission_fifo]:
+            if os.path.exists(fname):
+                os.remove(fname)
+        os.mkfifo(admission_fifo, 0o600)
+        cgroup = None
+        try:
+            get_input_files = [
+                'exec 3<>{fifo}'.format(fifo=admission_fifo),
+                'if [ ! -e {af} ]; then echo "[`timestamp`] Wait for admission"; fi'.format(af=admission_file),
+                'while [ ! -e {af} ]; do'.format(af=admission_file),
+                '    read -r -t 60 -u 3 || kill -0 $PPID 2>/dev/null || error_handler "Server process ended while the job was queued"',
+                'done',
+                'exec 3<&-',
+                'rm -f {fifo}'.format(fifo=admission_fifo),
+            ]
+            # Copy job description file
+            jdl_fname = job.jdl._get_filename(job.jobname)
+            get_input_files.append('cp -p {jdl} {jd}'.format(jdl=jdl_fname, jd=jd))
+            # Stage input files to workdir_path (see LOCAL_STAGING) if uploaded from form, or curl if given as a URI
+            staging = self.staging
+            if staging == 'auto':
+                staging = self.detect_staging(UPLOADS_PATH, self.workdir_path)
+            for fname in files['form']:
+                # shutil.copy(
+                #     '{}/{}/{}'.format(UPLOADS_PATH, job.jobid, fname),
+                #     '{}/{}'.format(wd, fname))
+                get_input_files.append(self._stage_file(
+                    '{up}/{jobid}/{fname}'.format(up=UPLOADS_PATH, jobid=job.jobid, fname=fname),
+                    '{wd}/{fname}'.format(wd=wd, fname=fname),
+                    staging=staging,
+                ))
+            for furl in files['URI']:
+                fname = furl.split('/')[-1]
+                # response = requests.get(furl, stream=True)
+                # with open('{}/{}'.format(wd, fname), 'wb') as out_file:
+                #     shutil.copyfileobj(response.raw, out_file)
+                # del response
+                get_input_files.append('curl -OJ {url}'.format(url=furl))
+            # Create batch file
+            batch = [
+                '#!/bin/bash -l',
+                '### INIT LocalManager',
+                # Redirect stdout and stderr to files
+                'exec >{jd}/stdout.log 2>{jd}/stderr.log'.format(jd=jd),
+            ]
+            if LOCAL_CGROUP_PATH:
+                # Limits of the job (see JobCgroup): the script and its children are moved to the cgroup first, the
+                # job fails if it cannot be moved, instead of running without limits
+                setup_local_cgroups()
+                cgroup = JobCgroup(job.jobid)
+                cgroup.create(cpus=request['cpus'], memory=request['memory'])
+                get_input_files.insert(0, cgroup.join_command())
+            batch.extend(
+                self._make_batch(job, get_input_files=get_input_files)
+            )
+            batch_file = '{}/batch.sh'.format(jd)
+            with open(batch_file, 'w') as f:
+                f.write('\n'.join(batch))
+            os.chmod(batch_file, 0o744)
+            # Admit the job now if possible (the script does not wait)
+            scheduler.submit(request)
+            # Execute batch using sp
+            cmd = [batch_file]
+            # logger.debug(' '.join(cmd))
+            popen = sp.Popen(cmd)
+        except Exception:
+            # The job is not started: free its slot, remove its cgroup and the admission files
+            scheduler.release(job.jobid)
+            if cgroup:
+                cgroup.remove()
+            for fname in [admission_file, admission_fifo]:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            raise
+        # follow process until it ends
+        get_local_supervisor().add(popen, job)
         # Return process_id
         return popen.pid
 
+    def is_job_process(self, job):
+        """Check that job.process_id runs the batch script of the job: the pid may have been reused by another
+        process (e.g. job aborted after a restart of the server). True if it cannot be checked (no /proc).
+        """
+        try:
+            with open('/proc/{}/cmdline'.format(job.process_id), 'rb') as f:
+                cmdline = f.read()
+        except FileNotFoundError:
+            return not os.path.isdir('/proc')
+        except OSError:
+            return True
+        return '{}/{}/batch.sh'.format(self.jobdata_path, job.jobid).encode() in cmdline
+
     def abort(self, job):
         """Abort/Cancel job"""
+        if LOCAL_CGROUP_PATH:
+            # Kill all the processes of the job, including the processes started in background
+            JobCgroup(job.jobid).kill()
+        if not self.is_job_process(job):
+            logger.info('Process {} is not job {} {}, not killed'.format(job.process_id, job.jobname, job.jobid))
+            return
         try:
             os.kill(job.process_id, signal.SIGKILL) # SIGTERM => error sent ; SIGKILL => no error sent, just killed!
         except OSError as e:
@@ -427,6 +544,691 @@ class LocalManager(Manager):
             raise
 
 
+# -------------
+# Supervisor of local processes
+
+
+class LocalSupervisor(object):
+    """
+    Follow all the processes started by LocalManager in a single thread. Processes that end are reaped
+    with os.waitpid (no zombies) and their end is signaled if needed. Stopped processes are restarted
+    with SIGCONT, or signaled as SUSPENDED if they remain stopped (SIGCONT is then sent at each poll).
+    Processes are polled all together every poll_interval, or as soon as a process ends (pidfd on Linux).
+    """
+
+    def __init__(self, send_signal, poll_interval=2, on_end=None):
+        self.send_signal = send_signal
+        self.poll_interval = poll_interval
+        self.on_end = on_end  # called with the job when its process ends
+        # Followed processes, only accessed by the supervisor thread: {pid: (popen, job, pidfd)}
+        self.processes = {}
+        self.stopped_processes = set()  # stopped processes, SIGCONT was sent
+        self.suspended_processes = set()  # processes still stopped after SIGCONT
+        self._new_processes = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._selector = selectors.DefaultSelector()
+        # Pipe used to wake up the supervisor thread when a process is added
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    def add(self, popen, job):
+        """Follow the process popen started for job"""
+        with self._lock:
+            self._new_processes.append((popen, job))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='LocalSupervisor', daemon=True)
+                self._thread.start()
+        os.write(self._wakeup_w, b'1')
+
+    def count(self):
+        """Number of processes followed"""
+        return len(self.processes) + len(self._new_processes)
+
+    def _run(self):
+        while True:
+            try:
+                self._wait()
+                self._add_new_processes()
+                self.poll()
+            except Exception as e:
+                logger.error('LocalSupervisor: {}'.format(e))
+
+    def _wait(self):
+        # Wait for a process to end (pidfd readable), a new process, or the next poll
+        timeout = self.poll_interval if self.processes else None
+        for key, events in self._selector.select(timeout):
+            if key.fd == self._wakeup_r:
+                try:
+                    os.read(self._wakeup_r, 4096)
+                except BlockingIOError:
+                    pass
+
+    def _add_new_processes(self):
+        with self._lock:
+            new_processes, self._new_processes = self._new_processes, []
+        for popen, job in new_processes:
+            pidfd = None
+            if hasattr(os, 'pidfd_open'):
+                try:
+                    pidfd = os.pidfd_open(popen.pid)
+                    self._selector.register(pidfd, selectors.EVENT_READ)
+                except OSError as e:
+                    # e.g. Linux < 5.3, the process is only polled
+                    logger.debug('No pidfd for process {}: {}'.format(popen.pid, e))
+                    pidfd = None
+            self.processes[popen.pid] = (popen, job, pidfd)
+
+    def poll(self):
+        """Check the state of all processes, reap the processes that ended"""
+        for process_id in list(self.processes):
+            try:
+                pid, status = os.waitpid(process_id, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+            except ChildProcessError:
+                logger.info('process {} ended (no such child process)'.format(process_id))
+                self._end_process(process_id, None)
+                continue
+            if pid == 0:
+                # No change: check if the process is still stopped
+                if process_id in self.stopped_processes:
+                    if process_id not in self.suspended_processes:
+                        # SIGCONT did not work, change status to SUSPENDED for now
+                        self.send_signal(process_id, 'SUSPENDED')
+                        self.suspended_processes.add(process_id)
+                    self._continue_process(process_id)
+            elif os.WIFSTOPPED(status):
+                logger.info('process {} stopped'.format(process_id))
+                self.stopped_processes.add(process_id)
+                self._continue_process(process_id)
+            elif os.WIFCONTINUED(status):
+                self.stopped_processes.discard(process_id)
+                if process_id in self.suspended_processes:
+                    self.send_signal(process_id, 'EXECUTING')
+                    self.suspended_processes.discard(process_id)
+                logger.info('process {} continued'.format(process_id))
+            elif os.WIFSIGNALED(status):
+                self._end_process(process_id, -os.WTERMSIG(status))
+            else:
+                self._end_process(process_id, os.WEXITSTATUS(status))
+
+    def _continue_process(self, process_id):
+        try:
+            # Try to restart the process by sending SIGCONT
+            os.kill(process_id, signal.SIGCONT)
+        except OSError as e:
+            logger.warning('Cannot continue process {}: {}'.format(process_id, e))
+
+    def _end_process(self, process_id, rcode):
+        popen, job, pidfd = self.processes.pop(process_id)
+        if pidfd is not None:
+            self._selector.unregister(pidfd)
+            os.close(pidfd)
+        self.stopped_processes.discard(process_id)
+        self.suspended_processes.discard(process_id)
+        if self.on_end:
+            try:
+                self.on_end(job)
+            except Exception as e:
+                logger.error('LocalSupervisor: {}'.format(e))
+        if rcode is None:
+            if job.phase == 'EXECUTING':
+                self.send_signal(process_id, 'ERROR', error_msg='Process terminated with errors')
+            return
+        # Process reaped here, popen.poll() would not get the return code
+        popen.returncode = rcode
+        # Handle killed processes
+        if rcode == -9:
+            logger.info('process {} killed during execution'.format(process_id))
+            self.send_signal(process_id, 'ERROR', error_msg='Process killed during execution')
+        # Handle processes terminated with errors
+        elif rcode <= -1:
+            logger.info('process {} terminated with errors'.format(process_id))
+            self.send_signal(process_id, 'ERROR', error_msg='Process terminated with errors')
+        # Otherwise process has terminated
+        else:
+            logger.info('process {} terminated (rcode={})'.format(process_id, rcode))
+            if job.phase == 'EXECUTING':
+                self.send_signal(process_id, 'ERROR', error_msg='Process terminated (rcode={})'.format(rcode))
+
+
+# Supervisor of the local processes started by this server process
+_local_supervisor = None
+_local_supervisor_lock = threading.Lock()
+
+
+def get_local_supervisor():
+    """Get the LocalSupervisor of the process, create it if needed (thread-safe)"""
+    global _local_supervisor
+    with _local_supervisor_lock:
+        if _local_supervisor is None:
+            _local_supervisor = LocalSupervisor(LocalManager()._send_signal, poll_interval=LocalManager.poll_interval,
+                                                on_end=end_local_job)
+    return _local_supervisor
+
+
+# cgroups of ended jobs not removed yet: their killed processes were not reaped when the job ended
+_cgroups_to_remove = set()
+_cgroups_to_remove_lock = threading.Lock()
+
+
+def end_local_job(job):
+    """Called when the process of a local job ended: record the resources used (cgroup), and free its slot"""
+    if LOCAL_CGROUP_PATH:
+        cgroup = JobCgroup(job.jobid)
+        if os.path.isdir(cgroup.path):
+            # Processes left in background by the job
+            cgroup.kill()
+            stats = cgroup.stats()
+            logger.info('Resources used by job {}: {}'.format(job.jobid, stats))
+            try:
+                with open('{}/{}/resources.yml'.format(JOBDATA_PATH, job.jobid), 'w') as f:
+                    yaml.safe_dump(stats, f, default_flow_style=False)
+            except OSError as e:
+                logger.warning('Cannot record resources used by job {}: {}'.format(job.jobid, e))
+            # Called by the supervisor thread: no wait, the cgroup is removed at the end of a next job if needed
+            with _cgroups_to_remove_lock:
+                _cgroups_to_remove.add(cgroup.path)
+                for path in list(_cgroups_to_remove):
+                    if JobCgroup.remove_path(path):
+                        _cgroups_to_remove.discard(path)
+    get_local_scheduler().release(job.jobid)
+
+
+# -------------
+# Resource limits of local jobs
+
+
+class JobCgroup(object):
+    """
+    cgroup v2 of a local job, created in root/jobs (see LOCAL_CGROUP_PATH). The root cgroup must be delegated to the
+    user of the server, and the server must be started in it (e.g. systemd service of the server with Delegate=yes),
+    since a process can only be moved between two cgroups by a user who can write to their common ancestor. The
+    server process is moved to the leaf root/server (see setup_local_cgroups), so that the cpu, memory and io
+    controllers can be enabled for root/jobs, and that the lower cpu.weight of root/jobs (LOCAL_CGROUP_CPU_WEIGHT)
+    protects the server.
+    """
+
+    cpu_period = 100000  # in microseconds
+
+    def __init__(self, jobid, root=LOCAL_CGROUP_PATH):
+        self.root = root
+        self.path = os.path.join(root, 'jobs', 'job_{}'.format(jobid))
+
+    @classmethod
+    def setup(cls, root=LOCAL_CGROUP_PATH, cpu_weight=LOCAL_CGROUP_CPU_WEIGHT):
+        """Move the server process to root/server, and create root/jobs with the controllers enabled"""
+        server = os.path.join(root, 'server')
+        jobs = os.path.join(root, 'jobs')
+        os.makedirs(server, exist_ok=True)
+        os.makedirs(jobs, exist_ok=True)
+        try:
+            with open(os.path.join(server, 'cgroup.procs'), 'w') as f:
+                f.write(str(os.getpid()))
+        except OSError as e:
+            raise OSError('Cannot move the server process to {} (the server must run in the delegated cgroup {}): {}'
+                          ''.format(server, root, e))
+        # A cgroup with processes cannot enable controllers for its children (except the root cgroup)
+        for path in [root, jobs]:
+            try:
+                with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as f:
+                    f.write('+cpu +memory +io')
+            except OSError as e:
+                logger.warning('Cannot enable controllers in {}: {}'.format(path, e))
+        if cpu_weight:
+            with open(os.path.join(jobs, 'cpu.weight'), 'w') as f:
+                f.write(str(cpu_weight))
+
+    def _write(self, name, value, path=None):
+        with open(os.path.join(path or self.path, name), 'w') as f:
+            f.write(value)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def create(self, cpus=0, memory=0):
+        """Create the cgroup with the given limits: cpus (number of CPUs, may be fractional) and memory (in MB)"""
+        os.makedirs(self.path, exist_ok=True)
+        if cpus:
+            self._write('cpu.max', '{} {}'.format(int(cpus * self.cpu_period), self.cpu_period))
+        if memory:
+            self._write('memory.max', str(int(memory * 1024**2)))
+
+    def join_command(self):
+        """Bash command that moves the script to the cgroup, or fails the job (error_handler of the batch script)"""
+        return 'echo $$ > {path}/cgroup.procs || error_handler "Cannot move the job to its cgroup {path}"'.format(
+            path=self.path)
+
+    def kill(self):
+        """Kill all the processes of the cgroup"""
+        if not os.path.isdir(self.path):
+            return
+        if os.path.exists(os.path.join(self.path, 'cgroup.kill')):
+            # Linux >= 5.14
+            try:
+                self._write('cgroup.kill', '1')
+                return
+            except OSError as e:
+                logger.warning('Cannot kill cgroup {}: {}'.format(self.path, e))
+        for pid in (self._read('cgroup.procs') or '').split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except (OSError, ValueError):
+                pass
+
+    def stats(self):
+        """Resources used: cpu_time (in seconds), memory_peak (in bytes, Linux >= 5.19), io_read_bytes,
+        io_write_bytes, oom_kill (number of processes killed by the memory limit)"""
+        stats = {}
+        for line in (self._read('cpu.stat') or '').splitlines():
+            key, value = line.split()
+            if key == 'usage_usec':
+                stats['cpu_time'] = int(value) / 1e6
+        memory_peak = self._read('memory.peak')
+        if memory_peak and memory_peak.strip().isdigit():
+            stats['memory_peak'] = int(memory_peak)
+        io_stat = self._read('io.stat')
+        if io_stat is not None:
+            stats['io_read_bytes'] = 0
+            stats['io_write_bytes'] = 0
+            for line in io_stat.splitlines():
+                for item in line.split()[1:]:
+                    key, value = item.split('=')
+                    if key == 'rbytes':
+                        stats['io_read_bytes'] += int(value)
+                    elif key == 'wbytes':
+                        stats['io_write_bytes'] += int(value)
+        for line in (self._read('memory.events') or '').splitlines():
+            key, value = line.split()
+            if key == 'oom_kill':
+                stats['oom_kill'] = int(value)
+        return stats
+
+    def remove(self):
+        """Remove the cgroup (once its processes ended)"""
+        return self.remove_path(self.path)
+
+    @staticmethod
+    def remove_path(path):
+        """Remove the cgroup path if it has no process, without waiting
+        :return: True if removed or not found
+        """
+        try:
+            os.rmdir(path)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            # Killed processes not reaped yet
+            logger.debug('Cannot remove cgroup {}: {}'.format(path, e))
+            return False
+
+
+# Local cgroups set up for this server process
+_local_cgroups_ready = False
+_local_cgroups_lock = threading.Lock()
+
+
+def setup_local_cgroups():
+    """Set up LOCAL_CGROUP_PATH for the jobs of this server process once (see JobCgroup.setup, thread-safe)"""
+    global _local_cgroups_ready
+    with _local_cgroups_lock:
+        if not _local_cgroups_ready:
+            JobCgroup.setup()
+            _local_cgroups_ready = True
+
+
+# -------------
+# Admission of local jobs
+
+
+def parse_memory(value):
+    """Memory in MB from a value given as in SLURM (e.g. 500mb, 2gb, 2G), in MB if no unit is given"""
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)b?\s*$', str(value).lower())
+    if not match:
+        raise ValueError('Bad memory value: {}'.format(value))
+    factors = {'k': 1 / 1024, '': 1, 'm': 1, 'g': 1024, 't': 1024**2}
+    return float(match.group(1)) * factors[match.group(2)]
+
+
+class LocalScheduler(object):
+    """
+    Admission of the jobs started by LocalManager. A job is executed only if a slot is free (max_jobs, and
+    max_jobs_per_user, max_jobs_per_jobname) and if the CPUs and memory it declares in its JDL (PARAM cpus and
+    memory, 1 CPU by default) are available, else it stays QUEUED: its batch script waits for the file
+    job_admitted in the jobdata directory, created at admission, blocked on a read of the named pipe
+    job_admission. The limits apply to the jobs started by this server process: with several processes (e.g.
+    mod_wsgi), each process admits its own jobs. Waiting jobs are admitted by priority
+    (PARAM priority in the JDL, higher first, 0 by default), then in order of submission. A job that does not
+    fit the free CPUs, memory or global slots blocks the jobs after it (no starvation of large jobs), a job that
+    waits for a slot of its user or jobname does not. Limits set to 0 are not checked.
+    """
+
+    def __init__(self, max_jobs=LOCAL_MAX_JOBS, max_jobs_per_user=LOCAL_MAX_JOBS_PER_USER,
+                 max_jobs_per_jobname=LOCAL_MAX_JOBS_PER_JOBNAME, cpus=LOCAL_CPUS, memory=LOCAL_MEMORY):
+        self.max_jobs = max_jobs
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_jobs_per_jobname = max_jobs_per_jobname
+        self.cpus = cpus
+        self.memory = memory
+        self.queue = []  # heap of (-priority, submission order, jobid)
+        self.waiting = {}  # {jobid: request}
+        self.running = {}  # {jobid: request}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def request(self, job, admission_file, admission_fifo=None):
+        """Resources requested by job (from its JDL), admission_file is created when the job is admitted, then a
+        line is written to admission_fifo (if given) to wake up the script that waits on it
+        """
+        jdl = job.jdl.content
+        try:
+            cpus = float(jdl.get('cpus') or 1)
+            if cpus <= 0:
+                raise ValueError
+        except ValueError:
+            raise UserWarning('Bad value for PARAM cpus in the JDL of {}: {}'.format(job.jobname, jdl.get('cpus')))
+        try:
+            memory = parse_memory(jdl['memory']) if jdl.get('memory') else 0
+        except ValueError:
+            raise UserWarning('Bad value for PARAM memory in the JDL of {}: {} (e.g. 500mb or 2gb)'.format(
+                job.jobname, jdl.get('memory')))
+        try:
+            priority = int(jdl.get('priority') or 0)
+        except ValueError:
+            raise UserWarning('Bad value for PARAM priority in the JDL of {}: {} (integer expected)'.format(
+                job.jobname, jdl.get('priority')))
+        return {
+            'jobid': job.jobid,
+            'owner': job.owner,
+            'jobname': job.jobname,
+            # A job that needs more than available is executed alone
+            'cpus': min(cpus, self.cpus) if self.cpus else cpus,
+            'memory': min(memory, self.memory) if self.memory else memory,
+            'priority': priority,
+            'admission_file': admission_file,
+            'admission_fifo': admission_fifo,
+        }
+
+    def submit(self, request):
+        """Admit the job now if possible, else add it to the queue
+        :return: True if admitted
+        """
+        with self._lock:
+            self.waiting[request['jobid']] = request
+            heapq.heappush(self.queue, (-request['priority'], next(self._counter), request['jobid']))
+            self._admit()
+            return request['jobid'] in self.running
+
+    def release(self, jobid):
+        """The job ended (or was aborted while waiting): free its resources and admit waiting jobs"""
+        with self._lock:
+            if self.waiting.pop(jobid, None):
+                self.queue = [item for item in self.queue if item[2] != jobid]
+                heapq.heapify(self.queue)
+            self.running.pop(jobid, None)
+            self._admit()
+
+    def count(self):
+        """Number of jobs running and waiting"""
+        return len(self.running), len(self.waiting)
+
+    def _count_running(self, key, value):
+        return sum(1 for r in self.running.values() if r[key] == value)
+
+    def _admit(self):
+        skipped = []
+        while self.queue:
+            item = heapq.heappop(self.queue)
+            request = self.waiting[item[2]]
+            # Global limits: the job blocks the jobs after it
+            if ((self.max_jobs and len(self.running) >= self.max_jobs)
+                    or (self.cpus and sum(r['cpus'] for r in self.running.values()) + request['cpus'] > self.cpus)
+                    or (self.memory and sum(r['memory'] for r in self.running.values()) + request['memory']
+                        > self.memory)):
+                skipped.append(item)
+                break
+            # Slots of the user and jobname: the job lets other jobs pass
+            if ((self.max_jobs_per_user and self._count_running('owner', request['owner'])
+                 >= self.max_jobs_per_user)
+                    or (self.max_jobs_per_jobname and self._count_running('jobname', request['jobname'])
+                        >= self.max_jobs_per_jobname)):
+                skipped.append(item)
+                continue
+            del self.waiting[request['jobid']]
+            self.running[request['jobid']] = request
+            try:
+                open(request['admission_file'], 'w').close()
+            except OSError as e:
+                logger.error('LocalScheduler: cannot admit job {}: {}'.format(request['jobid'], e))
+            self._wake_up(request)
+            logger.info('LocalScheduler: job {} admitted ({} running, {} waiting)'.format(
+                request['jobid'], len(self.running), len(self.waiting)))
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+
+    @staticmethod
+    def _wake_up(request):
+        # Non-blocking: fails with ENXIO if the script does not read the pipe yet (it then finds admission_file
+        # before reading), or if the job has already ended
+        if not request.get('admission_fifo'):
+            return
+        try:
+            fd = os.open(request['admission_fifo'], os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+        try:
+            os.write(fd, b'admitted\n')
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+# Scheduler of the local jobs started by this server process
+_local_scheduler = None
+_local_scheduler_lock = threading.Lock()
+
+
+def get_local_scheduler():
+    """Get the LocalScheduler of the process, create it if needed (thread-safe)"""
+    global _local_scheduler
+    with _local_scheduler_lock:
+        if _local_scheduler is None:
+            _local_scheduler = LocalScheduler()
+    return _local_scheduler
+
+
+# -------------
+# Job events of local processes
+
+
+class JobEventChannel(object):
+    """
+    Named pipe read by a thread of the server process: the job scripts started by LocalManager write their
+    events to it (one line per event: process_id, phase and error message separated by tabs) instead of
+    sending them to /handler/job_event. Events are dispatched in-process with the blinker signal 'job_event'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        os.mkfifo(path, 0o600)
+        # Open for reading and writing: open() does not block, and the pipe is not closed when scripts close it
+        self._fd = os.open(path, os.O_RDWR)
+        self._thread = threading.Thread(target=self._run, name='JobEventChannel', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        with open(self._fd, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                try:
+                    self.dispatch(line)
+                except Exception as e:
+                    logger.error('JobEventChannel: {}'.format(e))
+
+    def dispatch(self, line):
+        """Send the job event given as a line to the 'job_event' receivers"""
+        process_id, phase, error_msg = (line.rstrip('\n').split('\t', 2) + ['', ''])[:3]
+        logger.debug('job event received for process {}: {} {}'.format(process_id, phase, error_msg))
+        job_event = blinker.signal('job_event')
+        if not job_event.receivers:
+            logger.warning('job event lost for process {}: no receiver'.format(process_id))
+        job_event.send(process_id, phase=phase, error_msg=error_msg)
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Channel of the job events sent by the local processes started by this server process
+_job_event_channel = None
+_job_event_channel_lock = threading.Lock()
+
+
+def get_job_event_channel():
+    """Get the JobEventChannel of the process, create it if needed (thread-safe)"""
+    global _job_event_channel
+    with _job_event_channel_lock:
+        if _job_event_channel is None:
+            if not os.path.isdir(TEMP_PATH):
+                os.makedirs(TEMP_PATH)
+            _job_event_channel = JobEventChannel('{}/job_events_{}.fifo'.format(TEMP_PATH, os.getpid()))
+            atexit.register(_job_event_channel.close)
+    return _job_event_channel
+
+
+# -------------
+# SSH connection to the SLURM work cluster
+
+
+class SSHConnection(object):
+    """
+    Run commands on a remote host with ssh/scp through a persistent connection (OpenSSH ControlMaster):
+    the first command opens the connection, the following ones reuse it until it is idle for
+    SLURM_SSH_CONTROL_PERSIST seconds. Several commands can be sent in one round-trip with run_batch().
+    The latency of each operation is recorded, see get_metrics().
+    """
+
+    def __init__(self, ssh_arg, control_path=SLURM_SSH_CONTROL_PATH, control_persist=SLURM_SSH_CONTROL_PERSIST):
+        self.ssh_arg = ssh_arg
+        self.options = []
+        if control_persist:
+            self.options = [
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={}'.format(os.path.expanduser(control_path)),
+                '-o', 'ControlPersist={}'.format(control_persist),
+            ]
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _call(self, cmd, operation, input=None):
+        # logger.debug(' '.join(cmd))
+        t0 = time.monotonic()
+        try:
+            return sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True, input=input)
+        finally:
+            self._record(operation, time.monotonic() - t0)
+
+    def _record(self, operation, duration):
+        with self._lock:
+            m = self.metrics.setdefault(operation, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            m['count'] += 1
+            m['total'] += duration
+            m['max'] = max(m['max'], duration)
+            m['last'] = duration
+        logger.debug('{} on {} in {:.3f}s'.format(operation, self.ssh_arg, duration))
+
+    def run(self, command, operation='ssh', input=None):
+        """Run command on the remote host (input is sent to its stdin)
+
+        Returns:
+            output of the command (stdout and stderr)
+        """
+        return self._call(['ssh'] + self.options + [self.ssh_arg, command], operation, input=input)
+
+    def stream(self, command, operation='ssh', chunk_size=65536):
+        """Run command on the remote host and iterate over its output (stdout) by chunks
+
+        The first chunk is read before returning, so that a CalledProcessError is raised at once if the command
+        fails without output (e.g. file not found).
+        """
+        cmd = ['ssh'] + self.options + [self.ssh_arg, command]
+        t0 = time.monotonic()
+        proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+        first = proc.stdout.read1(chunk_size)
+        if not first:
+            stderr = proc.stderr.read()
+            if proc.wait() != 0:
+                self._record(operation, time.monotonic() - t0)
+                raise sp.CalledProcessError(proc.returncode, cmd, output=stderr.decode(errors='replace'))
+
+        def iter_output():
+            try:
+                if first:
+                    yield first
+                for chunk in iter(lambda: proc.stdout.read1(chunk_size), b''):
+                    yield chunk
+            finally:
+                proc.stdout.close()
+                proc.stderr.close()
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                self._record(operation, time.monotonic() - t0)
+
+        return iter_output()
+
+    def run_batch(self, commands, operation='ssh', input=None):
+        """Run several commands on the remote host in one round-trip, stop at the first command that fails
+
+        Returns:
+            output of the commands (stdout and stderr)
+        """
+        return self.run(' && '.join(commands), operation=operation, input=input)
+
+    def copy_to(self, local, remote, operation='scp', options=[]):
+        """Copy local file to remote path"""
+        cmd = ['scp'] + self.options + options + [local, '{}:{}'.format(self.ssh_arg, remote)]
+        return self._call(cmd, operation)
+
+    def copy_from(self, remote, local, operation='scp', options=[]):
+        """Copy remote path to local path"""
+        cmd = ['scp'] + self.options + options + ['{}:{}'.format(self.ssh_arg, remote), local]
+        return self._call(cmd, operation)
+
+    def get_metrics(self):
+        """Latency of each operation: count, mean, max and last duration in seconds"""
+        with self._lock:
+            return {
+                operation: {
+                    'count': m['count'],
+                    'mean': m['total'] / m['count'],
+                    'max': m['max'],
+                    'last': m['last'],
+                }
+                for operation, m in self.metrics.items()
+            }
+
+
+# SSH connections of the process, indexed by ssh_arg (user@host)
+_ssh_connections = {}
+_ssh_connections_lock = threading.Lock()
+
+
+def get_ssh_connection(ssh_arg):
+    """Get the SSHConnection of the process to ssh_arg, create it if needed (thread-safe)"""
+    with _ssh_connections_lock:
+        if ssh_arg not in _ssh_connections:
+            _ssh_connections[ssh_arg] = SSHConnection(ssh_arg)
+        return _ssh_connections[ssh_arg]
+
+
 # -------------
 # SLURM Manager class
 
@@ -444,6 +1246,7 @@ class SLURMManager(Manager):
         self.mail = SLURM_MAIL_USER
         self.ssh_arg = self.user + '@' + self.host
         self.ssh_arg_uws = LOCAL_USER + '@' + BASE_URL.split('://')[-1]
+        self.ssh = get_ssh_connection(self.ssh_arg)
         # PATHs
         self.scripts_path = SLURM_SCRIPTS_PATH
         self.jobdata_path = SLURM_JOBDATA_PATH
@@ -501,20 +1304,8 @@ class SLURMManager(Manager):
         Returns:
             process_id on SLURM server
         """
-        # Create jobdata and workdir (to upload the scripts, parameters and input files)
         jd = '{}/{}'.format(self.jobdata_path, job.jobid)
         wd = '{}/{}'.format(self.workdir_path, job.jobid)
-        cmd = ['ssh', self.ssh_arg,
-               'mkdir -p {jd}'.format(jd=jd)]
-        # logger.debug(' '.join(cmd))
-        try:
-            sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
-        except sp.CalledProcessError as e:
-            logger.warning('{}: {}'.format(e.cmd, e.output))
-            if 'File exists' in str(e.output):
-                logger.warning('force start {} {} (directories exist)'.format(job.jobname, job.jobid))
-            else:
-                raise
         get_input_files = []
         # Create parameter file
         param_file_local = '{}/{}_parameters.sh'.format(TEMP_PATH, job.jobid)
@@ -560,53 +1351,35 @@ class SLURMManager(Manager):
         with open(sbatch_file_local, 'w') as f:
             sbatch = self._make_sbatch(job, get_input_files=get_input_files)
             f.write('\n'.join(sbatch))
-        # Copy sbatch file to jobdata_path
-        cmd = ['scp',
-               sbatch_file_local,
-               '{}:{}'.format(self.ssh_arg, sbatch_file_distant)]
-        # logger.debug(' '.join(cmd))
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
-        # Start job using sbatch
-        cmd = ['ssh', self.ssh_arg,
-               'sbatch {}'.format(sbatch_file_distant)]
-        # logger.debug(' '.join(cmd))
-        process_out = str(sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True))
+        # Create jobdata_path, write sbatch file to jobdata_path and start job using sbatch, in one round-trip
+        process_out = self.ssh.run_batch([
+            'mkdir -p {jd}'.format(jd=jd),
+            'cat > {}'.format(sbatch_file_distant),
+            'sbatch {}'.format(sbatch_file_distant),
+        ], operation='start', input='\n'.join(sbatch))
         # Get process_id from output (e.g. "Submitted batch job 9421")
-        process_id = re.match('Submitted batch job ([0-9]*).*', process_out).group(1)
+        process_id = re.search('Submitted batch job ([0-9]*).*', process_out).group(1)
         # logger.debug(process_id)
         return process_id
 
     def abort(self, job):
         """Abort job on SLURM server"""
-        cmd = ['ssh', self.ssh_arg,
-               'scancel {}'.format(job.process_id)]
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+        self.ssh.run('scancel {}'.format(job.process_id), operation='abort')
 
     def delete(self, job):
         """Delete job on SLURM server"""
+        commands = []
         if job.phase not in ['COMPLETED', 'ERROR']:
-            cmd = ['ssh', self.ssh_arg,
-                   'scancel {}'.format(job.process_id)]
-            try:
-                sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
-            except sp.CalledProcessError as e:
-                logger.warning('{}: {}'.format(e.cmd, e.output))
-                if 'Invalid job id specified' in e.output:
-                    logger.warning('force delete {} {}'.format(job.jobname, job.jobid))
-                else:
-                    raise
-        # Delete workdir_path
-        cmd = ['ssh', self.ssh_arg,
-               'rm -rf {}/{}'.format(self.workdir_path, job.jobid)]
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
-        # Delete jobdata_path
-        cmd = ['ssh', self.ssh_arg,
-               'rm -rf {}/{}'.format(self.jobdata_path, job.jobid)]
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
-        # Delete results_path
-        cmd = ['ssh', self.ssh_arg,
-               'rm -rf {}/{}'.format(self.results_path, job.jobid)]
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+            # Continue if the job is not known anymore by SLURM ('Invalid job id specified')
+            commands.append(
+                'out=$(scancel {} 2>&1) || {{ echo "$out"; echo "$out" | grep -q "Invalid job id specified"; }}'
+                ''.format(job.process_id))
+        # Delete workdir_path, jobdata_path and results_path
+        commands.append('rm -rf {wd}/{jobid} {jd}/{jobid} {rs}/{jobid}'.format(
+            wd=self.workdir_path, jd=self.jobdata_path, rs=self.results_path, jobid=job.jobid))
+        output = self.ssh.run_batch(commands, operation='delete')
+        if 'Invalid job id specified' in output:
+            logger.warning('force delete {} {}'.format(job.jobname, job.jobid))
 
     def get_status(self, job):
         """Get job status (phase) from SLURM server
@@ -614,16 +1387,48 @@ class SLURMManager(Manager):
         Returns:
             job status (phase)
         """
-        cmd = ['ssh', self.ssh_arg,
-               'sacct -j {}'.format(job.process_id),
-               '-o state -P -n']
-        phase = sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+        phase = self.ssh.run('sacct -j {} -o state -P -n'.format(job.process_id), operation='get_status')
         # Take first line: there is a trailing \n in output, and possibly several lines
         phase = phase.split('\n')[0]
         if phase in PHASE_CONVERT:
             phase = PHASE_CONVERT[phase]['phase']
         return phase
 
+    def get_status_bulk(self, jobs, chunk_size=500):
+        """Get status (phase) of several jobs from SLURM server with one sacct call (per chunk_size jobs).
+        Jobs not yet known by sacct are looked for with squeue. Jobs not found are not returned.
+
+        Returns:
+            dictionary of job status (phase) indexed by jobid
+        """
+        phases = {}
+        jobs = [job for job in jobs if job.process_id]
+        for i in range(0, len(jobs), chunk_size):
+            chunk = jobs[i:i + chunk_size]
+            process_ids = ','.join(str(job.process_id) for job in chunk)
+            output = self.ssh.run(
+                'sacct -j {ids} -o jobid,state -P -n; squeue -h -j {ids} -o "%i|%T" 2>/dev/null || true'
+                ''.format(ids=process_ids),
+                operation='get_status_bulk')
+            # e.g. "9421|COMPLETED", "9421.batch|COMPLETED", "9422|CANCELLED by 1834"
+            states = {}
+            for line in output.splitlines():
+                if '|' not in line:
+                    continue
+                process_id, state = line.split('|', 1)
+                if '.' in process_id or process_id in states or not state:
+                    continue
+                states[process_id] = state.split()[0]
+            for job in chunk:
+                phase = states.get(str(job.process_id))
+                if phase is None:
+                    logger.warning('Status not found for job {} (process_id={})'.format(job.jobid, job.process_id))
+                    continue
+                if phase in PHASE_CONVERT:
+                    phase = PHASE_CONVERT[phase]['phase']
+                phases[job.jobid] = phase
+        return phases
+
     def get_info(self, job):
         """Get job info from SLURM server
 
@@ -631,14 +1436,24 @@ class SLURMManager(Manager):
             dictionary with info (jobid, start, end, elapsed, state)
         """
         # sacct -j 9000 -o jobid,start,end,elapsed,state -P -n
-        cmd = ['ssh', self.ssh_arg,
-               'sacct -j {}'.format(job.process_id),
-               '-o jobid,start,end,elapsed,state -P -n']
-        logger.debug(' '.join(cmd))
-        info = sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+        info = self.ssh.run('sacct -j {} -o jobid,start,end,elapsed,state -P -n'.format(job.process_id),
+                            operation='get_info')
         info_dict = info.split('|')
         return info_dict
 
+    def get_log(self, job, logname, offset=0, tail=None):
+        """Get a log (stdout or stderr) of a job from the SLURM server, read while the job is running
+
+        Returns:
+            iterator over the log content (bytes) from offset, or its last tail lines
+        """
+        path = '{}/{}/{}.log'.format(self.jobdata_path, job.jobid, logname)
+        if tail is not None:
+            command = 'tail -n {:d} {}'.format(tail, path)
+        else:
+            command = 'tail -c +{:d} {}'.format(offset + 1, path)
+        return self.ssh.stream(command, operation='get_log')
+
     def get_jobdata(self, job):
         """Get job results from SLURM server
 
@@ -646,26 +1461,21 @@ class SLURMManager(Manager):
             list of results?
         """
         # Retrieve jobdata (scripts used, stdout/err...)
-        cmd = ['scp', '-rp',
-               '{}:{}/{}'.format(self.ssh_arg, self.jobdata_path, job.jobid),
-               JOBDATA_PATH]
-        logger.debug(' '.join(cmd))
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+        self.ssh.copy_from('{}/{}'.format(self.jobdata_path, job.jobid), JOBDATA_PATH,
+                           operation='get_jobdata', options=['-rp'])
         # Retrieve results
         if COPY_RESULTS:
-            cmd = ['scp', '-rp',
-                   '{}:{}/{}'.format(self.ssh_arg, self.results_path, job.jobid),
-                   RESULTS_PATH]
-            logger.debug(' '.join(cmd))
             try:
-                sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+                self.ssh.copy_from('{}/{}'.format(self.results_path, job.jobid), RESULTS_PATH,
+                                   operation='get_results', options=['-rp'])
             except Exception as e:
                 logger.debug('Cannot get results for job {}'.format(job.jobid))
 
     def cp_script(self, jobname):
         """Copy job script to SLURM server"""
-        cmd = ['scp',
-               '{}/{}.sh'.format(SCRIPTS_PATH, jobname),
-               '{}:{}/{}.sh'.format(self.ssh_arg, self.scripts_path, jobname)]
-        logger.debug(' '.join(cmd))
-        sp.check_output(cmd, stderr=sp.STDOUT, universal_newlines=True)
+        self.ssh.copy_to('{}/{}.sh'.format(SCRIPTS_PATH, jobname), '{}/{}.sh'.format(self.scripts_path, jobname),
+                         operation='cp_script')
+
+    def get_metrics(self):
+        """Latency of the operations on the SLURM server (count, mean, max, last in seconds)"""
+        return self.ssh.get_metrics()
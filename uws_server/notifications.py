@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 by Mathieu Servillat
+# Licensed under MIT (https://github.com/mservillat/uws-server/blob/master/LICENSE)
+"""
+Defines the NotificationBus classes that send the job status changes to all the server processes
+(e.g. the processes of mod_wsgi), so that a WAIT request served by a process sees the changes
+handled by another one.
+
+The bus is selected with NOTIFICATION_BUS (see settings.py):
+* Local: within the server process only
+* PostgreSQL: LISTEN/NOTIFY on the PostgreSQL database of the server
+* Socket: Unix datagram sockets in NOTIFICATION_PATH, one per server process (e.g. with SQLite)
+
+In each process, the notifications (published by the process itself or received from the bus)
+are sent with the blinker signal 'job_status'.
+"""
+
+import time
+import uuid
+import socket
+import select
+import atexit
+import threading
+import blinker
+from .settings import *
+
+
+# -------------
+# NotificationBus classes
+
+
+class NotificationBus(object):
+    """
+    Base class of the notification buses, notifications are sent within the server process only.
+    Sub-classes send the notifications to the other processes in _send() and pass the messages
+    received from them to receive().
+    """
+
+    channel = 'opus_job_status'
+
+    def __init__(self):
+        # Identifies the messages sent by this process (already dispatched)
+        self.origin = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+
+    def publish(self, jobid, phase):
+        """Notify a job status change to all the server processes, including this one"""
+        self.dispatch(jobid, phase)
+        try:
+            self._send('{}\t{}\t{}'.format(self.origin, jobid, phase or ''))
+        except Exception as e:
+            # Other processes will see the change in storage (see WaitBroker)
+            logger.warning('{}: cannot publish status change of job {}: {}'.format(
+                self.__class__.__name__, jobid, e))
+
+    def _send(self, message):
+        pass
+
+    def receive(self, message):
+        """Dispatch a message received from another process"""
+        origin, jobid, phase = message.split('\t', 2)
+        if origin != self.origin:
+            logger.debug('{}: job {} is now {} (from {})'.format(self.__class__.__name__, jobid, phase, origin))
+            self.dispatch(jobid, phase or None)
+
+    def dispatch(self, jobid, phase):
+        """Send the status change within the process with the signal 'job_status'"""
+        return blinker.signal('job_status').send('change_status', sig_jobid=jobid, sig_phase=phase)
+
+    def close(self):
+        pass
+
+
+class LocalNotificationBus(NotificationBus):
+    """Notifications within the server process only (a single server process)"""
+    pass
+
+
+class SocketNotificationBus(NotificationBus):
+    """
+    Each server process binds a Unix datagram socket in the directory path, and sends its notifications
+    to the sockets of all the other processes. The sockets left by processes that ended are removed.
+    """
+
+    def __init__(self, path=NOTIFICATION_PATH):
+        super(SocketNotificationBus, self).__init__()
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.address = os.path.join(path, '{}.sock'.format(self.origin))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        self._thread = threading.Thread(target=self._run, name='SocketNotificationBus', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:
+                # Socket closed
+                break
+            try:
+                self.receive(data.decode('utf-8', errors='replace'))
+            except Exception as e:
+                logger.error('SocketNotificationBus: {}'.format(e))
+
+    def _send(self, message):
+        data = message.encode('utf-8')
+        for fname in os.listdir(self.path):
+            address = os.path.join(self.path, fname)
+            if address == self.address or not fname.endswith('.sock'):
+                continue
+            try:
+                # Do not block if the queue of the receiver is full
+                self.sock.sendto(data, socket.MSG_DONTWAIT, address)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket of a process that ended
+                try:
+                    os.remove(address)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                logger.warning('SocketNotificationBus: notification lost for {}: queue full'.format(fname))
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class PostgreSQLNotificationBus(NotificationBus):
+    """
+    Notifications are sent with NOTIFY on the PostgreSQL database of the server, and received by a thread
+    that LISTENs on a dedicated connection (reconnected if lost).
+    """
+
+    reconnect_interval = 5  # in seconds
+
+    def __init__(self, db_string=SQLALCHEMY_DB):
+        super(PostgreSQLNotificationBus, self).__init__()
+        from sqlalchemy import text
+        from . import storage
+        self._text = text
+        self.engine = storage.get_database(db_string).engine
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='PostgreSQLNotificationBus', daemon=True)
+        self._thread.start()
+
+    def _listen(self):
+        # Dedicated connection, detached from the pool (psycopg2)
+        conn = self.engine.raw_connection()
+        conn.detach()
+        dbapi_conn = conn.driver_connection
+        dbapi_conn.autocommit = True
+        with dbapi_conn.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(self.channel))
+        logger.debug('PostgreSQLNotificationBus: listening on {}'.format(self.channel))
+        try:
+            while not self._closed:
+                if select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    notify = dbapi_conn.notifies.pop(0)
+                    try:
+                        self.receive(notify.payload)
+                    except Exception as e:
+                        logger.error('PostgreSQLNotificationBus: {}'.format(e))
+        finally:
+            dbapi_conn.close()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning('PostgreSQLNotificationBus: connection lost ({}), reconnecting'.format(e))
+                time.sleep(self.reconnect_interval)
+
+    def _send(self, message):
+        with self.engine.begin() as conn:
+            conn.execute(self._text('SELECT pg_notify(:channel, :payload)'),
+                         dict(channel=self.channel, payload=message))
+
+    def close(self):
+        self._closed = True
+
+
+# Notification bus of the server process
+_notification_bus = None
+_notification_bus_lock = threading.Lock()
+
+
+def get_notification_bus():
+    """Get the NotificationBus of the process (see NOTIFICATION_BUS), create it if needed (thread-safe)"""
+    global _notification_bus
+    with _notification_bus_lock:
+        if _notification_bus is None:
+            _notification_bus = globals()[NOTIFICATION_BUS + 'NotificationBus']()
+            atexit.register(_notification_bus.close)
+    return _notification_bus
@@ -101,9 +101,36 @@ DESTRUCTION_INTERVAL = 30  # in days
 # Maximum and default execution duration, 0 implies unlimited execution duration
 EXECUTION_DURATION_DEF = 120  # in seconds
 EXECUTION_DURATION_MAX = 3600  # in seconds
+# Jobs still EXECUTING after start_time + execution_duration + margin are aborted (see DeadlineScheduler), opt-in:
+# jobs that do not set their execution duration then get EXECUTION_DURATION_DEF
+EXECUTION_DURATION_ENFORCE = False
+EXECUTION_DURATION_MARGIN = 10  # in seconds, time left to the job manager to end the job (e.g. SLURM --time)
 
 # Maximum wait time (UWS1.1)
 WAIT_TIME_MAX = 600  # in seconds
+WAIT_MAX_WAITERS = 10  # maximum number of blocked requests per server process, 0 for no limit
+WAIT_POLL_INTERVAL = 5  # in seconds, interval to read the phases of the waited jobs from storage
+
+# Server-Sent Events of a job (/rest/<jobname>/<jobid>/events), a stream lasts at most WAIT_TIME_MAX
+EVENTS_LOG_INTERVAL = 1  # in seconds, interval to read the new lines of stdout.log and stderr.log
+EVENTS_LOG_CHUNK_SIZE = 65536  # in bytes, maximum size of the log text sent in one event
+EVENTS_KEEPALIVE = 15  # in seconds, a comment is sent if no event was sent for this time
+EVENTS_MAX_STREAMS = 5  # maximum number of event streams per server process, 0 for no limit
+
+# Cache of users and roles in each server process (roles changed by another process are seen after the TTL)
+USER_CACHE_TTL = 60  # in seconds, 0 to disable the cache
+USER_CACHE_SIZE = 1000  # maximum number of users in the cache (least recently used are removed)
+
+# Job list: jobs are read from the database by chunks and streamed, or returned by pages if CURSOR is given
+JOBLIST_CHUNK_SIZE = 1000  # number of jobs read per query
+MAINTENANCE_CHUNK_SIZE = 500  # number of active jobs whose status is asked to the manager at once, then committed
+JOBLIST_PAGE_SIZE = 1000  # number of jobs per page (CURSOR parameter)
+
+# Inputs given as a URL are downloaded to UPLOADS_PATH by chunks (the hash of the entity is computed on the fly)
+INPUT_URL_MAX_SIZE = 10 * 1024**3  # in bytes, maximum size of an input downloaded by the server
+INPUT_URL_TIMEOUT = 600  # in seconds, maximum duration of a download
+INPUT_URL_CHUNK_SIZE = 1048576  # in bytes
+INPUT_URL_DEFER_SIZE = 0  # in bytes, larger inputs are downloaded by the job script instead (0: never deferred)
 
 # ARCHIVED phase (UWS1.1)
 USE_ARCHIVED_PHASE = True
@@ -116,6 +143,7 @@ COPY_RESULTS = True  # copy results from Manager to UWS server Archive (may be i
 
 # Algo for entity hash
 SHA_ALGO = '1'  # 1 (default), 224, 256, 384, 512
+HASH_CHUNK_SIZE = 1048576  # in bytes, size of the chunks read or written when the hash of a file is computed
 
 # Identifiers will be generated with the following functions
 JOB_ID_LENGTH = 6   # length of uuid identifiers from the right, max=36
@@ -147,6 +175,11 @@ ARCHIVE = 'Local'
 ARCHIVE_PATH = ''
 ARCHIVE_URL = '/store?ID={ID}'  # use {ID} for the identifier of the result, relative or full URL
 
+# Store the entity files once per hash in ENTITY_STORE_PATH, the files of the jobs are then hard links
+# (ENTITY_STORE_PATH should be on the same file system as UPLOADS_PATH and RESULTS_PATH)
+# With LOCAL_STAGING = 'hardlink', a job that modifies its input in place modifies it for all the jobs with this input
+USE_ENTITY_STORE = False
+
 
 ### Job Description Language (JDL) settings
 
@@ -197,6 +230,10 @@ PGSQL_PORT = 5432
 PGSQL_DATABASE = 'opus'
 PGSQL_USER = 'opus'
 PGSQL_PASSWORD = 'opus'
+# Connection pool shared by all the requests of a server process
+SQLALCHEMY_POOL_SIZE = 5  # connections kept open in the pool
+SQLALCHEMY_MAX_OVERFLOW = 10  # additional connections allowed when the pool is exhausted
+SQLALCHEMY_POOL_RECYCLE = 3600  # in seconds, connections older than this are replaced (-1 to disable)
 
 
 ### Manager settings
@@ -205,6 +242,41 @@ PGSQL_PASSWORD = 'opus'
 # SLURM: execution through a SLURM control manager (additional config required below)
 MANAGER = 'Local'
 LOCAL_WORKDIR_PATH = '/tmp'
+LOCAL_JOB_EVENTS_FIFO = True  # local jobs send events through a named pipe read by the server (else POST to /handler/job_event)
+# Staging of the uploaded input files to the working directory of a local job:
+# copy, reflink (copy-on-write, falls back to copy), hardlink (falls back to copy across devices; the job scripts
+# must not modify their input files), symlink (same), or auto (reflink if supported by the file system, else copy)
+LOCAL_STAGING = 'auto'
+# Admission of local jobs (see LocalScheduler): jobs stay QUEUED until a slot is free, 0 for no limit.
+# Limits of each server process, not of the whole deployment if the server runs several processes.
+LOCAL_MAX_JOBS = 0  # jobs executed at the same time
+LOCAL_MAX_JOBS_PER_USER = 0
+LOCAL_MAX_JOBS_PER_JOBNAME = 0
+LOCAL_CPUS = 0  # CPUs available for the jobs (PARAM cpus of the JDL, 1 by default), e.g. os.cpu_count()
+LOCAL_MEMORY = 0  # in MB, memory available for the jobs (PARAM memory of the JDL, e.g. 500mb or 2gb)
+# Limits (PARAM cpus and memory of the JDL) and accounting of local jobs with cgroups v2 (see JobCgroup)
+# cgroup delegated to the user of the server and in which it is started, e.g.
+# /sys/fs/cgroup/system.slice/opus.service ('' to disable): the server moves to LOCAL_CGROUP_PATH/server, the jobs
+# run in LOCAL_CGROUP_PATH/jobs/job_<jobid>
+LOCAL_CGROUP_PATH = ''
+LOCAL_CGROUP_CPU_WEIGHT = 50  # cpu.weight of LOCAL_CGROUP_PATH/jobs (100 by default, e.g. for the cgroup of the server)
+
+
+### Notification bus settings
+
+# Job status changes are sent to all the server processes (e.g. for WAIT requests), see notifications.py
+# Local: within the server process only (single server process)
+# PostgreSQL: LISTEN/NOTIFY on the database of the server (STORAGE_TYPE = 'PostgreSQL')
+# Socket: Unix datagram sockets in NOTIFICATION_PATH, one per server process (e.g. with SQLite)
+NOTIFICATION_BUS = 'Local'
+
+
+### HTTP client settings
+
+# Outbound requests of the server (job events, inputs given as URLs...), see http_client.py
+HTTP_POOL_SIZE = 10  # connections kept alive per host
+HTTP_CONNECT_TIMEOUT = 10  # in seconds
+HTTP_READ_TIMEOUT = 60  # in seconds, maximum time between two bytes received
 
 
 ### SLURM Manager settings
@@ -217,6 +289,8 @@ SLURM_JOBDATA_PATH = '/poubelle/vouws/jobdata'
 SLURM_UPLOADS_PATH = '/poubelle/vouws/uploads'
 SLURM_WORKDIR_PATH = '/scratch/vouws/workdir'
 SLURM_RESULTS_PATH = '/poubelle/vouws/results'
+SLURM_SSH_CONTROL_PATH = '~/.ssh/opus-%C'  # socket of the persistent ssh connection (%C: hash of host, port and user)
+SLURM_SSH_CONTROL_PERSIST = 600  # in seconds, idle time before the persistent ssh connection is closed (0 to disable)
 SLURM_SBATCH_DEFAULT = {
     'nodes': 1,
     'ntasks-per-node': 16,
@@ -408,8 +482,12 @@ JOBDATA_PATH = VAR_PATH + '/jobdata'
 RESULTS_PATH = VAR_PATH + '/results'
 # If POST contains files they are uploaded on the UWS server
 UPLOADS_PATH = VAR_PATH + '/uploads'
+# Files of the entities stored once per hash (see USE_ENTITY_STORE)
+ENTITY_STORE_PATH = VAR_PATH + '/entities'
 # Path for e.g. SLURM sbatch files created by SLURMManager
 TEMP_PATH = VAR_PATH + '/temp'
+# Sockets of the server processes for the Socket notification bus
+NOTIFICATION_PATH = TEMP_PATH + '/notifications'
 #--- Set all _PATH based on APP_PATH or VAR_PATH ---
 
 
@@ -486,6 +564,7 @@ for p in [VAR_PATH,
           LOCAL_WORKDIR_PATH,
           RESULTS_PATH,
           UPLOADS_PATH,
+          ENTITY_STORE_PATH,
           TEMP_PATH,
           JDL_PATH,
           JDL_PATH + '/votable',
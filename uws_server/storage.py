@@ -18,13 +18,22 @@ the number of database access (in the case of a relational database)
 """
 
 import datetime as dt
+import time
+import threading
+import collections
+import base64
 #from entity_store import *
 import hashlib
 from .settings import *
+from . import entity_store
 from sqlalchemy import create_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Column
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import relationship, joinedload, selectinload
+from sqlalchemy import Column, Index
+from sqlalchemy import inspect
+from sqlalchemy import select, update, or_, and_
 from sqlalchemy import ForeignKey, Float, String, Boolean, Integer, BigInteger, DateTime, Text
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.dialects import sqlite
@@ -39,6 +48,62 @@ class NotFoundWarning(Warning):
     pass
 
 
+# ----------
+# Cursor for the job list (keyset pagination on creation_time, jobid)
+
+
+def encode_cursor(creation_time, jobid):
+    """Return an opaque cursor pointing after the job (creation_time, jobid) in the job list"""
+    if isinstance(creation_time, dt.datetime):
+        creation_time = creation_time.strftime(DT_FMT)
+    key = '{}|{}'.format(creation_time, jobid)
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (creation_time, jobid) from a cursor given by encode_cursor(), raise ValueError if not valid"""
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        creation_time, jobid = key.split('|', 1)
+        dt.datetime.strptime(creation_time, DT_FMT)
+    except Exception:
+        raise ValueError('Bad cursor: {}'.format(cursor))
+    return creation_time, jobid
+
+
+# ----------
+# Entity hash
+
+
+def new_hash():
+    """Return a new hash object for the entities (see SHA_ALGO), to be updated e.g. while a file is written"""
+    return getattr(hashlib, 'sha' + SHA_ALGO)()
+
+
+class HashWriter(object):
+    """
+    File-like object that writes to fp and computes the hash of the data written (tee), so that the
+    hash of a file is known when it is saved, without reading it again, e.g.:
+        with open(path, 'wb') as fp:
+            writer = HashWriter(fp)
+            upload.save(writer, chunk_size=HASH_CHUNK_SIZE)
+        register_entity(..., hash=writer.hexdigest())
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha = new_hash()
+        self.size = 0
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
 # ---------
 # Storage classes
 
@@ -66,6 +131,26 @@ class JobStorage(object):
         """Get job list from storage"""
         pass
 
+    def iter_list(self, joblist, phase=None, where_owner=True, cursor=None):
+        """Iterate over the job list from storage, starting after the cursor"""
+        return iter(self.get_list(joblist, phase=phase, where_owner=where_owner))
+
+    def get_phases(self, jobids):
+        """Get the phase of the given jobs, as a dict {jobid: phase} (deleted jobs are missing)"""
+        pass
+
+    def get_process_ids(self, jobname, phases):
+        """Get the jobs of jobname in the given phases, as a list of dict with jobid, phase and process_id"""
+        pass
+
+    def get_deadlines(self, jobids=None):
+        """Get the EXECUTING jobs (all, or among jobids), as a dict {jobid: (jobname, start_time, execution_duration)}"""
+        pass
+
+    def claim_phase(self, jobid, phase, new_phase):
+        """Change the phase of the job to new_phase only if it is still phase, return True if changed"""
+        pass
+
 
 class UserStorage(object):
     """
@@ -110,16 +195,16 @@ class EntityStorage(object):
     Manage Entity storage.
     """
 
-    def get_hash(self, path):
+    def get_hash(self, path, buffer_size=HASH_CHUNK_SIZE):
         """Generate SHA hash for given file
         :param fname:
+        :param buffer_size: size of the chunks read
         :return: hax hash
         """
-        BUF_SIZE = 65536  # lets read stuff in 64kb chunks!
-        sha = getattr(hashlib, 'sha' + SHA_ALGO)()
+        sha = new_hash()
         with open(path, 'rb') as f:
             while True:
-                data = f.read(BUF_SIZE)
+                data = f.read(buffer_size)
                 if not data:
                     break
                 sha.update(data)
@@ -133,6 +218,10 @@ class EntityStorage(object):
         """Remove entity"""
         pass
 
+    def get_job_hashes(self, jobid):
+        """Return the hashes of the file entities generated or used by the job"""
+        return []
+
     def get_entity(self, entity_id):
         """Return all entity attributes"""
         pass
@@ -146,10 +235,24 @@ class EntityStorage(object):
 # SQLAlchemy
 
 
-class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
+class SQLAlchemyDatabase(object):
+    """
+    Engine, connection pool, declarative models and session registry for a given database.
+    It is created once per process and per db_string (see get_database()), then shared by all
+    the SQLAlchemyJobStorage objects.
+    """
 
     def __init__(self, db_string=SQLALCHEMY_DB):
-        self.engine = create_engine(db_string)  # , connect_args={'check_same_thread': False})
+        engine_kwargs = {}
+        if not db_string.endswith(':memory:'):
+            # In-memory SQLite uses a single connection, no pool to configure
+            engine_kwargs = dict(
+                pool_size=SQLALCHEMY_POOL_SIZE,
+                max_overflow=SQLALCHEMY_MAX_OVERFLOW,
+                pool_recycle=SQLALCHEMY_POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
+        self.engine = create_engine(db_string, **engine_kwargs)
         self.Base = declarative_base()
         # self.Base = automap_base()
         # dt_format = u'%(year)04d/%(month)02d/%(day)02dT%(hour)02d:%(min)02d:%(second)02d'
@@ -179,6 +282,14 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             owner_token = Column(String(128), nullable=True)
             run_id = Column(String(64), nullable=True)
             process_id = Column(BigInteger(), nullable=True)
+            __table_args__ = (
+                # get_list(): jobs of a user, or all jobs (admin), ordered by creation_time
+                Index('ix_jobs_jobname_owner', 'jobname', 'owner', 'owner_token', 'creation_time'),
+                Index('ix_jobs_jobname_phase', 'jobname', 'phase', 'creation_time'),
+                Index('ix_jobs_jobname_creation_time', 'jobname', 'creation_time'),
+                # read(from_process_id=True) for each job event
+                Index('ix_jobs_process_id', 'process_id'),
+            )
 
         class Parameter(self.Base):
             __tablename__ = 'job_parameters'
@@ -226,6 +337,10 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             result_value = Column(String(255), nullable=True)
             # derivation
             from_entity = Column(String(80), nullable=True)
+            __table_args__ = (
+                Index('ix_entities_hash', 'hash'),
+                Index('ix_entities_jobid', 'jobid', 'result_name'),
+            )
 
         class Used(self.Base):
             __tablename__ = 'used'
@@ -233,20 +348,236 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             jobid = Column(String(80), ForeignKey("jobs.jobid"), primary_key=True)  # uuid: max=36
             role = Column(String(255), nullable=True)
             owner = Column(String(64), nullable=True)
+            __table_args__ = (
+                Index('ix_used_jobid', 'jobid'),
+            )
+
+        # Relationships used to load a job with its parameters and results (read-only, rows are saved with merge)
+        Job.parameters = relationship(Parameter, viewonly=True)
+        Job.results = relationship(Result, viewonly=True)
+        Result.entity = relationship(Entity, viewonly=True)
 
         # self.Base.prepare(self.engine, reflect=True)
         self.Base.metadata.create_all(self.engine)
+        # Tables created by a previous version do not have all the indexes
+        self.create_indexes()
         self.Job = Job  # self.Base.classes.jobs
         self.Parameter = Parameter  # self.Base.classes.job_parameters
         self.Result = Result  # self.Base.classes.job_results
         self.User = User
         self.Entity = Entity
         self.Used = Used
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
+        # Sessions are thread-local, see remove_session() to release a session at the end of a request
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+
+    def create_indexes(self):
+        """Create the indexes declared in the models that are missing in the database (migration)"""
+        inspector = inspect(self.engine)
+        for table in self.Base.metadata.sorted_tables:
+            existing = [ix['name'] for ix in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                try:
+                    index.create(self.engine)
+                    logger.info('Index {} created on table {}'.format(index.name, table.name))
+                except Exception as e:
+                    # e.g. index created at the same time by another server process
+                    logger.warning('Index {} not created on table {}: {}'.format(index.name, table.name, e))
+
+
+# Databases already initialized in this process, indexed by db_string
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_string=SQLALCHEMY_DB):
+    """Get the SQLAlchemyDatabase shared by the process for db_string, create it if needed (thread-safe)"""
+    db = _databases.get(db_string)
+    if db is None:
+        with _databases_lock:
+            db = _databases.get(db_string)
+            if db is None:
+                db = SQLAlchemyDatabase(db_string)
+                _databases[db_string] = db
+                logger.debug('Database engine created for {}'.format(db.engine.url))
+    return db
+
+
+def remove_session():
+    """Close the session of the current thread, its connection goes back to the pool"""
+    for db in list(_databases.values()):
+        db.Session.remove()
+
+
+# ----------
+# Unit of work: within a request, changes are committed once, at the end of the request
+
+_unit_of_work = threading.local()
+
+
+def in_unit_of_work():
+    """True if a unit of work is open for the current thread (see begin_request())"""
+    return getattr(_unit_of_work, 'active', False)
+
+
+def begin_request():
+    """Open a unit of work for the current thread, storage commits are deferred to end_request()"""
+    _unit_of_work.active = True
+    _unit_of_work.on_commit = []
+    _unit_of_work.flushed = False
+
+
+def on_commit(func, *args, **kwargs):
+    """Call func once the current changes are committed (immediately if no unit of work is open)"""
+    if in_unit_of_work():
+        _unit_of_work.on_commit.append((func, args, kwargs))
+    else:
+        func(*args, **kwargs)
+
+
+def _run_on_commit():
+    callbacks = getattr(_unit_of_work, 'on_commit', [])
+    _unit_of_work.on_commit = []
+    for func, args, kwargs in callbacks:
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.warning('Callback after commit failed: {}'.format(e))
+
+
+def commit_session():
+    """Commit the changes of the current thread now, e.g. before a long wait or to keep an error state"""
+    for db in list(_databases.values()):
+        db.Session.commit()
+    _unit_of_work.flushed = False
+    _run_on_commit()
+
+
+def commit_flushed():
+    """Commit the changes already flushed by the current unit of work, if any, e.g. before a long transfer: the
+    write lock of the database (e.g. SQLite) is held from the first flush to the commit"""
+    if getattr(_unit_of_work, 'flushed', False):
+        commit_session()
+
+
+def end_request(commit=True):
+    """Close the unit of work of the current thread: commit (or rollback) once and release the session"""
+    try:
+        for db in list(_databases.values()):
+            if commit:
+                db.Session.commit()
+            else:
+                db.Session.rollback()
+        if commit:
+            _run_on_commit()
+    except Exception:
+        for db in list(_databases.values()):
+            db.Session.rollback()
+        raise
+    finally:
+        _unit_of_work.active = False
+        _unit_of_work.on_commit = []
+        _unit_of_work.flushed = False
+        remove_session()
+
+
+def dispose_databases():
+    """Close all sessions and connection pools, e.g. after a fork or to reset the process state"""
+    with _databases_lock:
+        for db in _databases.values():
+            db.Session.remove()
+            db.engine.dispose()
+        _databases.clear()
+
+
+# ----------
+# User cache: roles of the users known by the process, to avoid the user queries on each request
 
-    def __del__(self):
-        self.session.close()
+
+class UserCache(object):
+    """
+    Roles of users indexed by (name, token), kept for USER_CACHE_TTL seconds.
+    The least recently used users are removed when more than USER_CACHE_SIZE users are cached.
+    """
+
+    def __init__(self, ttl=USER_CACHE_TTL, size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._users = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, token):
+        """Get the roles of the user, or None if the user is not cached or has expired"""
+        if not self.ttl:
+            return None
+        key = (name, token)
+        with self._lock:
+            item = self._users.get(key)
+            if item is None:
+                return None
+            expires, roles = item
+            if expires < time.monotonic():
+                del self._users[key]
+                return None
+            self._users.move_to_end(key)
+            return list(roles)
+
+    def set(self, name, token, roles):
+        """Cache the roles of the user"""
+        if not self.ttl:
+            return
+        key = (name, token)
+        with self._lock:
+            self._users[key] = (time.monotonic() + self.ttl, tuple(roles))
+            self._users.move_to_end(key)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, name=None):
+        """Remove the user from the cache (whatever the token), or all users if name is None"""
+        with self._lock:
+            if name is None:
+                self._users.clear()
+            else:
+                for key in [k for k in self._users if k[0] == name]:
+                    del self._users[key]
+
+
+user_cache = UserCache()
+
+
+def invalidate_user(name=None):
+    """Remove the user from the cache now and once the current changes are committed"""
+    user_cache.invalidate(name)
+    # A concurrent request may cache the previous roles before the commit
+    on_commit(user_cache.invalidate, name)
+
+
+class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
+
+    def __init__(self, db_string=SQLALCHEMY_DB):
+        # Engine, models and pool are shared (created once per process)
+        db = get_database(db_string)
+        self.engine = db.engine
+        self.Base = db.Base
+        self.Job = db.Job
+        self.Parameter = db.Parameter
+        self.Result = db.Result
+        self.User = db.User
+        self.Entity = db.Entity
+        self.Used = db.Used
+        # scoped_session proxies the session of the current thread
+        self.Session = db.Session
+        self.session = db.Session
+
+    def _commit(self):
+        # Within a request, only flush: the unit of work is committed once by end_request()
+        if in_unit_of_work():
+            self.session.flush()
+            _unit_of_work.flushed = True
+        else:
+            self.session.commit()
 
     # ----------
     # UserStorage methods
@@ -274,7 +605,8 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
                 d['roles'] = roles
             u = self.User(**d)
             self.session.merge(u)
-            self.session.commit()
+            self._commit()
+            invalidate_user(name)
             logger.info('User {} added to db'.format(name))
         # else:
         #     logger.info('User {} already exists in db'.format(name))
@@ -282,17 +614,22 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
     def remove_user(self, name):
         """Remove user from storage"""
         self.session.query(self.User).filter_by(name=name).delete()
-        self.session.commit()
+        self._commit()
+        invalidate_user(name)
         logger.info('User {} removed from db'.format(name))
 
     def update_user(self, name, key, value):
         """Update user attribute"""
         row = self.session.query(self.User).filter_by(name=name).first()
         setattr(row, key, value)
-        self.session.commit()
+        self._commit()
+        invalidate_user(name)
         logger.debug('User {} updated: {}={}'.format(name, key, value))
 
     def get_roles(self, user):
+        roles = user_cache.get(user.name, user.token)
+        if roles is not None:
+            return roles
         row = self.session.query(self.User).filter_by(name=user.name, token=user.token).first()
         roles = []
         if row:
@@ -307,7 +644,8 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             roles.append(role)
             row.roles = ','.join(roles)
             self.session.merge(row)
-            self.session.commit()
+            self._commit()
+            invalidate_user(name)
             logger.debug('Role \"{}\" added for user {}'.format(role, name))
         else:
             logger.debug('Role \"{}\" already set for user {}'.format(role, name))
@@ -317,18 +655,22 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
         row = self.session.query(self.User).filter_by(name=name, token=token).first()
         roles = row.roles.split(',')
         if role in roles:
-            roles.pop(role)
+            roles.remove(role)
             row.roles = ','.join(roles)
             self.session.merge(row)
-            self.session.commit()
+            self._commit()
+            invalidate_user(name)
             logger.debug('Role \"{}\" removed for user {}'.format(role, name))
         else:
             logger.debug('Role \"{}\" not found for user {}'.format(role, name))
 
     def has_role(self, name, token, role=''):
-        row = self.session.query(self.User).filter_by(name=name, token=token).first()
-        if row:
-            roles = row.roles.split(',')
+        roles = user_cache.get(name, token)
+        if roles is None:
+            row = self.session.query(self.User).filter_by(name=name, token=token).first()
+            if row:
+                roles = row.roles.split(',')
+        if roles is not None:
             if ('all' in roles) or (role in roles):
                 # logger.debug('Role \"{}\" found for user {}:{}'.format(role, name, token))
                 return True
@@ -379,70 +721,72 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             d = {col: job.__dict__[col] for col in JOB_ATTRIBUTES}
             j = self.Job(**d)
             self.session.merge(j)
-            self.session.commit()
         if save_parameters:
             if isinstance(save_parameters, str):
                 # Save the given job parameter to db
                 pname = save_parameters
                 self._save_parameter(job, pname)
-                self.session.commit()
             else:
                 # Save all job parameters to db
                 for pname in list(job.parameters.keys()):
                     self._save_parameter(job, pname)
-                self.session.commit()
         if save_results:
             # Save job results to db
             for rname in list(job.results.keys()):
                 self._save_result(job, rname)
-            self.session.commit()
+        # Commit once for attributes, parameters and results
+        self._commit()
 
     def read(self, job, get_attributes=True, get_parameters=True, get_results=True,
              from_process_id=False):
-        """Read job information from storage"""
-        if get_attributes:
+        """Read job information from storage
+
+        The job row and its parameters are loaded in one query (joined), the results with their
+        entities in a second one (selectin), instead of one query per result.
+        """
+        query = self.session.query(self.Job)
+        if from_process_id:
+            # Query db for jobname and jobid using process_id
+            query = query.filter_by(process_id=job.process_id)
+        else:
+            query = query.filter_by(jobid=job.jobid)
+        if get_parameters:
+            query = query.options(joinedload(self.Job.parameters))
+        if get_results:
+            query = query.options(selectinload(self.Job.results).joinedload(self.Result.entity))
+        # Refresh rows (and collections) that may already be in the session
+        row = query.execution_options(populate_existing=True).first()
+        if not row:
             if from_process_id:
-                # Query db for jobname and jobid using process_id
-                row = self.session.query(self.Job).filter_by(process_id=job.process_id).first()
-                if not row:
-                    raise NotFoundWarning('Job with process_id={} NOT FOUND'.format(job.process_id))
-                # job.jobname = row.jobname
-                # job.jobid = row.jobid
-            else:
-                row = self.session.query(self.Job).filter_by(jobid=job.jobid).first()
-                if not row:
-                    raise NotFoundWarning('Job "{}" NOT FOUND'.format(job.jobid))
+                raise NotFoundWarning('Job with process_id={} NOT FOUND'.format(job.process_id))
+            raise NotFoundWarning('Job "{}" NOT FOUND'.format(job.jobid))
+        if get_attributes:
             for k in JOB_ATTRIBUTES:
                 if k in list(row.__dict__.keys()):
                     job.__dict__[k] = row.__dict__[k]
         if get_parameters:
-            # Query db for job parameters
-            params = self.session.query(self.Parameter).filter_by(jobid=job.jobid).all()
             # Format results to a parameter dict
             params_dict = {
-                row.name: {
-                    'value': row.value,
-                    'byref': row.byref,
-                    'entity_id': row.entity_id,
+                prow.name: {
+                    'value': prow.value,
+                    'byref': prow.byref,
+                    'entity_id': prow.entity_id,
                 }
-                for row in params
+                for prow in row.parameters
             }
             job.parameters = params_dict
         else:
             job.parameters = {}
         if get_results:
-            # Query db for job results
-            results = self.session.query(self.Result).filter_by(jobid=job.jobid).all()
             results_dict = {}
-            for rrow in results:
+            for rrow in row.results:
                 rrow_dict = {
                     'url': rrow.url,
                     'content_type': rrow.content_type,
                     'entity_id': rrow.entity_id,
                 }
-                entity = self.session.query(self.Entity).filter_by(entity_id=rrow.entity_id).first()
+                entity = rrow.entity
                 if entity:
-                    logger.debug(entity)
                     rrow_dict['file_name'] = entity.entity_id + '_' + entity.file_name
                     rrow_dict['hash'] = entity.hash
                 results_dict[rrow.name] = rrow_dict
@@ -455,26 +799,130 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
         self.session.query(self.Parameter).filter_by(jobid=job.jobid).delete()
         self.session.query(self.Result).filter_by(jobid=job.jobid).delete()
         self.session.query(self.Job).filter_by(jobid=job.jobid).delete()
-        self.session.commit()
+        self._commit()
 
-    def get_list(self, joblist, phase=None, after=None, last=None, where_owner=True, include_archived=False):
+    def get_list(self, joblist, phase=None, after=None, last=None, where_owner=True, include_archived=False,
+                 cursor=None, descending=False):
         """Get job list from storage"""
-        query = self.session.query(self.Job).filter_by(jobname=joblist.jobname)
+        return list(self.iter_list(joblist, phase=phase, after=after, last=last, where_owner=where_owner,
+                                   include_archived=include_archived, cursor=cursor, descending=descending))
+
+    def iter_list(self, joblist, phase=None, after=None, last=None, where_owner=True, include_archived=False,
+                  cursor=None, descending=False, chunk_size=JOBLIST_CHUNK_SIZE, columns=()):
+        """Iterate over the job list from storage, ordered by (creation_time, jobid)
+
+        Jobs are fetched by chunks of chunk_size rows, each chunk starting after the last job of the previous one
+        (keyset pagination), so that memory use does not depend on the number of jobs. Outside of a unit of work,
+        e.g. when the response is streamed after the end of the request, each chunk uses a connection from the
+        pool instead of the session. The cursor (see encode_cursor()) gives the job after which the list starts.
+
+        after (datetime or string in DT_FMT) keeps the jobs created strictly after this time, last (int) limits the
+        number of jobs returned. With descending=True, the most recent jobs come first, so that the last N jobs
+        are read from the end of the index (UWS 1.1 LAST parameter). Other attributes of the jobs may be read with
+        columns (e.g. ['start_time', 'end_time']).
+        """
+        Job = self.Job
+        query = select(Job.jobid, Job.phase, Job.run_id, Job.owner, Job.creation_time,
+                       *[getattr(Job, column) for column in columns]).where(Job.jobname == joblist.jobname)
         if phase:
-            query = query.filter(self.Job.phase.in_(phase))
+            query = query.where(Job.phase.in_(phase))
         elif not include_archived:
-            query = query.filter(self.Job.phase.notin_(["ARCHIVED"]))
+            query = query.where(Job.phase.notin_(["ARCHIVED"]))
         if after:
-            query = query.filter(self.Job.creation_time >= after)
+            if isinstance(after, dt.datetime):
+                after = after.strftime(DT_FMT)
+            query = query.where(Job.creation_time > after)
         if where_owner:
-            query = query.filter_by(owner=joblist.user.name)
-            query = query.filter_by(owner_token=joblist.user.token)
-        query = query.order_by(self.Job.creation_time.asc())
-        if last:
-            query = query.limit(last)
-        jobs = query.all()
-        djobs = [job.__dict__ for job in jobs]
-        return djobs
+            query = query.where(Job.owner == joblist.user.name, Job.owner_token == joblist.user.token)
+        if descending:
+            query = query.order_by(Job.creation_time.desc(), Job.jobid.desc())
+        else:
+            query = query.order_by(Job.creation_time.asc(), Job.jobid.asc())
+        key = decode_cursor(cursor) if cursor else None
+        remaining = int(last) if last else None
+        while remaining is None or remaining > 0:
+            limit = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk_query = query
+            if key and descending:
+                chunk_query = chunk_query.where(or_(
+                    Job.creation_time < key[0],
+                    and_(Job.creation_time == key[0], Job.jobid < key[1]),
+                ))
+            elif key:
+                chunk_query = chunk_query.where(or_(
+                    Job.creation_time > key[0],
+                    and_(Job.creation_time == key[0], Job.jobid > key[1]),
+                ))
+            if in_unit_of_work():
+                # Within a request, see the changes of the request
+                rows = [dict(row) for row in self.session.execute(chunk_query.limit(limit)).mappings()]
+            else:
+                with self.engine.connect() as conn:
+                    rows = [dict(row) for row in conn.execute(chunk_query.limit(limit)).mappings()]
+            for row in rows:
+                yield row
+            if len(rows) < limit:
+                break
+            key = (rows[-1]['creation_time'], rows[-1]['jobid'])
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def get_phases(self, jobids, chunk_size=JOBLIST_CHUNK_SIZE):
+        """Get the phase of the given jobs, as a dict {jobid: phase} (deleted jobs are missing)
+
+        Used outside of the requests (e.g. by the WaitBroker thread), so a connection from the pool is used.
+        """
+        jobids = list(jobids)
+        phases = {}
+        with self.engine.connect() as conn:
+            for i in range(0, len(jobids), chunk_size):
+                query = select(self.Job.jobid, self.Job.phase).where(self.Job.jobid.in_(jobids[i:i + chunk_size]))
+                phases.update(conn.execute(query).all())
+        return phases
+
+    def get_process_ids(self, jobname, phases):
+        """Get the jobs of jobname in the given phases, as a list of dict with jobid, phase and process_id
+
+        Only those columns are read, e.g. to get the status of the active jobs from the manager at once.
+        """
+        query = select(self.Job.jobid, self.Job.phase, self.Job.process_id).where(
+            self.Job.jobname == jobname, self.Job.phase.in_(phases))
+        if in_unit_of_work():
+            return [dict(row) for row in self.session.execute(query).mappings()]
+        with self.engine.connect() as conn:
+            return [dict(row) for row in conn.execute(query).mappings()]
+
+    def get_deadlines(self, jobids=None, chunk_size=JOBLIST_CHUNK_SIZE):
+        """Get the EXECUTING jobs (all, or among jobids), as a dict {jobid: (jobname, start_time, execution_duration)}
+
+        Used outside of the requests (by the DeadlineScheduler thread), so a connection from the pool is used.
+        """
+        deadlines = {}
+        columns = (self.Job.jobid, self.Job.jobname, self.Job.start_time, self.Job.execution_duration)
+        with self.engine.connect() as conn:
+            if jobids is None:
+                query = select(*columns).where(self.Job.phase == 'EXECUTING')
+                rows = conn.execute(query).all()
+            else:
+                jobids = list(jobids)
+                rows = []
+                for i in range(0, len(jobids), chunk_size):
+                    query = select(*columns).where(self.Job.phase == 'EXECUTING',
+                                                   self.Job.jobid.in_(jobids[i:i + chunk_size]))
+                    rows.extend(conn.execute(query).all())
+        for jobid, jobname, start_time, execution_duration in rows:
+            deadlines[jobid] = (jobname, start_time, execution_duration)
+        return deadlines
+
+    def claim_phase(self, jobid, phase, new_phase):
+        """Change the phase of the job to new_phase only if it is still phase, return True if changed
+
+        The conditional update is committed at once in its own transaction, so that among several server processes
+        (or threads) only one gets True, e.g. to abort a job once.
+        """
+        query = update(self.Job).where(self.Job.jobid == jobid, self.Job.phase == phase).values(phase=new_phase)
+        with self.engine.begin() as conn:
+            return conn.execute(query).rowcount == 1
 
     # ----------
     # EntityStorage methods
@@ -505,6 +953,11 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
                 full_path = os.path.join(kwargs['file_dir'], kwargs['file_name'])
                 if os.path.isfile(full_path):
                     kwargs['hash'] = self.get_hash(full_path)
+            # Store the file once per hash (the file becomes a hard link to the blob)
+            if USE_ENTITY_STORE and kwargs.get('hash'):
+                full_path = os.path.join(kwargs['file_dir'], kwargs['file_name'])
+                if os.path.isfile(full_path):
+                    entity_store.get_entity_store().add(full_path, kwargs['hash'])
 
             # Check if file already exists --> first hash, then test if filename contains entity_id or jobid if found
             if 'hash' in kwargs:
@@ -571,7 +1024,7 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             role = kwargs.pop('used_role', None)
             used = self.Used(entity_id=entity_id, jobid=jobid, role=role, owner=kwargs['owner'])
             self.session.merge(used)
-            self.session.commit()
+            self._commit()
             logger.info('Adding Used relation for file_name={} (entity_id={}, jobid={})'.format(kwargs['file_name'], entity_id, jobid))
 
         # Register new entity
@@ -587,7 +1040,7 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
             # Store info in DB
             e = self.Entity(**kwargs)
             self.session.merge(e)
-            self.session.commit()
+            self._commit()
             # Return entity attributes
             logger.info('New entity registered: {}'.format(str(kwargs)))
             return kwargs
@@ -605,7 +1058,14 @@ class SQLAlchemyJobStorage(JobStorage, UserStorage, EntityStorage):
         elif jobid:
             self.session.query(self.Entity).filter_by(jobid=jobid).delete()
             self.session.query(self.Used).filter_by(jobid=jobid).delete()
-        self.session.commit()
+        self._commit()
+
+    def get_job_hashes(self, jobid):
+        """Return the hashes of the file entities generated or used by the job"""
+        generated = select(self.Entity.hash).where(self.Entity.jobid == jobid, self.Entity.hash.isnot(None))
+        used = select(self.Entity.hash).join(self.Used, self.Used.entity_id == self.Entity.entity_id).where(
+            self.Used.jobid == jobid, self.Entity.hash.isnot(None))
+        return sorted(set(self.session.execute(generated.union(used)).scalars()))
 
     def get_entity(self, entity_id, silent=False):
         """Return all entity attributes"""
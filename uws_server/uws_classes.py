@@ -8,8 +8,10 @@ Defines classes for UWS objects job and job_list
 
 import shutil
 import urllib.request, urllib.parse, urllib.error
-import requests
 import re
+import time
+import heapq
+import threading
 import datetime as dt
 import xml.etree.ElementTree as ETree
 import yaml
@@ -17,6 +19,9 @@ from blinker import signal
 from . import uws_jdl
 from . import storage
 from . import managers
+from . import notifications
+from . import http_client
+from . import entity_store
 from .settings import *
 
 
@@ -47,14 +52,14 @@ def is_downloadable(url):
     """
     Does the url contain a downloadable resource
     """
-    h = requests.head(url, allow_redirects=True)
+    h = http_client.get_http_client().head(url, allow_redirects=True)
     header = h.headers
     content_type = header.get('content-type')
     if 'html' in content_type.lower():
         logger.warning('Found HTML page, nothing to download')
         return False
     content_length = header.get('content-length', None)
-    if content_length and content_length > 2e8:  # 200 mb approx
+    if content_length and INPUT_URL_MAX_SIZE and int(content_length) > INPUT_URL_MAX_SIZE:
         logger.warning('File is too large to be downloaded')
         return False
     return True
@@ -72,6 +77,53 @@ def get_filename_from_cd(cd):
     return fname[0]
 
 
+def get_filename_from_url(url):
+    """
+    Get filename from the path of the url
+    """
+    return os.path.basename(urllib.parse.urlparse(url).path)
+
+
+def save_upload(upload, path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Save a file uploaded from a form (bottle FileUpload) to path, and return its hash computed while the file
+    is written (see storage.HashWriter). Raise IOError if the file exists.
+    """
+    with open(path, 'xb') as f:
+        writer = storage.HashWriter(f)
+        upload.save(writer, chunk_size=chunk_size)
+    return writer.hexdigest()
+
+
+def download_response(response, path, max_size=INPUT_URL_MAX_SIZE, timeout=INPUT_URL_TIMEOUT,
+                      chunk_size=INPUT_URL_CHUNK_SIZE):
+    """
+    Write the body of a streamed response to path by chunks, and return its hash (see storage.HashWriter).
+    Raise UserWarning if the body is larger than max_size or if the download lasts more than timeout (in seconds),
+    the partial file is then removed.
+    """
+    content_length = response.headers.get('content-length')
+    if max_size and content_length and int(content_length) > max_size:
+        raise UserWarning('file is too large ({} bytes, maximum is {})'.format(content_length, max_size))
+    t0 = time.time()
+    part_path = path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            writer = storage.HashWriter(f)
+            for chunk in response.iter_content(chunk_size):
+                if max_size and writer.size + len(chunk) > max_size:
+                    raise UserWarning('file is too large (maximum is {} bytes)'.format(max_size))
+                if timeout and time.time() - t0 > timeout:
+                    raise UserWarning('download lasts more than {}s'.format(timeout))
+                writer.write(chunk)
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return writer.hexdigest()
+
+
 # ---------
 # User class
 
@@ -132,6 +184,252 @@ def check_owner(job):
                 raise JobAccessDenied('User {} is not the owner of the job'.format(job.user.name))
 
 
+def send_status_signal(jobid, phase):
+    """Signal a job status change to all the server processes (e.g. to a WAIT command expecting signal)"""
+    notifications.get_notification_bus().publish(jobid, phase)
+
+
+# ---------
+# WAIT broker
+
+
+class WaitBroker(object):
+    """
+    Waiters of the UWS 1.1 blocking behaviour (WAIT), woken up when the phase of their job changes.
+
+    Waiters are indexed by jobid, so a status change only wakes the waiters of its job. A status change is received
+    from the job_status signal of this process, sent for the changes of all the server processes by the notification
+    bus (see notifications.py). A single thread also reads the phases of all the waited jobs from storage every
+    poll_interval seconds, in one query, so that changes are seen even if the bus is Local or a notification is lost.
+    The number of waiters is bounded by max_waiters (0 for no limit). Above this limit, wait() returns at once,
+    so that waiting clients cannot hold all the threads of the WSGI server.
+    """
+
+    def __init__(self, max_waiters=WAIT_MAX_WAITERS, poll_interval=WAIT_POLL_INTERVAL):
+        self.max_waiters = max_waiters
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        # {jobid: {event: phase}}
+        self.waiters = {}
+        self.n_waiters = 0
+        self.thread = None
+        self.closed = threading.Event()
+        self.storage = getattr(storage, STORAGE + 'JobStorage')()
+        signal('job_status').connect(self._receive, weak=False)
+
+    def _receive(self, sender, **kw):
+        self.notify(kw.get('sig_jobid'), kw.get('sig_phase'))
+
+    def count(self):
+        """Number of waiters"""
+        with self.lock:
+            return self.n_waiters
+
+    def notify(self, jobid, phase):
+        """Wake up the waiters of jobid that wait for a phase change (phase=None if the job was deleted)"""
+        with self.lock:
+            for event, waited_phase in self.waiters.get(jobid, {}).items():
+                if phase != waited_phase:
+                    event.set()
+
+    def wait(self, jobid, phase, timeout):
+        """Wait until the job is not in phase anymore, return True if it changed, False on timeout, None if too busy"""
+        event = threading.Event()
+        with self.lock:
+            if self.max_waiters and self.n_waiters >= self.max_waiters:
+                logger.warning('{}: Too many waiters ({}), WAIT ignored'.format(jobid, self.n_waiters))
+                return None
+            self.waiters.setdefault(jobid, {})[event] = phase
+            self.n_waiters += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='WaitBroker', daemon=True)
+                self.thread.start()
+        try:
+            return event.wait(timeout)
+        finally:
+            with self.lock:
+                del self.waiters[jobid][event]
+                if not self.waiters[jobid]:
+                    del self.waiters[jobid]
+                self.n_waiters -= 1
+
+    def poll(self):
+        """Read the phases of the waited jobs from storage and wake up the waiters of the jobs that changed"""
+        with self.lock:
+            jobids = list(self.waiters)
+        if not jobids:
+            return
+        phases = self.storage.get_phases(jobids)
+        for jobid in jobids:
+            self.notify(jobid, phases.get(jobid))
+
+    def _run(self):
+        while not self.closed.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning('Cannot poll the phases of the waited jobs: {}'.format(e))
+
+    def close(self):
+        """Stop receiving the status changes and stop the thread"""
+        signal('job_status').disconnect(self._receive)
+        self.closed.set()
+
+
+# WaitBroker of the server process
+_wait_broker = None
+_wait_broker_lock = threading.Lock()
+
+
+def get_wait_broker():
+    """Get the WaitBroker of the process, create it if needed (thread-safe)"""
+    global _wait_broker
+    with _wait_broker_lock:
+        if _wait_broker is None:
+            _wait_broker = WaitBroker()
+    return _wait_broker
+
+
+class DeadlineScheduler(object):
+    """
+    Deadlines of the EXECUTING jobs (start_time + execution_duration + margin), to abort the jobs that overrun.
+
+    The deadlines are kept in a heap, so adding a job or getting the next deadline is O(log n) whatever the number of
+    running jobs, and a single thread sleeps until the next deadline, then calls on_expire(jobid, jobname) for each
+    job overrun. The deadlines are read from storage: for all the EXECUTING jobs when the thread starts (e.g. after a
+    restart of the server), then for each job that becomes EXECUTING (job_status signal, sent for the changes of all
+    the server processes by the notification bus). An entry of the heap is ignored when the job is not EXECUTING
+    anymore, or if its deadline changed. A job with execution_duration = 0 has no deadline.
+    """
+
+    retry_interval = 5  # in seconds, if storage cannot be read
+
+    def __init__(self, on_expire, margin=EXECUTION_DURATION_MARGIN):
+        self.on_expire = on_expire
+        self.margin = margin
+        self.condition = threading.Condition()
+        # Heap of (deadline, jobid), and {jobid: (deadline, jobname)} for the current deadlines
+        self.heap = []
+        self.deadlines = {}
+        # Jobs to read from storage (None to read all the EXECUTING jobs)
+        self.pending = None
+        self.thread = None
+        self.stopped = False
+        self.storage = getattr(storage, STORAGE + 'JobStorage')()
+        signal('job_status').connect(self._receive, weak=False)
+
+    def _receive(self, sender, **kw):
+        jobid = kw.get('sig_jobid')
+        with self.condition:
+            if kw.get('sig_phase') == 'EXECUTING':
+                if self.pending is not None:
+                    self.pending.add(jobid)
+                    self.condition.notify()
+            else:
+                # The entry left in the heap is ignored
+                self.deadlines.pop(jobid, None)
+
+    def count(self):
+        """Number of jobs with a deadline"""
+        with self.condition:
+            return len(self.deadlines)
+
+    def start(self):
+        """Start the thread, that first reads the deadlines of all the EXECUTING jobs"""
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='DeadlineScheduler', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout=5):
+        """Disconnect from the job_status signal and stop the thread"""
+        signal('job_status').disconnect(self._receive)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def set_deadline(self, jobid, jobname, deadline):
+        """Set the deadline of a job (timestamp), or remove it if deadline is None"""
+        with self.condition:
+            if deadline is None:
+                self.deadlines.pop(jobid, None)
+                return
+            self.deadlines[jobid] = (deadline, jobname)
+            heapq.heappush(self.heap, (deadline, jobid))
+            if self.heap[0][1] == jobid:
+                # New next deadline
+                self.condition.notify()
+
+    def load(self, jobids=None):
+        """Read the deadlines of the EXECUTING jobs from storage (all, or among jobids)"""
+        deadlines = self.storage.get_deadlines(jobids)
+        for jobid, (jobname, start_time, execution_duration) in deadlines.items():
+            deadline = None
+            if start_time and execution_duration:
+                if not isinstance(start_time, dt.datetime):
+                    start_time = dt.datetime.strptime(start_time, DT_FMT)
+                deadline = start_time.timestamp() + execution_duration + self.margin
+            self.set_deadline(jobid, jobname, deadline)
+        for jobid in set(jobids or []) - set(deadlines):
+            self.set_deadline(jobid, None, None)
+
+    def pop_expired(self, now):
+        """Remove the deadlines reached at timestamp now, return the list of (jobid, jobname) of the jobs overrun"""
+        expired = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, jobid = heapq.heappop(self.heap)
+                if self.deadlines.get(jobid, (None,))[0] == deadline:
+                    expired.append((jobid, self.deadlines.pop(jobid)[1]))
+        return expired
+
+    def _wait(self):
+        """Wait for jobs to read from storage or for the next deadline, return the jobs to read (None for all)"""
+        with self.condition:
+            while self.pending == set() and not self.stopped:
+                timeout = self.heap[0][0] - time.time() if self.heap else None
+                if timeout is not None and timeout <= 0:
+                    break
+                self.condition.wait(timeout)
+            jobids, self.pending = self.pending, set()
+        return jobids
+
+    def _run(self):
+        while not self.stopped:
+            jobids = self._wait()
+            if self.stopped:
+                return
+            if jobids is None or jobids:
+                try:
+                    self.load(jobids)
+                except Exception as e:
+                    logger.warning('Cannot read the deadlines of the EXECUTING jobs: {}'.format(e))
+                    with self.condition:
+                        self.pending = None if jobids is None else self.pending | jobids
+                    time.sleep(self.retry_interval)
+            for jobid, jobname in self.pop_expired(time.time()):
+                try:
+                    self.on_expire(jobid, jobname)
+                except Exception as e:
+                    logger.warning('Cannot abort job {} {} after its execution duration: {}'.format(jobname, jobid, e))
+
+
+# DeadlineScheduler of the server process
+_deadline_scheduler = None
+_deadline_scheduler_lock = threading.Lock()
+
+
+def get_deadline_scheduler(on_expire=None):
+    """Get the DeadlineScheduler of the process, create it with on_expire if needed (thread-safe)"""
+    global _deadline_scheduler
+    with _deadline_scheduler_lock:
+        if _deadline_scheduler is None:
+            _deadline_scheduler = DeadlineScheduler(on_expire)
+    return _deadline_scheduler
+
+
 def upper2underscore(inputstring):
     return ''.join('_' + char.lower() if char.isupper() else char for char in inputstring).lstrip('_')
 
@@ -298,12 +596,16 @@ class Job(object):
                     pname = upper2underscore(pname.split('uws_')[-1])  # remove the prefix uws_ to update the class attribute
                     #self.parameters[pname] = {'value': value, 'byref': False}
                     setattr(self, pname, value)
-        # Save job as is for now
-        self.storage.save(self, save_attributes=True, save_parameters=True)
+        # Transfer the input files before the first write to storage: the write lock of the database (e.g. SQLite)
+        # is then not held during the uploads and downloads. Changes made so far (e.g. new user) are committed.
+        storage.commit_flushed()
         # Search input entities in POST/files
         upload_dir = os.path.join(UPLOADS_PATH, self.jobid)
+        # {pname: (value, file_name, file_hash, content_type)}, file_name is None if no file was transferred
+        inputs = {}
         for pname in self.jdl.content.get('used', {}):
-            entity = {}
+            file_name = None
+            file_hash = None
             content_type = self.jdl.content['used'][pname].get('content_type', None)
             if pname in list(files.keys()):
                 # 1/ Parameter is a file from the form
@@ -311,23 +613,11 @@ class Job(object):
                 f = files[pname]
                 if not os.path.isdir(upload_dir):
                     os.makedirs(upload_dir)
-                f.save(os.path.join(upload_dir, f.filename))
+                # The hash is computed while the file is written
+                file_hash = save_upload(f, os.path.join(upload_dir, f.filename))
+                file_name = f.filename
                 # value = f.filename
                 logger.info('Input "{}" is a file and was downloaded ({})'.format(pname, f.filename))
-                # Check if file already exists in entity store (hash + ID in name or jobid) and add in Used table
-                entity = self.storage.register_entity(
-                    file_name=f.filename,
-                    file_dir=upload_dir,
-                    used_jobid=self.jobid,
-                    used_role=pname,
-                    owner=self.user.name,
-                    content_type=content_type
-                )
-                # Parameter value is set to the filename
-                # url = ARCHIVE_URL.format(ID=entity['entity_id'])
-                # if url.startswith('/'):
-                #     url = '{}{}'.format(BASE_URL, url)
-                # value = url
                 value = 'file://' + f.filename
             else:
                 # 2/ Parameter is a value, possibly an ID (set from post or by default)
@@ -349,35 +639,48 @@ class Job(object):
                     else:
                         furl = url.replace('$ID', value)
                     try:
-                        r = requests.get(furl, allow_redirects=True)
-                        if r.status_code == 200:
-                            cd = r.headers.get('content-disposition')
-                            filename = get_filename_from_cd(cd)
-                            if not os.path.isdir(upload_dir):
-                                os.makedirs(upload_dir)
-                            open(os.path.join(upload_dir, filename), 'wb').write(r.content)
-                            # Parameter value is set to the file name on server
-                            logger.info('Input "{}" is a URL and was downloaded : {}'.format(pname, furl))
-                            entity = self.storage.register_entity(
-                                file_name=filename,
-                                file_dir=upload_dir,
-                                used_jobid=self.jobid,
-                                used_role=pname,
-                                owner=self.user.name,
-                                content_type=content_type
-                            )
-                            # Parameter value is set to the URL of the file in the Entity Store
-                            # url = ARCHIVE_URL.format(ID=entity['entity_id'])
-                            # if url.startswith('/'):
-                            #     url = '{}{}'.format(BASE_URL, url)
-                            # value = url
-                            value = 'file://' + filename
+                        r = http_client.get_http_client().get(furl, allow_redirects=True, stream=True)
+                        with r:
+                            if r.status_code == 200:
+                                content_length = int(r.headers.get('content-length') or 0)
+                                if INPUT_URL_DEFER_SIZE and content_length > INPUT_URL_DEFER_SIZE:
+                                    # Large file, downloaded by the job script (see parameters_to_bash())
+                                    logger.info('Input "{}" is a URL and will be downloaded by the job ({} bytes): {}'.format(
+                                        pname, content_length, furl))
+                                    value = furl
+                                else:
+                                    filename = get_filename_from_cd(r.headers.get('content-disposition'))
+                                    filename = os.path.basename(filename or get_filename_from_url(r.url) or pname)
+                                    if not os.path.isdir(upload_dir):
+                                        os.makedirs(upload_dir)
+                                    # Written by chunks, the hash is computed on the fly
+                                    file_hash = download_response(r, os.path.join(upload_dir, filename))
+                                    file_name = filename
+                                    logger.info('Input "{}" is a URL and was downloaded : {}'.format(pname, furl))
+                                    value = 'file://' + filename
+                    except UserWarning as e:
+                        logger.warning('Cannot upload URL for input "{}": {}\n{}'.format(pname, furl, e))
+                        raise UserWarning('cannot upload URL for input "{}": {} ({})'.format(pname, furl, e))
                     except Exception as e:
                         logger.warning('Cannot upload URL for input "{}": {}\n{}'.format(pname, furl, e))
                         raise UserWarning('cannot upload URL for input "{}": {}'.format(pname, furl))
-                # TODO: 4/ check if value is an ID that already exists in the entity store ? other attribute ?
-                if not entity:
-                    pass
+            inputs[pname] = (value, file_name, file_hash, content_type)
+        # Save job as is for now
+        self.storage.save(self, save_attributes=True, save_parameters=True)
+        for pname, (value, file_name, file_hash, content_type) in inputs.items():
+            entity = {}
+            if file_name:
+                # Check if file already exists in entity store (hash + ID in name or jobid) and add in Used table
+                entity = self.storage.register_entity(
+                    file_name=file_name,
+                    file_dir=upload_dir,
+                    hash=file_hash,
+                    used_jobid=self.jobid,
+                    used_role=pname,
+                    owner=self.user.name,
+                    content_type=content_type
+                )
+            # TODO: 4/ check if value is an ID that already exists in the entity store ? other attribute ?
             # Store Input entity in UWS parameters
             self.parameters[pname] = {
                 'value': value,
@@ -596,6 +899,12 @@ class Job(object):
         xml_jobinfo = ETree.SubElement(xml_job, 'uws:jobInfo')
         # ETree.SubElement(xml_jobinfo, 'process_id').text = str(self.process_id)
         add_sub_elt(xml_jobinfo, 'process_id', str(self.process_id))
+        # Resources used by the job (e.g. recorded by LocalManager with cgroups)
+        resources_file = os.path.join(JOBDATA_PATH, self.jobid, 'resources.yml')
+        if os.path.isfile(resources_file):
+            with open(resources_file) as f:
+                for key, value in (yaml.safe_load(f) or {}).items():
+                    add_sub_elt(xml_jobinfo, key, str(value))
         # logger.debug(self.jobid)
         try:
             return ETree.tostring(xml_job)
@@ -810,6 +1119,8 @@ class Job(object):
         if self.phase not in ['PENDING']:
             # Send command to manager
             self.manager.delete(self)
+        # Blobs of the entity store that may not be linked anymore by the files of the job
+        hashes = self.storage.get_job_hashes(self.jobid) if USE_ENTITY_STORE else []
         # Remove uploaded files corresponding to jobid if needed
         uploads_dir = '{}/{}'.format(UPLOADS_PATH, self.jobid)
         if os.path.isdir(uploads_dir):
@@ -826,17 +1137,21 @@ class Job(object):
         # TODO: remove or keep entities ? may break the provenance...
         self.storage.remove_entity(jobid=self.jobid)
         self.storage.delete(self)
+        for file_hash in hashes:
+            entity_store.get_entity_store().release(file_hash)
 
-    def get_status(self):
+    def get_status(self, new_phase=None):
         """Get job status
 
         Job can get its status from the manager if it has been started and it is not in a final phase:
         - QUEUED / HELD / SUSPENDED
         - EXECUTING
+        new_phase may be given if the status was already obtained from the manager (e.g. get_status_bulk)
         """
         if self.phase not in ['PENDING', 'COMPLETED', 'ERROR', 'ABORTED', 'UNKNOWN']:
             # Send command to manager
-            new_phase = self.manager.get_status(self)
+            if new_phase is None:
+                new_phase = self.manager.get_status(self)
             if new_phase != self.phase:
                 # Change phase
                 self.change_status(new_phase)
@@ -865,6 +1180,9 @@ class Job(object):
         # Set start_time
         if new_phase in ['QUEUED']:
             self.start_time = now.strftime(DT_FMT)
+        # Execution starts (UWS startTime), the execution duration is counted from here (see DeadlineScheduler)
+        if new_phase == 'EXECUTING' and self.phase in ['PENDING', 'QUEUED', 'HELD']:
+            self.start_time = now.strftime(DT_FMT)
         if new_phase in ['COMPLETED', 'ABORTED', 'ERROR']:
             if self.phase not in ['ERROR']:
             # Get results, logs
@@ -884,8 +1202,9 @@ class Job(object):
                         self.error = error
                     self.end_time = now.strftime(DT_FMT)
                     self.storage.save(self)
-                    change_status_signal = signal('job_status')
-                    result = change_status_signal.send('change_status', sig_jobid=self.jobid, sig_phase=self.phase)
+                    storage.on_commit(send_status_signal, self.jobid, self.phase)
+                    # Keep the ERROR phase even if the request is rolled back
+                    storage.commit_session()
                     raise
         # Increment error message if needed
         if new_phase in ['ERROR', 'ABORTED', 'ARCHIVED']:
@@ -907,9 +1226,8 @@ class Job(object):
         self.phase = new_phase
         # Save job description
         self.storage.save(self)
-        # Send signal (e.g. if WAIT command expecting signal)
-        change_status_signal = signal('job_status')
-        result = change_status_signal.send('change_status', sig_jobid=self.jobid, sig_phase=self.phase)
+        # Send signal once the new phase is committed (e.g. if WAIT command expecting signal)
+        storage.on_commit(send_status_signal, self.jobid, self.phase)
         # logger.debug('Signal sent for status change ({} --> {}). Results: \n{}'.format(previous_phase, self.phase, str(result)))
         # Add provenance files
         if new_phase in ['COMPLETED']:
@@ -926,9 +1244,24 @@ class Job(object):
 
 
 class JobList(object):
-    """JobList with attributes and function to fetch from storage and return as XML"""
+    """JobList with attributes and function to fetch from storage and return as XML
+
+    The jobs are read from storage when iterated (see iter_jobs() and iter_xml()), by chunks, so that a long list can
+    be streamed. As for the UWS 1.1 parameters, after (datetime) keeps the jobs created after this time, and last (int)
+    keeps the last jobs created, the most recent first. If cursor is not None (an empty string for the first page),
+    only one page of jobs is read, of size last (bounded by JOBLIST_PAGE_SIZE), and next_cursor is set if there are
+    more jobs (older jobs if last is given).
+    """
 
-    def __init__(self, jobname, user, phase=None, after=None, last=None, where_owner=True, include_archived=False):
+    xmlns_uris = {
+        'xmlns:uws': 'http://www.ivoa.net/xml/UWS/v1.0',
+        'xmlns:xlink': 'http://www.w3.org/1999/xlink',
+        'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+        'xsi:schemaLocation': 'http://www.ivoa.net/xml/UWS/v1.0 http://ivoa.net/xml/UWS/UWS-v1.0.xsd'
+    }
+
+    def __init__(self, jobname, user, phase=None, after=None, last=None, where_owner=True, include_archived=False,
+                 cursor=None):
         self.jobname = jobname
         self.jobid = 'joblist'
         self.user = user
@@ -940,52 +1273,71 @@ class JobList(object):
         check_permissions(self)
 
         # Check if user is admin, then get all jobs
-        if user.check_admin():
+        self.is_admin = user.check_admin()
+        if self.is_admin:
             where_owner = False
             #logger.debug('User is the admin: list all jobs')
 
-        self.jobs = self.storage.get_list(self, phase=phase, after=after, last=last, where_owner=where_owner, include_archived=include_archived)
+        # LAST: the most recent jobs first, read from the end of the index
+        self.list_kwargs = dict(phase=phase, after=after, last=last, where_owner=where_owner,
+                                include_archived=include_archived, descending=bool(last))
+        self.next_cursor = None
+        self._jobs = None
+        if cursor is not None:
+            # Read one page now (bounded), and one more job to know if there is a next page
+            page_size = min(int(last), JOBLIST_PAGE_SIZE) if last else JOBLIST_PAGE_SIZE
+            self.list_kwargs.update(last=page_size + 1, cursor=cursor or None)
+            jobs = list(self.storage.iter_list(self, **self.list_kwargs))
+            if len(jobs) > page_size:
+                jobs = jobs[:page_size]
+                self.next_cursor = storage.encode_cursor(jobs[-1]['creation_time'], jobs[-1]['jobid'])
+            self._jobs = jobs
+
+    @property
+    def jobs(self):
+        """List of jobs (dict with jobid, phase, run_id, owner and creation_time), read from storage"""
+        if self._jobs is None:
+            self._jobs = list(self.iter_jobs())
+        return self._jobs
+
+    def iter_jobs(self):
+        """Iterate over the jobs, read from storage by chunks if not already read"""
+        if self._jobs is not None:
+            return iter(self._jobs)
+        return self.storage.iter_list(self, **self.list_kwargs)
+
+    def _jobref_to_xml(self, job):
+        href = '{}/{}/{}'.format(BASE_URL, self.jobname, job['jobid'])
+        xml_job = ETree.Element('uws:jobref', attrib={
+            'id': job['jobid'],
+            'xlink:href': href,
+        })
+        ETree.SubElement(xml_job, 'uws:phase').text = job['phase']
+        ETree.SubElement(xml_job, 'uws:runId').text = job['run_id']
+        if self.is_admin:
+            ETree.SubElement(xml_job, 'uws:ownerId').text = job['owner']
+        ETree.SubElement(xml_job, 'uws:creationTime').text = str(job['creation_time'])
+        return ETree.tostring(xml_job)
+
+    def iter_xml(self):
+        """Yield the XML representation of jobs (uws:jobs) by chunks, e.g. to stream the response"""
+        attrib = ' '.join('{}="{}"'.format(k, v) for k, v in self.xmlns_uris.items())
+        yield '<uws:jobs {}>'.format(attrib).encode()
+        chunk = []
+        for job in self.iter_jobs():
+            try:
+                chunk.append(self._jobref_to_xml(job))
+            except Exception as e:
+                raise UserWarning('Cannot serialize joblist: {}'.format(e))
+            if len(chunk) >= JOBLIST_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+        chunk.append(b'</uws:jobs>')
+        yield b''.join(chunk)
 
     def to_xml(self):
         """Returns the XML representation of jobs (uws:jobs)"""
-        # xml_out = [
-        #     '<?xml version="1.0" encoding="UTF-8"?>',
-        #     '<uws:jobs ',
-        #     'xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" ',
-        #     'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ',
-        #     'xsi:schemaLocation="http://www.ivoa.net/xml/UWS/v1.0 http://ivoa.net/xml/UWS/UWS-v1.0.xsd" ',
-        #     'xmlns:xlink="http://www.w3.org/1999/xlink">',
-        # ]
-        # for job in self.jobs:
-        #     href = '{}/{}/{}'.format(BASE_URL, self.jobname, job['jobid'])
-        #     xml_out.append('<uws:jobref id="{}" xlink:href="{}">'.format(job['jobid'], href))
-        #     xml_out.append('<uws:phase>{}</uws:phase>'.format(job['phase']))
-        #     xml_out.append('</uws:jobref>')
-        # xml_out.append('</uws:jobs>')
-        # return ''.join(xml_out)
-
-        xmlns_uris = {
-            'xmlns:uws': 'http://www.ivoa.net/xml/UWS/v1.0',
-            'xmlns:xlink': 'http://www.w3.org/1999/xlink',
-            'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-            'xsi:schemaLocation': 'http://www.ivoa.net/xml/UWS/v1.0 http://ivoa.net/xml/UWS/UWS-v1.0.xsd'
-        }
-        xml_jobs = ETree.Element('uws:jobs', attrib=xmlns_uris)
-        for job in self.jobs:
-            href = '{}/{}/{}'.format(BASE_URL, self.jobname, job['jobid'])
-            xml_job = ETree.SubElement(xml_jobs, 'uws:jobref', attrib={
-                'id': job['jobid'],
-                'xlink:href': href,
-            })
-            ETree.SubElement(xml_job, 'uws:phase').text = job['phase']
-            ETree.SubElement(xml_job, 'uws:runId').text = job['run_id']
-            if self.user.check_admin():
-                ETree.SubElement(xml_job, 'uws:ownerId').text = job['owner']
-            ETree.SubElement(xml_job, 'uws:creationTime').text = str(job['creation_time'])
-        try:
-            return ETree.tostring(xml_jobs)
-        except Exception as e:
-            raise UserWarning('Cannot serialize joblist: {}'.format(e))
+        return b''.join(self.iter_xml())
 
     def to_html(self):
         """Returns the HTML representation of jobs"""
@@ -13,6 +13,7 @@ import json
 import yaml
 import lxml.etree as ETree
 import glob
+import threading
 import datetime as dt
 from .settings import *
 
@@ -79,6 +80,46 @@ test_job = {
     'quote': 1,
 }
 
+# ---------
+# Registry of parsed job descriptions
+
+
+class JDLRegistry(object):
+    """
+    Job description files parsed by the process, indexed by file name. A file is parsed again only if
+    its modification time or size changed, or if the job description was invalidated (new, validated or
+    deleted job). The content is shared between JDLFile instances and must not be modified.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, fname, parse, jobname):
+        """Return parse(fname), parsed again only if the file changed (IOError if file not found)"""
+        st = os.stat(fname)
+        stamp = (st.st_mtime_ns, st.st_size)
+        item = self._files.get(fname)
+        if item is not None and item[0] == stamp:
+            return item[2]
+        content = parse(fname)
+        with self._lock:
+            self._files[fname] = (stamp, jobname, content)
+        return content
+
+    def invalidate(self, jobname=None):
+        """Remove the files of jobname from the registry (all files if jobname is None)"""
+        with self._lock:
+            if jobname is None:
+                self._files.clear()
+            else:
+                for fname in [f for f, item in self._files.items() if item[1] == jobname]:
+                    del self._files[fname]
+
+
+jdl_registry = JDLRegistry()
+
+
 # ---------
 # Job Description Language
 
@@ -146,11 +187,14 @@ class JDLFile(object):
             f.write(script.replace('\r', ''))
             logger.info('Job script saved: ' + script_fname)
 
+    def _read_file(self, fname):
+        with open(fname, 'r') as f:
+            return f.read()
+
     def read_script(self, jobname):
         script_fname = '{}/{}.sh'.format(self.scripts_path, jobname)
         if os.path.isfile(script_fname):
-            with open(script_fname,'r') as f:
-                self.content['script'] = f.read()
+            self.content['script'] = jdl_registry.get(script_fname, self._read_file, jobname)
         else:
             logger.warning('Script not found for {}'.format(jobname))
 
@@ -234,6 +278,10 @@ class JDLFile(object):
             'used': used,
             'executionDuration': post.get('executionDuration', EXECUTION_DURATION_DEF),
             'quote': post.get('quote', ''),
+            # Resources and priority of local jobs (see LocalScheduler)
+            'cpus': post.get('cpus', ''),
+            'memory': post.get('memory', ''),
+            'priority': post.get('priority', ''),
             'script': post.get('script', ''),
         })
 
@@ -257,16 +305,20 @@ class JSONFile(JDLFile):
         with open(jdl_fname, 'w') as f:
             f.write(js)
             logger.info('JSON saved: ' + jdl_fname)
+        jdl_registry.invalidate(jobname)
         # Write script file
         self.save_script(jobname, self.content['script'])
 
+    def _parse_json(self, fname):
+        with open(fname, 'r') as f:
+            #return json.load(f)
+            return yaml.safe_load(f)
+
     def read(self, jobname):
         """Read job description from file"""
         raw_jobname = jobname.split('/')[-1]  # remove tmp/ prefix
         fname = self._get_filename(jobname)
-        with open(fname, 'r') as f:
-            #self.content = json.load(f)
-            self.content.update(yaml.safe_load(f))
+        self.content.update(jdl_registry.get(fname, self._parse_json, jobname))
         # Load script in job_def
         if 'script' not in self.content:
             self.read_script(jobname)
@@ -360,6 +412,15 @@ class VOTFile(JDLFile):
                 'datatype': "int",
                 'utype': 'uws:Job.{}'.format(key),
             })
+        # Resources and priority of local jobs (see LocalScheduler), not written if not set
+        for key in ['cpus', 'memory', 'priority']:
+            if self.content.get(key):
+                ETree.SubElement(resource, 'PARAM', attrib={
+                    'name': key,
+                    'value': str(self.content[key]),
+                    'arraysize': "*",
+                    'datatype': "char",
+                })
         # Script
         script = ETree.SubElement(resource, 'PARAM', attrib={
             'name': 'script',
@@ -489,9 +550,145 @@ class VOTFile(JDLFile):
         with open(jdl_fname, 'wb') as f:
             f.write(jdl_content)
         logger.info('JDL saved as VOTable: ' + jdl_fname)
+        jdl_registry.invalidate(jobname)
         # Write script file
         self.save_script(jobname, self.content['script'])
 
+    def _parse_votable(self, fname):
+        """Parse VOTable file, return job description"""
+        groups = {
+            'InputParams': 'parameters',
+            'Used': 'used',
+            'Generated': 'generated'
+        }
+        with open(fname, 'r') as f:
+            jdl_string = f.read()
+        jdl_tree = ETree.fromstring(jdl_string)
+        #print jdl_tree
+        # Get default namespace
+        xmlns = '{' + jdl_tree.nsmap[None] + '}'
+        #print xmlns
+        # Read parameters description
+        resource_block = jdl_tree.find(".//{}RESOURCE".format(xmlns))
+        #print resource_block
+        job_def = {
+            'name': resource_block.get('name'),
+            'parameters': collections.OrderedDict(),
+            'generated': collections.OrderedDict(),
+            'used': collections.OrderedDict()
+        }
+        for elt in resource_block.getchildren():
+
+            if elt.tag == '{}DESCRIPTION'.format(xmlns):
+                job_def['annotation'] = elt.text
+                #print elt.text
+            if elt.tag == '{}LINK'.format(xmlns):
+                job_def['doculink'] = elt.get('href')
+            if elt.tag == '{}PARAM'.format(xmlns):
+                # TODO: set datatype of value in the dictionary?
+                #print elt.get('name'), elt.get('value')
+                job_def[elt.get('name')] = elt.get('value', '')
+
+                #logger.debug(elt.get('value', ''))
+                #for subelt in elt:
+                #    if subelt.tag == '{}DESCRIPTION'.format(xmlns):
+                #        logger.debug(subelt.text)
+
+            if elt.tag == '{}GROUP'.format(xmlns):
+                group = groups[elt.get('name')]
+                #print group
+                order = 0
+                keys = []
+                if group == 'parameters':
+                    for p in elt:
+                        if p.tag == '{}PARAM'.format(xmlns):
+                            order += 1
+                            name = p.get('name')
+                            keys.append(name)
+                            #print name, p.get('datatype', 'char')
+                            pdatatype = p.get('datatype', 'char')
+                            pxtype = p.get('xtype', None)
+                            if pxtype == 'application/octet-stream':
+                                pdatatype = 'file'
+                            else:
+                                pdatatype = self.datatype_vo2xs[pdatatype]
+                            prequired = 'true'
+                            if p.get('type') == 'no_query':    # type="no_query" in VOTable
+                                prequired = 'false'
+                            item = {
+                                'datatype': pdatatype,
+                                'required': prequired,
+                                'default': p.get('value'),
+                                'unit': p.get('unit', ''),
+                                'ucd': p.get('ucd', ''),
+                                'utype': p.get('utype', ''),
+                            }
+                            for pp in p:
+                                if pp.tag == '{}DESCRIPTION'.format(xmlns):
+                                    item['annotation'] = pp.text
+                                if pp.tag == '{}VALUES'.format(xmlns):
+                                    options = []
+                                    for ppp in pp:
+                                        if ppp.tag == '{}MIN'.format(xmlns):
+                                            item['min'] = ppp.get('value')
+                                        if ppp.tag == '{}MAX'.format(xmlns):
+                                            item['max'] = ppp.get('value')
+                                        if ppp.tag == '{}OPTION'.format(xmlns):
+                                            options.append(ppp.get('value'))
+                                    item['options'] = ','.join(options)
+                            job_def[group][name] = item
+                if group == 'used':
+                    for p in elt:
+                        order += 1
+                        name = p.get('name')
+                        keys.append(name)
+                        ref = p.get('ref')
+                        item = {
+                            'datatype': 'xs:string',  # may be changed below
+                            'annotation': '',         # filled below
+                            'url': '',                # default to ''
+                        }
+                        if ref:
+                            item['datatype'] = job_def.get('parameters').get(ref).get('datatype', item['datatype'])
+                            item['default'] = job_def.get('parameters').get(ref).get('default')
+                            item['annotation'] = job_def.get('parameters').get(ref).get('annotation', item['annotation'])
+                        for pp in p:
+                            if pp.tag == '{}PARAM'.format(xmlns):
+                                if pp.get('name'):
+                                    item[pp.get('name')] = pp.get('value')
+                            if pp.tag == '{}DESCRIPTION'.format(xmlns):
+                                item['annotation'] = pp.text
+                            if pp.tag == '{}LINK'.format(xmlns):
+                                purl = pp.get('href')
+                                item['url'] = purl
+                                if 'file://' in purl:
+                                    item['datatype'] = 'file'
+                        job_def[group][name] = item
+                if group == 'generated':
+                    for p in elt:
+                        order += 1
+                        name = p.get('name')
+                        keys.append(name)
+                        ref = p.get('ref')
+                        item = {
+                            'annotation': '',  # filled below
+                        }
+                        if ref:
+                            item['default'] = job_def.get('parameters').get(ref).get('default')
+                            item['annotation'] = job_def.get('parameters').get(ref).get('annotation')
+                        for pp in p:
+                            if pp.tag == '{}PARAM'.format(xmlns):
+                                if pp.get('name'):
+                                    item[pp.get('name')] = pp.get('value')
+                            if pp.tag == '{}DESCRIPTION'.format(xmlns):
+                                item['annotation'] = pp.text
+                        job_def[group][name] = item
+                job_def[group + '_keys'] = keys
+        # Log votable access
+        # frame, filename, line_number, function_name, lines, index = inspect.stack()[1]
+        # logger.debug('VOTable read at {} ({}:{}): {}'.format(function_name, filename, line_number, fname))
+        return job_def
+
     def read(self, jobname, jobid=None):
         """Read job description from VOTable file"""
         raw_jobname = jobname.split('/')[-1]  # remove tmp/ prefix
@@ -500,138 +697,12 @@ class VOTFile(JDLFile):
         elif self.content.get('name') != jobname:
             fname = self._get_filename(jobname, jobid=jobid)
             # '{}/{}{}'.format(JDL_PATH, job.jobname, self.extension)
-            groups = {
-                'InputParams': 'parameters',
-                'Used': 'used',
-                'Generated': 'generated'
-            }
             try:
-                with open(fname, 'r') as f:
-                    jdl_string = f.read()
-                jdl_tree = ETree.fromstring(jdl_string)
-                #print jdl_tree
-                # Get default namespace
-                xmlns = '{' + jdl_tree.nsmap[None] + '}'
-                #print xmlns
-                # Read parameters description
-                resource_block = jdl_tree.find(".//{}RESOURCE".format(xmlns))
-                #print resource_block
-                job_def = {
-                    'name': resource_block.get('name'),
-                    'parameters': collections.OrderedDict(),
-                    'generated': collections.OrderedDict(),
-                    'used': collections.OrderedDict()
-                }
-                for elt in resource_block.getchildren():
-
-                    if elt.tag == '{}DESCRIPTION'.format(xmlns):
-                        job_def['annotation'] = elt.text
-                        #print elt.text
-                    if elt.tag == '{}LINK'.format(xmlns):
-                        job_def['doculink'] = elt.get('href')
-                    if elt.tag == '{}PARAM'.format(xmlns):
-                        # TODO: set datatype of value in the dictionary?
-                        #print elt.get('name'), elt.get('value')
-                        job_def[elt.get('name')] = elt.get('value', '')
-
-                        #logger.debug(elt.get('value', ''))
-                        #for subelt in elt:
-                        #    if subelt.tag == '{}DESCRIPTION'.format(xmlns):
-                        #        logger.debug(subelt.text)
-
-                    if elt.tag == '{}GROUP'.format(xmlns):
-                        group = groups[elt.get('name')]
-                        #print group
-                        order = 0
-                        keys = []
-                        if group == 'parameters':
-                            for p in elt:
-                                if p.tag == '{}PARAM'.format(xmlns):
-                                    order += 1
-                                    name = p.get('name')
-                                    keys.append(name)
-                                    #print name, p.get('datatype', 'char')
-                                    pdatatype = p.get('datatype', 'char')
-                                    pxtype = p.get('xtype', None)
-                                    if pxtype == 'application/octet-stream':
-                                        pdatatype = 'file'
-                                    else:
-                                        pdatatype = self.datatype_vo2xs[pdatatype]
-                                    prequired = 'true'
-                                    if p.get('type') == 'no_query':    # type="no_query" in VOTable
-                                        prequired = 'false'
-                                    item = {
-                                        'datatype': pdatatype,
-                                        'required': prequired,
-                                        'default': p.get('value'),
-                                        'unit': p.get('unit', ''),
-                                        'ucd': p.get('ucd', ''),
-                                        'utype': p.get('utype', ''),
-                                    }
-                                    for pp in p:
-                                        if pp.tag == '{}DESCRIPTION'.format(xmlns):
-                                            item['annotation'] = pp.text
-                                        if pp.tag == '{}VALUES'.format(xmlns):
-                                            options = []
-                                            for ppp in pp:
-                                                if ppp.tag == '{}MIN'.format(xmlns):
-                                                    item['min'] = ppp.get('value')
-                                                if ppp.tag == '{}MAX'.format(xmlns):
-                                                    item['max'] = ppp.get('value')
-                                                if ppp.tag == '{}OPTION'.format(xmlns):
-                                                    options.append(ppp.get('value'))
-                                            item['options'] = ','.join(options)
-                                    job_def[group][name] = item
-                        if group == 'used':
-                            for p in elt:
-                                order += 1
-                                name = p.get('name')
-                                keys.append(name)
-                                ref = p.get('ref')
-                                item = {
-                                    'datatype': 'xs:string',  # may be changed below
-                                    'annotation': '',         # filled below
-                                    'url': '',                # default to ''
-                                }
-                                if ref:
-                                    item['datatype'] = job_def.get('parameters').get(ref).get('datatype', item['datatype'])
-                                    item['default'] = job_def.get('parameters').get(ref).get('default')
-                                    item['annotation'] = job_def.get('parameters').get(ref).get('annotation', item['annotation'])
-                                for pp in p:
-                                    if pp.tag == '{}PARAM'.format(xmlns):
-                                        if pp.get('name'):
-                                            item[pp.get('name')] = pp.get('value')
-                                    if pp.tag == '{}DESCRIPTION'.format(xmlns):
-                                        item['annotation'] = pp.text
-                                    if pp.tag == '{}LINK'.format(xmlns):
-                                        purl = pp.get('href')
-                                        item['url'] = purl
-                                        if 'file://' in purl:
-                                            item['datatype'] = 'file'
-                                job_def[group][name] = item
-                        if group == 'generated':
-                            for p in elt:
-                                order += 1
-                                name = p.get('name')
-                                keys.append(name)
-                                ref = p.get('ref')
-                                item = {
-                                    'annotation': '',  # filled below
-                                }
-                                if ref:
-                                    item['default'] = job_def.get('parameters').get(ref).get('default')
-                                    item['annotation'] = job_def.get('parameters').get(ref).get('annotation')
-                                for pp in p:
-                                    if pp.tag == '{}PARAM'.format(xmlns):
-                                        if pp.get('name'):
-                                            item[pp.get('name')] = pp.get('value')
-                                    if pp.tag == '{}DESCRIPTION'.format(xmlns):
-                                        item['annotation'] = pp.text
-                                job_def[group][name] = item
-                        job_def[group + '_keys'] = keys
-                # Log votable access
-                # frame, filename, line_number, function_name, lines, index = inspect.stack()[1]
-                # logger.debug('VOTable read at {} ({}:{}): {}'.format(function_name, filename, line_number, fname))
+                if fname.startswith(JOBDATA_PATH):
+                    # Copy of the JDL for a given job, not kept in the registry
+                    job_def = self._parse_votable(fname)
+                else:
+                    job_def = jdl_registry.get(fname, self._parse_votable, jobname)
             except IOError:
                 # if file does not exist, continue and return an empty dict
                 logger.debug('VOTable not found for job {}'.format(jobname))
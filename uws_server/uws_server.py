@@ -5,18 +5,20 @@
 """
 """
 
-import requests
 import traceback
+import json
+import time
 import glob
 import re
 import io
 import sys
 import copy
 import smtplib
+from types import SimpleNamespace
 from email.mime.text import MIMEText
 import threading
 from subprocess import CalledProcessError
-from bottle import Bottle, request, response, abort, redirect, run, static_file
+from bottle import Bottle, request, response, abort, redirect, run, static_file, parse_range_header
 
 from .uws_classes import *
 # Note: this import will also import .settings
@@ -53,6 +55,29 @@ def strip_path():
     request.environ['PATH_INFO'] = request.environ['PATH_INFO'].rstrip('/')
 
 
+@app.hook('before_request')
+def begin_storage_request():
+    # One unit of work per request: storage changes are committed once in end_storage_request()
+    storage.begin_request()
+
+
+@app.hook('after_request')
+def end_storage_request():
+    # Commit if the request succeeded, rollback on error (HTTP 4xx/5xx or uncaught exception)
+    failed = sys.exc_info()[0] is not None or response.status_code >= 400
+    storage.end_request(commit=not failed)
+
+
+def app_token_roles_synced(user_token, roles):
+    """Check that the roles of a user match its APP_TOKEN, if any (without database query)"""
+    if not APP_TOKENS or user_token not in APP_TOKENS:
+        return True
+    app_jobs = set(APP_TOKENS[user_token]["jobs"])
+    if APP_TOKENS[user_token]["active"]:
+        return 'all' in roles or app_jobs <= set(roles)
+    return not (app_jobs & set(roles))
+
+
 #@app.hook('before_request')
 def set_user(jobname=None):
     global logger
@@ -97,6 +122,11 @@ def set_user(jobname=None):
     logger = CustomAdapter(logger_init, {'username': user.name})
     if user == User('anonymous', 'anonymous') and ALLOW_ANONYMOUS == False:
         abort_403('User anomymous not allowed on this server')
+    # User already checked by this process (roles are updated on SCIM changes, or after USER_CACHE_TTL), unless
+    # the cached roles do not match its APP_TOKEN (e.g. token deactivated or reactivated)
+    roles = storage.user_cache.get(user.name, user.token)
+    if roles is not None and app_token_roles_synced(user.token, roles):
+        return user
     # Add user if not in db
     job_storage = getattr(storage, STORAGE + 'JobStorage')()
     job_storage.add_user(user.name, token=user.token)
@@ -115,6 +145,8 @@ def set_user(jobname=None):
                 else:
                     if active:
                         job_storage.add_role(user_name, user_token, role=jobname)
+    # Cache the roles once the user is committed to the db
+    storage.on_commit(storage.user_cache.set, user.name, user.token, job_storage.get_roles(user))
     return user
 
 
@@ -225,6 +257,16 @@ def abort_404(msg=None):
         abort(404)
 
 
+def abort_503(msg=''):
+    """HTTP Error 503
+
+    Returns:
+        503 Service Unavailable
+    """
+    logger.warning('Service Unavailable: {} ({})'.format(msg, request.urlparts.path))
+    abort(503, '{}'.format(msg))
+
+
 def abort_500(msg=None):
     """HTTP Error 500
 
@@ -278,7 +320,7 @@ def home():
         client_url = UWS_CLIENT_ENDPOINT
         if not "http" in client_url:
             client_url = BASE_URL + UWS_CLIENT_ENDPOINT
-        resp = requests.get(client_url)
+        resp = http_client.get_http_client().get(client_url, timeout=HTTP_CONNECT_TIMEOUT)
         resp_status_code = resp.status_code
     except Exception as e:
         msg_txt = "Client is not responding"
@@ -610,7 +652,7 @@ def create_new_job_definition():
             #jdl = uws_jdl.__dict__[JDL]()
             jdl = getattr(uws_jdl, JDL)()
             jdl.set_from_post(request.forms, user)
-            # Save as a new job description
+            # Save as a new job description (the previous one is removed from uws_jdl.jdl_registry)
             jdl.save('tmp/' + jobname)
         else:
             abort_500('No jobname given')
@@ -721,6 +763,7 @@ def validate_job_definition(jobname):
                 os.rename(jdl_dst, jdl_dst_save)
                 logger.info('Previous job JDL saved: ' + jdl_dst_save)
             shutil.copy(jdl_src, jdl_dst)
+            uws_jdl.jdl_registry.invalidate(jobname)
             logger.info('Job JDL file copied: ' + jdl_dst)
         else:
             logger.info('No JDL  found for validation: ' + jdl_src)
@@ -736,6 +779,7 @@ def validate_job_definition(jobname):
                 os.rename(script_dst, script_dst_save)
                 logger.info('Previous job script saved: ' + script_dst_save)
             shutil.copy(script_src, script_dst)
+            uws_jdl.jdl_registry.invalidate(jobname)
             logger.info('Job script copied: ' + script_dst)
             # Copy script to job manager
             #manager = managers.__dict__[MANAGER + 'Manager']()
@@ -913,6 +957,7 @@ def delete_jdl(jobname):
             jdl_dst_save = '{}/saved/{}_v{}_{}_DELETED{}'.format(
                 jdl.jdl_path, jobname, jdl.content['version'], mt, jdl.extension)
             shutil.move(jdl_src, jdl_dst_save)
+            uws_jdl.jdl_registry.invalidate(jobname)
             logger.info('JDL file archived and deleted: ' + jdl_dst_save)
         else:
             logger.warning('No JDL file found: ' + jdl_src)
@@ -924,6 +969,7 @@ def delete_jdl(jobname):
             script_dst_save = '{}/saved/{}_v{}_{}_DELETED.sh'.format(
                 SCRIPTS_PATH, jobname, jdl.content['version'], mt)
             shutil.move(script_src, script_dst_save)
+            uws_jdl.jdl_registry.invalidate(jobname)
             logger.info('Job script archived and deleted: ' + script_dst_save)
         else:
             logger.warning('No job script found: ' + script_src)
@@ -1147,6 +1193,13 @@ def provsap():
 # ----------
 
 
+def _to_datetime(value):
+    """Datetime from a date read from storage (string in DT_FMT for SQLite), None if not set"""
+    if not value or isinstance(value, dt.datetime):
+        return value or None
+    return dt.datetime.strptime(value, DT_FMT)
+
+
 @app.route('/handler/maintenance/<jobname>')
 @is_localhost
 def maintenance(jobname):
@@ -1162,25 +1215,50 @@ def maintenance(jobname):
     try:
         user = User('maintenance', MAINTENANCE_TOKEN)
         logger = logger_init
-        if jobname != "__all__":
+        all_jobnames = jobname == "__all__"
+        if not all_jobnames:
             jobnames = [jobname]
         else:
             jdl = getattr(uws_jdl, JDL)()
             jobnames = jdl.get_jobnames()
+        # Get status of the active jobs from the manager by chunks (e.g. one sacct call for SLURM), only the
+        # attributes needed by the manager are read for those jobs. Only the jobs whose phase changed are then read
+        # and updated, and the changes are committed once per chunk (the write lock of the database, e.g. SQLite,
+        # is not held for the whole maintenance)
+        job_storage = getattr(storage, STORAGE + 'JobStorage')()
+        active_phases = [p for p in PHASES if p not in TERMINAL_PHASES + ['PENDING', 'UNKNOWN']]
+        manager = getattr(managers, MANAGER + 'Manager')()
+        for jobname in jobnames:
+            report.append('Status of the active jobs of {}...'.format(jobname))
+            active_jobs = [SimpleNamespace(**j) for j in job_storage.get_process_ids(jobname, active_phases)]
+            for i in range(0, len(active_jobs), MAINTENANCE_CHUNK_SIZE):
+                chunk = active_jobs[i:i + MAINTENANCE_CHUNK_SIZE]
+                new_phases = manager.get_status_bulk(chunk)
+                for active_job in chunk:
+                    new_phase = new_phases.get(active_job.jobid)
+                    if new_phase is None:
+                        report.append('[{} {}] Status not found'.format(jobname, active_job.jobid))
+                    elif new_phase != active_job.phase:
+                        job = Job(jobname, active_job.jobid, user,
+                                  get_attributes=True, get_parameters=True, get_results=True)
+                        phase = job.phase
+                        new_phase = job.get_status(new_phase)
+                        report.append('[{} {}] Status has been updated: {} --> {}'.format(
+                            jobname, job.jobid, phase, new_phase))
+                storage.commit_flushed()
+            del active_jobs
+        # Consistency checks from the attributes of the jobs read by chunks, a job is read only to be archived
+        date_columns = ['start_time', 'end_time', 'destruction_time']
         for jobname in jobnames:
             report.append('Maintenance checks for {}...'.format(jobname))
-            # Get joblist
-            joblist = JobList(jobname, user, where_owner=False, include_archived=True)
             now = dt.datetime.now()
-            for j in joblist.jobs:
+            joblist = JobList(jobname, user, where_owner=False, include_archived=True)
+            for j in job_storage.iter_list(joblist, where_owner=False, include_archived=True, columns=date_columns):
                 # For each job:
-                job = Job(jobname, j['jobid'], user, get_attributes=True, get_parameters=True, get_results=True)
-                report.append('[{} {} {} {}]'.format(jobname, job.jobid, job.creation_time, job.phase))
+                report.append('[{} {} {} {}]'.format(jobname, j['jobid'], j['creation_time'], j['phase']))
                 # Check consistency of dates (destruction_time > end_time > start_time > creation_time)
-                creation_time = None if not job.creation_time else dt.datetime.strptime(job.creation_time, DT_FMT)
-                start_time = None if not job.start_time else dt.datetime.strptime(job.start_time, DT_FMT)
-                end_time = None if not job.end_time else dt.datetime.strptime(job.end_time, DT_FMT)
-                destruction_time = None if not job.destruction_time else dt.datetime.strptime(job.destruction_time, DT_FMT)
+                creation_time, start_time, end_time, destruction_time = [
+                    _to_datetime(j[key]) for key in ['creation_time'] + date_columns]
                 if creation_time and start_time and (creation_time > start_time):
                     report.append('  creation_time > start_time')
                 if start_time and end_time and (start_time > end_time):
@@ -1188,35 +1266,36 @@ def maintenance(jobname):
                 if end_time and destruction_time and (end_time > destruction_time):
                     report.append('  end_time > destruction_time')
                 # Check if start_time is set
-                if not start_time and job.phase not in ['PENDING', 'QUEUED']:
+                if not start_time and j['phase'] not in ['PENDING', 'QUEUED']:
                     report.append('  Start time not set')
-                if not end_time and job.phase in TERMINAL_PHASES:
+                if not end_time and j['phase'] in TERMINAL_PHASES:
                     report.append('  End time not set')
-                # Check status if phase is not terminal (or for all jobs?)
-                if job.phase not in TERMINAL_PHASES:
+                if j['phase'] not in TERMINAL_PHASES:
                     report.append('  Job is not in a terminal phase')
-                    phase = job.phase
-                    new_phase = job.get_status()  # will update the phase from manager
-                    if new_phase != phase:
-                        report.append('  Status has been updated: {} --> {}'.format(phase, new_phase))
                 # If destruction time is passed, delete or archive job
                 if destruction_time and (destruction_time < now):
                     # TODO: effective deletion or archiving of job
                     if USE_ARCHIVED_PHASE:
-                        if job.phase in ['COMPLETED', 'ABORTED', 'ERROR']:
+                        if j['phase'] in ['COMPLETED', 'ABORTED', 'ERROR']:
+                            job = Job(jobname, j['jobid'], user,
+                                      get_attributes=True, get_parameters=True, get_results=True)
                             job.archive()
+                            storage.commit_flushed()
                             report.append(
                                 '  Job has been archived (destruction_time={})'.format(job.destruction_time))
                         else:
                             # job.delete()
                             report.append(
-                                '  Job has been deleted (destruction_time={})'.format(job.destruction_time))
+                                '  Job has been deleted (destruction_time={})'.format(j['destruction_time']))
                             pass
                     else:
                         # job.delete()
                         report.append(
-                            '  Job has been deleted (destruction_time={})'.format(job.destruction_time))
+                            '  Job has been deleted (destruction_time={})'.format(j['destruction_time']))
                         pass
+        # Remove the blobs of the entity store not linked anymore (e.g. files removed by hand)
+        if USE_ENTITY_STORE and all_jobnames:
+            report.append('Entity store: {} blobs removed'.format(entity_store.get_entity_store().collect()))
         report.append('Done\n')
         for line in report:
             logger.warning(line)
@@ -1238,6 +1317,100 @@ def maintenance(jobname):
 # ----------
 
 
+def handle_job_event(process_id, new_phase=None, error_msg=''):
+    """Change the phase of the job with given process_id, or report an error
+
+    Used by /handler/job_event and by the receiver of in-process job events (see receive_job_event)
+    """
+    user = User('job_event', JOB_EVENT_TOKEN)
+    # Get job properties from DB based on process_id
+    job = Job('', process_id, user,
+              get_attributes=True, get_parameters=True, get_results=True,
+              from_process_id=True)
+    # Update job
+    if new_phase:
+        cur_phase = job.phase
+        msg = ''
+        # If phase=ERROR, add error message if available and change job status
+        if new_phase == 'ERROR':
+            msg = error_msg
+            job.change_status('ERROR', msg)
+            logger.info('ERROR reported for job {} {}'.format(job.jobname, job.jobid))
+        elif new_phase not in [cur_phase]:
+            # Convert phase if needed
+            if new_phase not in PHASES:
+                if new_phase in PHASE_CONVERT:
+                    new_msg = PHASE_CONVERT[new_phase]['msg']
+                    new_phase = PHASE_CONVERT[new_phase]['phase']
+                    if new_phase in ['ERROR', 'ABORTED']:
+                        msg = new_msg
+                else:
+                    raise UserWarning('Unknown new phase ' + new_phase + ' for job ' + job.jobid)
+            # Change job status
+            job.change_status(new_phase, msg)
+            logger.info('Phase {} --> {} for job {} {}'
+                        ''.format(cur_phase, new_phase, job.jobname, job.jobid))
+        else:
+            raise UserWarning('Phase is already ' + new_phase)
+    else:
+        raise UserWarning('Unknown event sent for job ' + job.jobid)
+
+
+@signal('job_event').connect
+def receive_job_event(process_id, phase=None, error_msg=''):
+    """Job event sent in-process by LocalManager (see managers.JobEventChannel), without HTTP request"""
+    # Same unit of work as a request if not already in one
+    request_scope = not storage.in_unit_of_work()
+    if request_scope:
+        storage.begin_request()
+    try:
+        handle_job_event(process_id, new_phase=phase, error_msg=error_msg)
+    except Exception as e:
+        logger_init.warning('Job event {} for process {} not handled: {}'.format(phase, process_id, e))
+        if request_scope:
+            storage.end_request(commit=False)
+        return
+    if request_scope:
+        storage.end_request()
+
+
+def abort_overrun_job(jobid, jobname):
+    """Abort a job still EXECUTING after its execution duration (called by the DeadlineScheduler thread)"""
+    storage.begin_request()
+    try:
+        user = User('maintenance', MAINTENANCE_TOKEN)
+        job = Job(jobname, jobid, user, get_attributes=True, get_parameters=True, get_results=True)
+        # The phase may have changed meanwhile, and the deadline is seen by all the server processes: only the one
+        # that changes the phase from EXECUTING aborts the job (e.g. a single scancel)
+        if job.phase == 'EXECUTING' and job.storage.claim_phase(jobid, 'EXECUTING', 'ERROR'):
+            error = 'Execution duration exceeded ({}s)'.format(job.execution_duration)
+            # No other process retries once the phase is claimed: the error is recorded even if the abort fails
+            try:
+                job.manager.abort(job)
+            except Exception as e:
+                logger_init.warning('Cannot abort job {} {} after its execution duration: {}'.format(jobname, jobid, e))
+                error += ', abort failed: {}'.format(e)
+            job.change_status('ERROR', error)
+            logger_init.info('Execution duration exceeded for job {} {}'.format(jobname, jobid))
+    except Exception as e:
+        logger_init.warning('Cannot abort job {} {} after its execution duration: {}'.format(jobname, jobid, e))
+        storage.end_request(commit=False)
+        return
+    storage.end_request()
+
+
+def start_deadline_scheduler():
+    """Abort the jobs that overrun their execution duration (see EXECUTION_DURATION_ENFORCE), called once per
+    server process by the WSGI script"""
+    if not EXECUTION_DURATION_ENFORCE:
+        return None
+    # Receive the status changes made by the other server processes
+    notifications.get_notification_bus()
+    scheduler = get_deadline_scheduler(abort_overrun_job)
+    scheduler.start()
+    return scheduler
+
+
 @app.post('/handler/job_event')
 @is_job_server
 def job_event():
@@ -1254,43 +1427,12 @@ def job_event():
     """
     global logger
     try:
-        user = User('job_event', JOB_EVENT_TOKEN)
         logger = logger_init
         logger.debug('with POST={}'.format(str(request.POST.dict)))
         if 'jobid' in request.POST:
-            process_id = request.POST['jobid']
-            # Get job properties from DB based on process_id
-            job = Job('', process_id, user,
-                      get_attributes=True, get_parameters=True, get_results=True,
-                      from_process_id=True)
-            # Update job
-            if 'phase' in request.POST:
-                cur_phase = job.phase
-                new_phase = request.POST['phase']
-                msg = ''
-                # If phase=ERROR, add error message if available and change job status
-                if new_phase == 'ERROR':
-                    msg = request.POST.get('error_msg', '')
-                    job.change_status('ERROR', msg)
-                    logger.info('ERROR reported for job {} {}'.format(job.jobname, job.jobid))
-                elif new_phase not in [cur_phase]:
-                    # Convert phase if needed
-                    if new_phase not in PHASES:
-                        if new_phase in PHASE_CONVERT:
-                            new_msg = PHASE_CONVERT[new_phase]['msg']
-                            new_phase = PHASE_CONVERT[new_phase]['phase']
-                            if new_phase in ['ERROR', 'ABORTED']:
-                                msg = new_msg
-                        else:
-                            raise UserWarning('Unknown new phase ' + new_phase + ' for job ' + job.jobid)
-                    # Change job status
-                    job.change_status(new_phase, msg)
-                    logger.info('Phase {} --> {} for job {} {}'
-                                ''.format(cur_phase, new_phase, job.jobname, job.jobid))
-                else:
-                    raise UserWarning('Phase is already ' + new_phase)
-            else:
-                raise UserWarning('Unknown event sent for job ' + job.jobid)
+            handle_job_event(request.POST['jobid'],
+                             new_phase=request.POST.get('phase'),
+                             error_msg=request.POST.get('error_msg', ''))
         else:
             raise UserWarning('jobid is not defined in POST')
     except JobAccessDenied as e:
@@ -1328,14 +1470,43 @@ def get_joblist(jobname):
         if 'PHASE' in request.query:
             # Allow for multiple PHASE keywords to be sent
             phase = re.split('&?PHASE=', request.query_string)[1:]
-        # TODO: UWS v1.1 AFTER keyword
+        # UWS v1.1 AFTER keyword: jobs created after an ISO 8601 date/time
         after = request.query.get('AFTER', None)
-        # TODO: UWS v1.1 LAST keyword
+        if after:
+            try:
+                after = dt.datetime.fromisoformat(after)
+            except ValueError:
+                raise BadRequest('Bad value for AFTER ({}), ISO 8601 date/time expected'.format(after))
+            if after.tzinfo:
+                # Creation times are stored in the local time of the server
+                after = after.astimezone().replace(tzinfo=None)
+        # UWS v1.1 LAST keyword: the last jobs created, the most recent first
         last = request.query.get('LAST', None)
-        joblist = JobList(jobname, user, phase=phase, after=after, last=last)
-        xml_out = joblist.to_xml()
+        if last:
+            try:
+                last = int(last)
+                if last <= 0:
+                    raise ValueError
+            except ValueError:
+                raise BadRequest('Bad value for LAST ({}), positive integer expected'.format(last))
+        # Keyset pagination: CURSOR empty for the first page, then given by the Link header of the previous page
+        cursor = request.query.get('CURSOR', None)
+        if cursor:
+            try:
+                storage.decode_cursor(cursor)
+            except ValueError as e:
+                raise BadRequest(str(e))
+        joblist = JobList(jobname, user, phase=phase, after=after, last=last, cursor=cursor)
+        if joblist.next_cursor:
+            query = [(k, v) for k, v in request.query.allitems() if k != 'CURSOR']
+            query.append(('CURSOR', joblist.next_cursor))
+            next_url = '{}/rest/{}?{}'.format(BASE_URL, jobname, urllib.parse.urlencode(query))
+            response.set_header('Link', '<{}>; rel="next"'.format(next_url))
         response.content_type = 'text/xml; charset=UTF-8'
-        return xml_out
+        # The job list is streamed, read from storage by chunks
+        return joblist.iter_xml()
+    except BadRequest as e:
+        abort_400(e.args[0])
     except JobAccessDenied as e:
         abort_403(str(e))
     except storage.NotFoundWarning as e:
@@ -1408,26 +1579,15 @@ def get_job(jobname, jobid):
             if wait_time == -1:
                 wait_time = WAIT_TIME_MAX
             if (client_phase == job.phase) and (wait_time > 0):
-                change_status_signal = signal('job_status')
-                change_status_event = threading.Event()
-
-                def receiver(sender, **kw):
-                    logger.info('{}: {} is now {}'.format(sender, kw.get('sig_jobid'), kw.get('sig_phase')))
-                    # Set event if job changed
-                    if (kw.get('sig_jobid') == jobid) and (kw.get('sig_phase') != job.phase):
-                        change_status_event.set()
-                        return '{}: signal received and job updated'.format(jobid)
-                    return '{}: signal received but job not concerned'.format(jobid)
-
-                # Connect to signal
-                change_status_signal.connect(receiver)
-                # Wait for signal event
+                # Commit and release the storage session (and its locks) while blocking
+                storage.commit_session()
+                storage.remove_session()
+                # Wait for a phase change, signaled by this process or seen in storage
                 logger.info('{}: Blocking for {} seconds'.format(jobid, wait_time))
-                event_is_set = change_status_event.wait(wait_time)
+                phase_changed = get_wait_broker().wait(jobid, job.phase, wait_time)
                 logger.info('{}: Continue execution'.format(jobid))
-                change_status_signal.disconnect(receiver)
                 # Reload job if necessary
-                if event_is_set:
+                if phase_changed:
                     job = Job(jobname, jobid, user,
                               get_attributes=True, get_parameters=True, get_results=True)
         # Return job description in UWS format
@@ -1944,27 +2104,106 @@ def get_result(jobname, jobid, rname):
         abort_500_except()
 
 
-@app.route('/rest/<jobname>/<jobid>/stdout')
-def get_stdout(jobname, jobid):
-    """Get stdout for job <jobid>
-
-    Returns:
-        200 OK: file (on success)
-        404 Not Found: Job not found (on NotFoundWarning)
-        404 Not Found: Result not found (on NotFoundWarning)
-        500 Internal Server Error (on error)
+def iter_file(path, start, end, chunk_size=65536):
+    """Iterate over the bytes of a file from start to end by chunks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def tail_offset(path, size, n, chunk_size=65536):
+    """Offset of the last n lines of a file"""
+    if n == 0:
+        return size
+    with open(path, 'rb') as f:
+        offset = size
+        # A final newline does not start a new line
+        newlines = -1
+        f.seek(max(size - 1, 0))
+        if f.read(1) != b'\n':
+            newlines = 0
+        while offset > 0:
+            start = max(offset - chunk_size, 0)
+            f.seek(start)
+            chunk = f.read(offset - start)
+            pos = len(chunk)
+            while True:
+                pos = chunk.rfind(b'\n', 0, pos)
+                if pos < 0:
+                    break
+                newlines += 1
+                if newlines == n:
+                    return start + pos + 1
+            offset = start
+    return 0
+
+
+def send_log(jobname, jobid, logname):
+    """Send the log <logname> (stdout or stderr) of job <jobid>
+
+    The log can be read incrementally: from a byte offset (offset=N), its last lines (tail=N), or a byte range
+    (Range header, 206 Partial Content). The ETag changes with the size and modification time of the log, so that
+    a client can poll it with If-None-Match (304 Not Modified if unchanged). The X-Log-Size header gives the size
+    of the log, i.e. the offset to read the next bytes.
+
+    If the log is not in JOBDATA_PATH, it is read through the manager (e.g. on the SLURM work cluster while the job
+    is running), from offset or its last lines, with chunked transfer.
     """
     user = set_user()
     try:
-        # Get job properties from DB
-        # job = Job(jobname, jobid, user, get_results=True)
-        logname = 'stdout'
+        offset = int(request.query.get('offset', 0))
+        tail = request.query.get('tail', None)
+        tail = int(tail) if tail is not None else None
+        if offset < 0 or (tail is not None and tail < 0):
+            raise ValueError('negative value')
+    except ValueError as e:
+        abort_400('Bad value for offset or tail: {}'.format(e))
+    try:
         logroot = '{}/{}'.format(JOBDATA_PATH, jobid)
-        if not os.path.isfile(os.path.join(logroot, logname + '.log')):
-            # TODO: get from manager if not available, only available when EXECUTING
-            raise storage.NotFoundWarning('Log "{}" NOT FOUND for job "{}"'.format(logname, jobid))
-        # Return file
-        return static_file(logname + '.log', root=logroot, mimetype='text')
+        path = os.path.join(logroot, logname + '.log')
+        response.content_type = 'text/plain; charset=UTF-8'
+        if not os.path.isfile(path):
+            # Get from manager if not available, only available when EXECUTING
+            job = Job(jobname, jobid, user, get_attributes=True)
+            log = None
+            if job.phase in ACTIVE_PHASES:
+                try:
+                    log = job.manager.get_log(job, logname, offset=offset, tail=tail)
+                except CalledProcessError as e:
+                    logger.debug('Cannot get log "{}" for job "{}": {}'.format(logname, jobid, e.output))
+            if log is None:
+                raise storage.NotFoundWarning('Log "{}" NOT FOUND for job "{}"'.format(logname, jobid))
+            return log
+        stats = os.stat(path)
+        size = stats.st_size
+        etag = '"{:x}-{:x}"'.format(size, stats.st_mtime_ns)
+        response.set_header('ETag', etag)
+        response.set_header('Accept-Ranges', 'bytes')
+        response.set_header('X-Log-Size', str(size))
+        if_none_match = request.get_header('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+            response.status = 304
+            return ''
+        start, end = min(offset, size), size
+        if tail is not None:
+            start = tail_offset(path, size, tail)
+        if request.get_header('Range'):
+            ranges = list(parse_range_header(request.get_header('Range'), size))
+            if not ranges:
+                response.set_header('Content-Range', 'bytes */{}'.format(size))
+                response.status = 416
+                return ''
+            start, end = ranges[0]
+            response.status = 206
+            response.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+        response.set_header('Content-Length', str(end - start))
+        return iter_file(path, start, end)
     except JobAccessDenied as e:
         abort_403(str(e))
     except storage.NotFoundWarning as e:
@@ -1973,33 +2212,192 @@ def get_stdout(jobname, jobid):
         abort_500_except()
 
 
+@app.route('/rest/<jobname>/<jobid>/stdout')
+def get_stdout(jobname, jobid):
+    """Get stdout for job <jobid>, see send_log() for incremental access
+
+    Returns:
+        200 OK: file (on success)
+        206 Partial Content: part of file (Range header)
+        304 Not Modified: file not modified (If-None-Match header)
+        404 Not Found: Job not found (on NotFoundWarning)
+        404 Not Found: Result not found (on NotFoundWarning)
+        500 Internal Server Error (on error)
+    """
+    return send_log(jobname, jobid, 'stdout')
+
+
 @app.route('/rest/<jobname>/<jobid>/stderr')
 def get_stderr(jobname, jobid):
-    """Get stderr for job <jobid>
+    """Get stderr for job <jobid>, see send_log() for incremental access
 
     Returns:
         200 OK: file (on success)
+        206 Partial Content: part of file (Range header)
+        304 Not Modified: file not modified (If-None-Match header)
         404 Not Found: Job not found (on NotFoundWarning)
         404 Not Found: Result not found (on NotFoundWarning)
         500 Internal Server Error (on error)
     """
+    return send_log(jobname, jobid, 'stderr')
+
+
+def format_event(event, data, event_id=None):
+    """Format a Server-Sent Event, data is sent as JSON"""
+    lines = []
+    if event_id is not None:
+        lines.append('id: {}'.format(event_id))
+    lines.append('event: {}'.format(event))
+    lines.append('data: {}'.format(json.dumps(data)))
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def read_log(jobid, logname, offset, whole=False):
+    """Read the new lines of a log from offset (in bytes), return (text, new offset)
+
+    Only complete lines are returned, unless whole is True (e.g. the job has ended).
+    """
+    try:
+        with open(os.path.join(JOBDATA_PATH, jobid, logname + '.log'), 'rb') as f:
+            f.seek(offset)
+            data = f.read(EVENTS_LOG_CHUNK_SIZE)
+    except FileNotFoundError:
+        return '', offset
+    if not whole and len(data) < EVENTS_LOG_CHUNK_SIZE:
+        data = data[:data.rfind(b'\n') + 1]
+    return data.decode('utf-8', errors='replace'), offset + len(data)
+
+
+class EventStreams(object):
+    """
+    Server-Sent Events streams open in the server process. A stream holds a thread of the WSGI server for up to
+    WAIT_TIME_MAX, and only takes a slot of the WaitBroker while it waits, so the number of streams is bounded
+    separately by max_streams (0 for no limit).
+    """
+
+    def __init__(self, max_streams=EVENTS_MAX_STREAMS):
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.n_streams = 0
+
+    def count(self):
+        """Number of open streams"""
+        with self.lock:
+            return self.n_streams
+
+    def open(self):
+        """Count a new stream, return False if too many streams are open"""
+        with self.lock:
+            if self.max_streams and self.n_streams >= self.max_streams:
+                return False
+            self.n_streams += 1
+            return True
+
+    def stream(self, events):
+        """Iterate over the events of a stream counted by open(), the stream is closed when the iteration ends or
+        when the response is closed (e.g. client disconnected)"""
+        try:
+            yield from events
+        finally:
+            with self.lock:
+                self.n_streams -= 1
+
+
+event_streams = EventStreams()
+
+
+def iter_job_events(jobid, phase, offsets, timeout):
+    """Yield the Server-Sent Events of a job: its phase changes, and the new lines of stdout.log and stderr.log
+
+    Events:
+        phase: {"phase": <phase>}, sent first, then on each phase change
+        stdout, stderr: {"offset": <offset in bytes>, "text": <new lines>}, the event id gives the offsets
+            of the logs after this event ("<stdout offset>:<stderr offset>")
+        end: {"phase": <phase>}, the job has ended and its logs were sent, the stream is closed
+    The stream is closed after timeout seconds, the client then reconnects with the Last-Event-ID header.
+    """
+    broker = get_wait_broker()
+    job_storage = getattr(storage, STORAGE + 'JobStorage')()
+    t_end = time.monotonic() + timeout
+    yield 'retry: {}\n\n'.format(int(EVENTS_LOG_INTERVAL * 1000) + 1000).encode()
+    yield format_event('phase', {'phase': phase})
+    t_sent = time.monotonic()
+    while True:
+        ended = phase is None or phase in TERMINAL_PHASES
+        # New lines of the logs, all the logs if the job has ended
+        more = False
+        for logname in ['stdout', 'stderr']:
+            start = offsets[logname]
+            text, offsets[logname] = read_log(jobid, logname, start, whole=ended)
+            if text:
+                event_id = '{stdout}:{stderr}'.format(**offsets)
+                yield format_event(logname, {'offset': start, 'text': text}, event_id=event_id)
+                t_sent = time.monotonic()
+                more = more or offsets[logname] - start >= EVENTS_LOG_CHUNK_SIZE
+        if more:
+            continue
+        if ended:
+            yield format_event('end', {'phase': phase})
+            return
+        if time.monotonic() > t_end:
+            return
+        # Wait for a phase change, or for new lines in the logs
+        changed = broker.wait(jobid, phase, EVENTS_LOG_INTERVAL)
+        if changed is None:
+            # Too many waiters: the client reconnects after the retry delay
+            return
+        if changed:
+            new_phase = job_storage.get_phases([jobid]).get(jobid)
+            if new_phase != phase:
+                phase = new_phase
+                yield format_event('phase', {'phase': phase})
+                t_sent = time.monotonic()
+        if time.monotonic() - t_sent > EVENTS_KEEPALIVE:
+            yield b': keepalive\n\n'
+            t_sent = time.monotonic()
+
+
+@app.route('/rest/<jobname>/<jobid>/events')
+def get_events(jobname, jobid):
+    """Get a stream of Server-Sent Events for job <jobid>: phase changes and new lines of stdout/stderr
+
+    The offsets of the logs can be given with the stdout_offset and stderr_offset parameters, or with
+    the Last-Event-ID header when the client reconnects.
+
+    Returns:
+        200 OK: text/event-stream (on success)
+        404 Not Found: Job not found (on NotFoundWarning)
+        500 Internal Server Error (on error)
+        503 Service Unavailable: too many streams open (see EVENTS_MAX_STREAMS)
+    """
     user = set_user()
     try:
-        # Get job properties from DB
-        # job = Job(jobname, jobid, user, get_results=True)
-        logname = 'stderr'
-        logroot = '{}/{}'.format(JOBDATA_PATH, jobid)
-        if not os.path.isfile(os.path.join(logroot, logname + '.log')):
-            # TODO: get from manager if not available, only available when EXECUTING
-            raise storage.NotFoundWarning('Log "{}" NOT FOUND for job "{}"'.format(logname, jobid))
-        # Return file
-        return static_file(logname + '.log', root=logroot, mimetype='text')
+        logger.info('{} {}'.format(jobname, jobid))
+        job = Job(jobname, jobid, user, get_attributes=True)
+        offsets = {
+            'stdout': int(request.query.get('stdout_offset', 0)),
+            'stderr': int(request.query.get('stderr_offset', 0)),
+        }
+        last_event_id = request.get_header('Last-Event-ID')
+        if last_event_id:
+            offsets['stdout'], offsets['stderr'] = [int(o) for o in last_event_id.split(':')]
+        timeout = int(request.query.get('timeout', WAIT_TIME_MAX))
+        timeout = min(timeout, WAIT_TIME_MAX)
+        response.content_type = 'text/event-stream; charset=UTF-8'
+        response.set_header('Cache-Control', 'no-cache')
+        # Do not buffer the stream in a reverse proxy (e.g. nginx)
+        response.set_header('X-Accel-Buffering', 'no')
     except JobAccessDenied as e:
         abort_403(str(e))
     except storage.NotFoundWarning as e:
         abort_404(str(e))
+    except ValueError as e:
+        abort_400('Bad offset or timeout: {}'.format(e))
     except:
         abort_500_except()
+    if not event_streams.open():
+        abort_503('Too many event streams ({}), retry later'.format(event_streams.max_streams))
+    return event_streams.stream(iter_job_events(jobid, job.phase, offsets, timeout))
 
 
 @app.route('/rest/<jobname>/<jobid>/prov<provtype>')
@@ -17,5 +17,8 @@ os.chdir(curdir)
 
 from uws_server import uws_server
 
+# Abort the jobs that overrun their execution duration
+uws_server.start_deadline_scheduler()
+
 # Do NOT use bottle.run() with mod_wsgi
 application = uws_server.app